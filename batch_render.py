@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Rendering lots of images (every frame of a recorded animation, one chart per dataset...) on all cores. Each worker
+# process has its own QApplication and OffscreenMarcPaintWidget, set up once, and renders one input at a time:
+#
+#     def draw_chart(renderer, dataset):
+#         renderer.fill_rects(dataset.locations, dataset.dimensions, dataset.colors)
+#
+#     for i, png_bytes in enumerate(render_batch(draw_chart, datasets, workers=8, size=(800, 600))):
+#         with open("chart_%d.png" % i, "wb") as f:
+#             f.write(png_bytes)
+#
+# The scene function and inputs are sent to other processes, so they have to be picklable (e.g. a module level
+# function rather than a lambda).
+
+# what a worker process keeps between tasks: its QApplication, renderer, scene function and encoding
+_worker_state = {}
+
+
+class RenderFailure:
+    """
+    Stands in for the image of an input that couldn't be rendered, either because the scene function raised an
+    exception, or because the worker process died while rendering it.
+    """
+
+    def __init__(self, index, message, traceback_text=None):
+        self.index = index
+        self.message = message
+        self.traceback_text = traceback_text
+
+    def __repr__(self):
+        return "RenderFailure(index={}, message={!r})".format(self.index, self.message)
+
+
+class WorkerInitializationError(Exception):
+    """
+    Raised by render_batch when the worker processes can't set up their renderers (e.g. because no OpenGL context can
+    be made), so that nothing can be rendered at all.
+    """
+    pass
+
+
+def render_batch(scene_function, inputs, workers=None, encoding="PNG", max_in_flight=None, renderer_class=None,
+                 **renderer_options):
+    """
+    Renders one image per input, in parallel, and yields the results in the order of the inputs.
+
+    :param scene_function: function(renderer, scene_input) that draws the scene for one input. Layers that aren't
+        static are cleared between inputs, so static layers can be used for things every image shares.
+    :param inputs: an iterable of scene inputs; it's consumed lazily, so it can be a generator
+    :param workers: number of worker processes (by default, one per core)
+    :param encoding: the image format to encode with in the workers ("PNG", "JPG"...), in which case the results are
+        bytes, or None to get the RGBA numpy arrays from OffscreenMarcPaintWidget.render
+    :param max_in_flight: how many inputs can be taken from the iterable but not yet yielded (by default, twice the
+        number of workers). This bounds memory use when the consumer is slower than the workers.
+    :param renderer_class: OffscreenMarcPaintWidget or a subclass of it
+    :param renderer_options: passed on to renderer_class, e.g. size, view_bounds, bg_color or samples
+    :return: a generator of encoded images (or pixel arrays), with a RenderFailure in place of any that failed. If the
+        workers can't set up their renderers, it raises a WorkerInitializationError instead.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    max_in_flight = 2 * workers if max_in_flight is None else max_in_flight
+    initializer_arguments = (scene_function, renderer_class, renderer_options, encoding)
+
+    indexed_inputs = enumerate(inputs)
+    inputs_exhausted = False
+    # future -> (index, scene input, whether it's a suspect running on its own)
+    pending = {}
+    # results that are done but waiting for earlier ones, so that they come out in order
+    finished = {}
+    # inputs that were in flight when a worker died; they are retried one at a time to find the one that killed it
+    suspects = deque()
+    next_index = 0
+
+    executor = _make_executor(workers, initializer_arguments)
+    try:
+        while True:
+            if len(suspects) > 0:
+                if len(pending) == 0:
+                    index, scene_input = suspects.popleft()
+                    pending[executor.submit(_render_in_worker, index, scene_input)] = (index, scene_input, True)
+            else:
+                while not inputs_exhausted and len(pending) + len(finished) < max_in_flight:
+                    try:
+                        index, scene_input = next(indexed_inputs)
+                    except StopIteration:
+                        inputs_exhausted = True
+                        break
+                    pending[executor.submit(_render_in_worker, index, scene_input)] = (index, scene_input, False)
+
+            if len(pending) == 0:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pool_broke = False
+            for future in done:
+                index, scene_input, is_suspect = pending.pop(future)
+                try:
+                    finished[index] = future.result()
+                except BrokenProcessPool:
+                    if is_suspect:
+                        # it was running on its own, so it's the one that took the worker down
+                        finished[index] = RenderFailure(index, "The worker process died while rendering this input")
+                    else:
+                        suspects.append((index, scene_input))
+                    pool_broke = True
+
+            if pool_broke:
+                # everything else in flight is lost along with the pool, and gets retried
+                suspects.extend((index, scene_input) for index, scene_input, _ in pending.values())
+                suspects = deque(sorted(suspects, key=lambda suspect: suspect[0]))
+                pending = {}
+                executor.shutdown(wait=False)
+                executor = _make_executor(workers, initializer_arguments)
+                # if the workers themselves can't start, retrying the inputs one by one would only spawn pool after
+                # pool, so a fresh pool has to prove it works first
+                _check_executor(executor)
+
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+    finally:
+        executor.shutdown(wait=False)
+        for future in pending:
+            future.cancel()
+
+
+def _make_executor(workers, initializer_arguments):
+    # Qt and GL don't survive a fork, so the workers are always spawned fresh
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_initialize_worker, initargs=initializer_arguments)
+
+
+def _check_executor(executor):
+    # waits for a worker of a new pool to start up, raising if it can't
+    try:
+        executor.submit(_check_worker).result()
+    except BrokenProcessPool:
+        executor.shutdown(wait=False)
+        raise WorkerInitializationError("The worker processes die while starting up")
+
+
+def _initialize_worker(scene_function, renderer_class, renderer_options, encoding):
+    try:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        # llvmpipe would otherwise start a rendering thread per core in every worker; the parallelism comes from the
+        # processes instead
+        os.environ.setdefault("LP_NUM_THREADS", "1")
+        from PyQt5 import QtWidgets
+        from .offscreen import OffscreenMarcPaintWidget
+        if renderer_class is None:
+            renderer_class = OffscreenMarcPaintWidget
+        _worker_state["application"] = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        _worker_state["renderer"] = renderer_class(**renderer_options)
+        _worker_state["scene_function"] = scene_function
+        _worker_state["encoding"] = encoding
+    except Exception:
+        # raising here would just kill the worker (and the pool with it) without saying why, so the error is kept to
+        # be raised by every task instead
+        _worker_state["initialization_error"] = traceback.format_exc()
+
+
+def _check_worker():
+    if "initialization_error" in _worker_state:
+        raise WorkerInitializationError("A worker process couldn't set up its renderer:\n" +
+                                        _worker_state["initialization_error"])
+
+
+def _render_in_worker(index, scene_input):
+    _check_worker()
+    renderer = _worker_state["renderer"]
+    try:
+        for layer in renderer.get_layers():
+            if not layer.static:
+                layer.clear()
+        _worker_state["scene_function"](renderer, scene_input)
+        pixels = renderer.render()
+        if _worker_state["encoding"] is None:
+            return pixels
+        return _encode_pixels(pixels, _worker_state["encoding"])
+    except Exception as exception:
+        return RenderFailure(index, repr(exception), traceback.format_exc())
+
+
+def _encode_pixels(pixels, encoding):
+    from PyQt5.QtGui import QImage
+    from PyQt5.QtCore import QBuffer, QByteArray, QIODevice
+    height, width = pixels.shape[:2]
+    pixel_bytes = pixels.tobytes()
+    image = QImage(pixel_bytes, width, height, width * 4, QImage.Format_RGBA8888)
+    byte_array = QByteArray()
+    buffer = QBuffer(byte_array)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, encoding)
+    buffer.close()
+    return bytes(byte_array)
@@ -0,0 +1,94 @@
+"""
+Times fill_arcs, which builds arcs from cached unit templates (see tessellation_template_cache), against building them
+the way it did before the cache: linspace, cos, sin and tile on every call. Both are timed for 1, 1k and 100k arcs,
+with one angle range shared by all the arcs, with an angle range for each arc out of a handful of distinct ones (as in
+pie charts), and with an angle range of its own for each arc (more distinct ranges than are worth caching, so both
+do the trig).
+
+    python benchmarks/bench_arc_templates.py
+
+(marqt has to be importable; no OpenGL context is needed, since nothing gets painted)
+"""
+import math
+import os
+import time
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PyQt5 import QtWidgets
+from marqt.marc_paint import MarcPaintWidget
+from marqt.marc_paint_shapes import TriangleFans
+
+ARC_COUNTS = (1, 1000, 100000)
+RANGE_CASES = ("shared angle range", "few distinct angle ranges", "all distinct angle ranges")
+NUM_SEGMENTS = 100
+
+
+def fill_arcs_without_templates(widget, centers, radii, colors, angle_ranges, num_segments):
+    # fill_arcs as it was before the template cache, for a single color
+    edges = centers.repeat(num_segments + 1, axis=0)
+    if angle_ranges.ndim == 1:
+        angles = np.linspace(angle_ranges[0], angle_ranges[1], num_segments+1)
+        displacements = np.tile(np.column_stack((np.cos(angles), np.sin(angles))), (centers.shape[0], 1))
+    else:
+        zero_to_one_ramps = np.tile(np.linspace(0, 1, num_segments+1), centers.shape[0])
+        ranges_repeated = angle_ranges.repeat(num_segments+1, axis=0)
+        angles = ranges_repeated[:, 0] * (1-zero_to_one_ramps) + ranges_repeated[:, 1] * zero_to_one_ramps
+        displacements = np.column_stack((np.cos(angles), np.sin(angles)))
+    edges += radii.repeat(num_segments+1, axis=0)[:, np.newaxis]*displacements
+    insert_locations = np.arange(0, edges.shape[0], num_segments+1)
+    vertices = np.insert(edges, insert_locations, centers, axis=0)
+    start_indices = None if centers.shape[0] == 1 else np.arange(0, vertices.shape[0], num_segments + 2)
+    return widget._add_shape(TriangleFans(widget, vertices, colors, starting_indices=start_indices))
+
+
+def time_calls(function, min_seconds=1.0, max_calls=1000):
+    # the fastest of repeated calls, in seconds
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_calls and (len(times) < 3 or time.perf_counter() - started < min_seconds):
+        call_started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - call_started)
+    return min(times)
+
+
+def main():
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    widget = MarcPaintWidget(window_size=(500, 500))
+    rng = np.random.default_rng(0)
+    color = np.array((1.0, 0.5, 0.0))
+    print("%-28s %10s %14s %14s %9s" % ("case", "arcs", "no cache (ms)", "cached (ms)", "speedup"))
+    for case in RANGE_CASES:
+        for num_arcs in ARC_COUNTS:
+            centers = rng.random((num_arcs, 2))
+            radii = rng.random(num_arcs) * 0.05
+            if case == "few distinct angle ranges":
+                angle_ranges = rng.integers(0, 8, (num_arcs, 2)) * (math.pi / 4)
+            elif case == "all distinct angle ranges":
+                angle_ranges = rng.random((num_arcs, 2)) * (2 * math.pi)
+            else:
+                angle_ranges = np.array((0, 2 * math.pi))
+
+            def run_without_templates():
+                fill_arcs_without_templates(widget, centers, radii, color, angle_ranges, NUM_SEGMENTS)
+                widget.clear()
+
+            def run_with_templates():
+                widget.fill_arcs(centers, radii, color, angle_ranges=angle_ranges, num_segments=NUM_SEGMENTS)
+                widget.clear()
+
+            expected = fill_arcs_without_templates(widget, centers, radii, color, angle_ranges, NUM_SEGMENTS).vertices
+            widget.clear()
+            got = widget.fill_arcs(centers, radii, color, angle_ranges=angle_ranges, num_segments=NUM_SEGMENTS).vertices
+            widget.clear()
+            assert np.allclose(expected, got, atol=1e-6)
+
+            time_without = time_calls(run_without_templates)
+            time_with = time_calls(run_with_templates)
+            print("%-28s %10d %14.3f %14.3f %8.1fx" % (case, num_arcs, time_without * 1e3, time_with * 1e3,
+                                                        time_without / time_with))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures what handing a scene's geometry over to GL allocates on every paint (immediate mode, i.e. without VBOs), for
+two scenes of about 1M vertices each: quads, which are drawn with glDrawElements, and arcs, which are drawn with
+glMultiDrawArrays. Compared are:
+
+    before: geometry kept as float64 (and int64 starting indices), as the builders used to make it, and handed to the
+            wrapped PyOpenGL functions, which convert every array to a float32 (or GLint) copy on every call
+    after:  geometry made float32 once, when the shape is created (as_gl_floats, as_gl_ints), and handed to the raw
+            functions as pointers (array_pointer), which copies nothing
+
+The allocations are traced with tracemalloc, which sees numpy's array buffers.
+
+    python benchmarks/bench_geometry_allocation.py
+
+(marqt has to be importable; no OpenGL context is needed, since nothing gets painted)
+"""
+import os
+import time
+import tracemalloc
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PyQt5 import QtWidgets
+from OpenGL.arrays import GLfloatArray, GLintArray
+from marqt.marc_paint import MarcPaintWidget
+from marqt.marc_paint_shapes import array_pointer
+
+NUM_FRAMES = 20
+
+
+def make_scenes(widget, rng):
+    # {scene name: shape}, about a million vertices each
+    num_quads = 250000
+    quads = widget.fill_quads(rng.random((4 * num_quads, 2)), rng.random((num_quads, 3)))
+    num_arcs = 10000
+    arcs = widget.fill_arcs(rng.random((num_arcs, 2)), rng.random(num_arcs) * 0.01, rng.random((num_arcs, 4)),
+                            num_segments=98)
+    return {"quads": quads, "arcs": arcs}
+
+
+def get_float_arrays(shape):
+    return [array for array in (shape.vertices, shape.colors, shape.tex_coords)
+            if array is not None and array.ndim == 2]
+
+
+def get_int_arrays(shape):
+    return [] if shape.starting_indices is None else [shape.starting_indices, shape.counts]
+
+
+def hand_over_before(float_arrays, int_arrays):
+    # what the wrapped glVertexPointer, glColorPointer, glTexCoordPointer and glMultiDrawArrays did with each array
+    converted = [GLfloatArray.asArray(array) for array in float_arrays]
+    converted += [GLintArray.asArray(array) for array in int_arrays]
+    return converted
+
+
+def hand_over_after(float_arrays, int_arrays):
+    return [array_pointer(array) for array in float_arrays + int_arrays]
+
+
+def measure_frames(hand_over, float_arrays, int_arrays):
+    # (bytes allocated per frame at the peak, seconds per frame), over NUM_FRAMES frames
+    tracemalloc.start()
+    peak = 0
+    started = time.perf_counter()
+    for _ in range(NUM_FRAMES):
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        hand_over(float_arrays, int_arrays)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    return peak, elapsed / NUM_FRAMES
+
+
+def main():
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    widget = MarcPaintWidget(window_size=(500, 500))
+    rng = np.random.default_rng(0)
+    print("%-8s %10s %14s %14s %16s %16s %12s %12s" % ("scene", "vertices", "kept before", "kept after",
+                                                        "per frame before", "per frame after", "before (ms)",
+                                                        "after (ms)"))
+    for scene_name, shape in make_scenes(widget, rng).items():
+        float_arrays, int_arrays = get_float_arrays(shape), get_int_arrays(shape)
+        assert all(array.dtype == np.float32 and array.flags.c_contiguous for array in float_arrays)
+        # the same geometry, the way it used to be kept
+        old_float_arrays = [array.astype(np.float64) for array in float_arrays]
+        old_int_arrays = [array.astype(np.int64) for array in int_arrays]
+        for old_array, array in zip(old_float_arrays + old_int_arrays, float_arrays + int_arrays):
+            assert np.array_equal(GLfloatArray.asArray(old_array) if array.dtype == np.float32
+                                  else GLintArray.asArray(old_array), array)
+
+        bytes_before, seconds_before = measure_frames(hand_over_before, old_float_arrays, old_int_arrays)
+        bytes_after, seconds_after = measure_frames(hand_over_after, float_arrays, int_arrays)
+        kept_before = sum(array.nbytes for array in old_float_arrays + old_int_arrays)
+        kept_after = sum(array.nbytes for array in float_arrays + int_arrays)
+        print("%-8s %10d %12.1fMB %12.1fMB %14.1fMB %14.1fMB %12.2f %12.2f" % (
+            scene_name, shape.vertices.shape[0], kept_before / 2 ** 20, kept_after / 2 ** 20,
+            bytes_before / 2 ** 20, bytes_after / 2 ** 20, seconds_before * 1e3, seconds_after * 1e3))
+        widget.clear()
+
+
+if __name__ == "__main__":
+    main()
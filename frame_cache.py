@@ -0,0 +1,65 @@
+from OpenGL.GL import *
+
+# A copy of the last fully painted frame, kept in an offscreen framebuffer. When the shapes haven't changed and only
+# the overlay (whatever do_extra_painting draws) needs redrawing, the frame is put back with a single blit instead of
+# painting every shape again.
+
+
+class FrameCache:
+
+    def __init__(self):
+        self.framebuffer = None
+        self.renderbuffer = None
+        self.size = None
+        self.samples = None
+        # false until something has been stored, and again after the stored frame is known to be out of date
+        self.is_valid = False
+
+    def _allocate(self, width, height, samples):
+        # the cache has to match the widget's framebuffer in size and number of samples, since multisampled buffers
+        # can only be blitted to and from buffers with the same number of samples
+        self.release()
+        self.renderbuffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.renderbuffer)
+        if samples > 0:
+            glRenderbufferStorageMultisample(GL_RENDERBUFFER, samples, GL_RGBA8, width, height)
+        else:
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        self.framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.renderbuffer)
+        self.size = (width, height)
+        self.samples = samples
+
+    def store(self, source_framebuffer, width, height):
+        # copies the color buffer of source_framebuffer (which must be the one currently bound) into the cache
+        samples = glGetIntegerv(GL_SAMPLES)
+        if self.size != (width, height) or self.samples != samples:
+            self._allocate(width, height, samples)
+        self._blit(source_framebuffer, self.framebuffer, width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, source_framebuffer)
+        self.is_valid = True
+
+    def restore(self, target_framebuffer):
+        width, height = self.size
+        self._blit(self.framebuffer, target_framebuffer, width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, target_framebuffer)
+
+    def matches(self, width, height):
+        return self.is_valid and self.size == (width, height)
+
+    @staticmethod
+    def _blit(read_framebuffer, draw_framebuffer, width, height):
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, read_framebuffer)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, draw_framebuffer)
+        glBlitFramebuffer(0, 0, width, height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+
+    def release(self):
+        # must be called with the GL context current
+        if self.framebuffer is not None:
+            glDeleteFramebuffers(1, [self.framebuffer])
+            glDeleteRenderbuffers(1, [self.renderbuffer])
+        self.framebuffer = self.renderbuffer = None
+        self.size = self.samples = None
+        self.is_valid = False
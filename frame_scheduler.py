@@ -0,0 +1,204 @@
+from PyQt5.QtCore import QTimer, Qt
+from marcpy.utilities import enum
+from collections import deque
+import math
+import time
+
+# How animation frames get scheduled (see MarcPaintWidget.start_animation):
+#   TIMER: a frame every interval seconds. Deadlines are kept on a fixed grid measured with perf_counter, so lateness
+#       doesn't accumulate into drift. animate gets the real time since the last frame.
+#   VSYNC: a frame per display refresh, the next one being started when the last one has been swapped onto the screen.
+#       animate gets the real time since the last frame.
+#   FIXED_TIMESTEP: also paced by the display, but animate is always called with dt equal to interval, as many times
+#       per displayed frame as the elapsed time calls for (zero or more). What's left over is available as
+#       get_interpolation_alpha(), i.e. how far we are between the last step and the next one, for smoothing motion.
+#   FREE_RUNNING: a new frame as soon as the last one is painted, uncapped (unless the driver waits for vsync on swap).
+FrameSchedulingModes = enum(TIMER="timer", VSYNC="vsync", FIXED_TIMESTEP="fixed timestep", FREE_RUNNING="free running")
+
+# What to do when frames take longer than they should:
+#   CATCH_UP: keep animation time in step with real time; fixed timestep mode runs the missed steps (and the variable
+#       dt modes pass on the whole elapsed time), up to max_steps_per_frame intervals' worth, beyond which (e.g. after
+#       the computer sleeps) the time is dropped.
+#   SLOW_DOWN: never advance more than one interval per frame, so that the animation slows down rather than jumps.
+FrameSkipPolicies = enum(CATCH_UP="catch up", SLOW_DOWN="slow down")
+
+# how many recent frames the frame time statistics are taken over
+FRAME_TIME_HISTORY_LENGTH = 240
+# until we've measured the display, assume it refreshes at this rate (used when a frame isn't swapped; see
+# _schedule_next_frame)
+DEFAULT_REFRESH_INTERVAL = 1 / 60
+
+
+class FrameScheduler:
+
+    def __init__(self, host_widget):
+        self.host_widget = host_widget
+        self.mode = FrameSchedulingModes.TIMER
+        self.frame_skip_policy = FrameSkipPolicies.CATCH_UP
+        self.interval = DEFAULT_REFRESH_INTERVAL
+        self.max_steps_per_frame = 5
+        self.running = False
+        # the animation clock: the sum of all the dts passed to animate, so it's monotonic and consistent with them
+        self.animation_time = 0.0
+        self.interpolation_alpha = 0.0
+
+        self._timer = QTimer(host_widget)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._tick)
+        self._connected_to_swaps = False
+        self._last_tick = None
+        self._next_deadline = None
+        self._accumulator = 0.0
+        self._refresh_interval = DEFAULT_REFRESH_INTERVAL
+
+        self._frame_times = deque(maxlen=FRAME_TIME_HISTORY_LENGTH)
+        self.frame_count = 0
+        self.late_frame_count = 0
+        self.step_count = 0
+        self.dropped_time = 0.0
+
+    # ------------------------------------ Starting and stopping -------------------------------------
+
+    def start(self, interval=None, mode=None, frame_skip_policy=None, max_steps_per_frame=None):
+        # arguments left as None keep their current values
+        self.stop()
+        if interval is not None:
+            self.interval = interval
+        if mode is not None:
+            self.mode = mode
+        if frame_skip_policy is not None:
+            self.frame_skip_policy = frame_skip_policy
+        if max_steps_per_frame is not None:
+            self.max_steps_per_frame = max_steps_per_frame
+        self.running = True
+        self._last_tick = None
+        self._accumulator = 0.0
+        self.interpolation_alpha = 0.0
+        if self.mode in (FrameSchedulingModes.VSYNC, FrameSchedulingModes.FIXED_TIMESTEP):
+            self.host_widget.frameSwapped.connect(self._on_frame_swapped)
+            self._connected_to_swaps = True
+        self._timer.start(0)
+
+    def stop(self):
+        self.running = False
+        self._timer.stop()
+        if self._connected_to_swaps:
+            self.host_widget.frameSwapped.disconnect(self._on_frame_swapped)
+            self._connected_to_swaps = False
+
+    # ------------------------------------------- Frames ---------------------------------------------
+
+    def _on_frame_swapped(self):
+        if not self.running:
+            return
+        now = time.perf_counter()
+        if self._last_tick is not None:
+            # as long as we keep the display busy, the time between swaps is its refresh interval
+            self._refresh_interval = 0.9 * self._refresh_interval + 0.1 * min(now - self._last_tick, 0.1)
+        self._tick()
+
+    def _tick(self):
+        if not self.running:
+            return
+        # whichever of the timer and the swap got here first, the other shouldn't start another frame
+        self._timer.stop()
+        now = time.perf_counter()
+        first_frame = self._last_tick is None
+        if first_frame:
+            # the first frame starts the clock
+            elapsed = 0.0
+            self._next_deadline = now
+        else:
+            elapsed = now - self._last_tick
+            self._frame_times.append(elapsed)
+        self._last_tick = now
+        self.frame_count += 1
+
+        if self.mode is FrameSchedulingModes.FIXED_TIMESTEP:
+            self._run_fixed_steps(elapsed, first_frame)
+        else:
+            self._run_variable_step(elapsed)
+
+        repainted = self.host_widget._present_animation_frame(
+            synchronous=self.mode in (FrameSchedulingModes.TIMER, FrameSchedulingModes.FREE_RUNNING))
+        if not self.running:
+            # animate or an animation layer stopped the animation
+            return
+        self._schedule_next_frame(repainted)
+
+    def _run_variable_step(self, elapsed):
+        if self.frame_skip_policy is FrameSkipPolicies.SLOW_DOWN:
+            dt = min(elapsed, self.interval)
+        else:
+            dt = min(elapsed, self.interval * self.max_steps_per_frame)
+        self.dropped_time += elapsed - dt
+        self._advance(dt)
+
+    def _run_fixed_steps(self, elapsed, first_frame):
+        self._accumulator += elapsed
+        max_steps = 1 if self.frame_skip_policy is FrameSkipPolicies.SLOW_DOWN else self.max_steps_per_frame
+        steps = min(int(self._accumulator / self.interval), max_steps)
+        if first_frame:
+            # the first frame shows the animation's starting state, as with the other modes
+            self._advance(0.0)
+        for _ in range(steps):
+            self._advance(self.interval)
+        self._accumulator -= steps * self.interval
+        if self._accumulator >= self.interval:
+            # too far behind to catch up; whole steps get dropped, keeping the fraction for the alpha
+            dropped_steps = int(self._accumulator / self.interval)
+            self.dropped_time += dropped_steps * self.interval
+            self._accumulator -= dropped_steps * self.interval
+        self.interpolation_alpha = self._accumulator / self.interval
+
+    def _advance(self, dt):
+        self.animation_time += dt
+        self.step_count += 1
+        self.host_widget._advance_animation(dt, self.animation_time)
+
+    def _schedule_next_frame(self, repainted):
+        now = time.perf_counter()
+        if self.mode is FrameSchedulingModes.TIMER:
+            self._next_deadline += self.interval
+            if now > self._next_deadline:
+                # missed at least one deadline; rather than firing a burst of frames, we skip to the next one on the
+                # grid
+                self.late_frame_count += 1
+                self._next_deadline += math.ceil((now - self._next_deadline) / self.interval) * self.interval
+            self._timer.start(max(0, int(round((self._next_deadline - now) * 1000))))
+        elif self.mode is FrameSchedulingModes.FREE_RUNNING:
+            self._timer.start(0)
+        elif not repainted:
+            # Nothing changed, so there won't be a swap to start the next frame. We check back after about a refresh.
+            self._timer.start(max(1, int(round(self._refresh_interval * 1000))))
+        # otherwise, _on_frame_swapped starts the next frame
+
+    # ----------------------------------------- Statistics -------------------------------------------
+
+    def get_stats(self):
+        """
+        Frame time statistics, in seconds, over the last FRAME_TIME_HISTORY_LENGTH frames, along with totals since the
+        scheduler was made: frames, animate steps, late frames (timer mode deadlines missed) and animation time dropped
+        by the frame skip policy.
+        """
+        frame_times = sorted(self._frame_times)
+        stats = {
+            "frame_count": self.frame_count,
+            "step_count": self.step_count,
+            "late_frame_count": self.late_frame_count,
+            "dropped_time": self.dropped_time,
+            "animation_time": self.animation_time,
+        }
+        if len(frame_times) > 0:
+            mean_frame_time = sum(frame_times) / len(frame_times)
+            stats.update({
+                "mean_frame_time": mean_frame_time,
+                "min_frame_time": frame_times[0],
+                "max_frame_time": frame_times[-1],
+                "95th_percentile_frame_time": frame_times[min(len(frame_times) - 1, int(0.95 * len(frame_times)))],
+                "frame_time_deviation": math.sqrt(sum((frame_time - mean_frame_time) ** 2
+                                                      for frame_time in frame_times) / len(frame_times)),
+                "frames_per_second": 1 / mean_frame_time if mean_frame_time > 0 else float("inf"),
+            })
+        return stats
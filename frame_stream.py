@@ -0,0 +1,191 @@
+from PyQt5.QtGui import QImageReader
+import threading
+import weakref
+
+# Streaming playback of big animated images. Rather than decoding every frame up front, a FrameStream decodes the first
+# frame right away and the rest on a background thread, keeping a window of decoded frames that starts at the frame
+# last asked for (the playhead) and reaches as far ahead as the memory budget allows. Frames behind the playhead are
+# thrown away as it moves on. Animated image decoding only goes forwards, so when the playhead loops back to the start
+# (or jumps back out of the window) the decoder starts over from the first frame.
+#
+# Painting never waits for the decoder: a frame that isn't decoded yet is stood in for by the frame handed out last, and
+# arrived_frames goes up once it comes in, so that whatever painted the stand-in knows to paint again.
+#
+# The window follows whichever frame was asked for last, so streaming suits images that play in one place (or in
+# sync); handlers far apart in the same streamed animation will keep sending the decoder back and forth.
+
+
+def read_frames(image_reader, frames_already_read=0):
+    """
+    Yields (image, delay in milliseconds) for each remaining frame of an animated image. We count frames against
+    imageCount() ourselves, since currentImageNumber() starts at -1 for some image formats and at 0 for others.
+    """
+    frame_count = image_reader.imageCount()
+    frame_number = frames_already_read
+    while frame_number < frame_count or frame_count <= 0 and image_reader.canRead():
+        image = image_reader.read()
+        if image.isNull():
+            return
+        yield image, image_reader.nextImageDelay()
+        frame_number += 1
+
+
+def scan_gif_frame_delays(file_path):
+    # the delay of each frame of a GIF in milliseconds, read from the file structure without decoding any pixels, or
+    # None if it isn't a GIF we can make sense of
+    try:
+        with open(file_path, "rb") as gif_file:
+            data = gif_file.read()
+        if data[:6] not in (b"GIF87a", b"GIF89a"):
+            return None
+        position = 13
+        if data[10] & 0x80:
+            # global color table
+            position += 3 * 2 ** ((data[10] & 0x07) + 1)
+        delays = []
+        pending_delay = 0
+        while data[position] != 0x3B:
+            if data[position] == 0x21:
+                # an extension; the graphic control extension has the delay of the next frame, in hundredths
+                if data[position + 1] == 0xF9:
+                    pending_delay = 10 * (data[position + 4] | data[position + 5] << 8)
+                position += 2
+            elif data[position] == 0x2C:
+                # an image descriptor, maybe followed by a local color table, then the LZW code size
+                packed_fields = data[position + 9]
+                position += 10
+                if packed_fields & 0x80:
+                    position += 3 * 2 ** ((packed_fields & 0x07) + 1)
+                position += 1
+                delays.append(pending_delay)
+                pending_delay = 0
+            else:
+                return None
+            # skip the data sub-blocks, up to the zero length terminator
+            while data[position] != 0:
+                position += data[position] + 1
+            position += 1
+        return delays if len(delays) > 0 else None
+    except (IndexError, OSError):
+        return None
+
+
+class FrameStream:
+
+    def __init__(self, file_path, memory_budget):
+        """
+        :param file_path: an animated image
+        :param memory_budget: roughly how many bytes of decoded frames to keep (at least two frames are kept)
+        """
+        self.file_path = file_path
+        image_reader = QImageReader(file_path)
+        self.loop_count = image_reader.loopCount()
+        first_frame = image_reader.read()
+        if first_frame.isNull():
+            raise IOError("Could not read " + file_path)
+        self.delays = scan_gif_frame_delays(file_path)
+        if self.delays is None:
+            # we can't get at the timing without decoding, so we go through the frames once just for the delays
+            self.delays = [image_reader.nextImageDelay()] + [delay for _, delay in read_frames(image_reader, 1)]
+            image_reader = None
+        self.num_frames = len(self.delays)
+        self.frame_size = first_frame.size()
+        self.capacity = max(2, min(self.num_frames, memory_budget // max(1, first_frame.byteCount())))
+
+        self._condition = threading.Condition()
+        self._frames = {0: first_frame}
+        self._playhead = 0
+        self._closed = False
+        # the frame get_frame handed out last, which stands in for frames that aren't decoded yet
+        self._shown_frame = first_frame
+        # the frame that was asked for before it was decoded, if any, and how many such frames have since come in
+        self._awaited_frame = None
+        self.arrived_frames = 0
+        # only touched by the decoding thread (after this)
+        self._image_reader = image_reader
+        self._next_frame_to_read = 0 if image_reader is None else 1
+        self._last_read_frame = first_frame
+        threading.Thread(target=_decode_in_background, args=(weakref.ref(self), ), daemon=True).start()
+
+    def get_frame(self, frame_number):
+        # the decoded frame, or if the decoder hasn't got there yet (or the stream is closed), the frame handed out last
+        frame = self.try_get_frame(frame_number)
+        return self._shown_frame if frame is None else frame
+
+    def try_get_frame(self, frame_number):
+        # the decoded frame, or None if the decoder hasn't got there yet; either way, moves the window to start at it
+        with self._condition:
+            if self._closed:
+                return None
+            if frame_number != self._playhead:
+                self._playhead = frame_number
+                self._evict_frames_outside_window()
+                self._condition.notify_all()
+            frame = self._frames.get(frame_number)
+            if frame is None:
+                self._awaited_frame = frame_number
+                return None
+            self._shown_frame = frame
+            return frame
+
+    def is_in_window(self, frame_number):
+        return (frame_number - self._playhead) % self.num_frames < self.capacity
+
+    def get_decoded_frame_count(self):
+        return len(self._frames)
+
+    def close(self):
+        # stops the decoding thread
+        with self._condition:
+            self._closed = True
+            self._frames = {}
+            self._condition.notify_all()
+
+    def _evict_frames_outside_window(self):
+        for frame_number in [frame_number for frame_number in self._frames if not self.is_in_window(frame_number)]:
+            del self._frames[frame_number]
+
+    def _get_next_missing_frame(self):
+        for offset in range(self.capacity):
+            frame_number = (self._playhead + offset) % self.num_frames
+            if frame_number not in self._frames:
+                return frame_number
+        return None
+
+    def _decode_next_frame(self):
+        # Decodes one frame towards the first one missing from the window. Returns False once the stream is closed.
+        with self._condition:
+            target_frame = self._get_next_missing_frame()
+            if target_frame is None and not self._closed:
+                # nothing to do; the timeout lets the thread notice if the stream gets garbage collected
+                self._condition.wait(1.0)
+                return not self._closed
+            if self._closed:
+                return False
+        if self._image_reader is None or self._next_frame_to_read > target_frame or \
+                self._next_frame_to_read >= self.num_frames:
+            self._image_reader = QImageReader(self.file_path)
+            self._next_frame_to_read = 0
+        image = self._image_reader.read()
+        if image.isNull():
+            # a truncated file; the frames we can't read just repeat the last one we could
+            image = self._last_read_frame
+        self._last_read_frame = image
+        with self._condition:
+            if self.is_in_window(self._next_frame_to_read):
+                self._frames[self._next_frame_to_read] = image
+                if self._next_frame_to_read == self._awaited_frame:
+                    self._awaited_frame = None
+                    self.arrived_frames += 1
+            self._next_frame_to_read += 1
+            self._condition.notify_all()
+        return True
+
+
+def _decode_in_background(stream_reference):
+    # only holds on to the stream while decoding a frame, so that an unused stream can be garbage collected
+    while True:
+        stream = stream_reference()
+        if stream is None or not stream._decode_next_frame():
+            return
+        del stream
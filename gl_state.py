@@ -0,0 +1,207 @@
+from OpenGL.GL import *
+from collections import Counter
+
+# The GLStateCache keeps track of the fixed-function state that the shapes care about (client arrays, enabled
+# capabilities, bound texture, line width, texture environment, blend function and current color), so that each shape
+# only issues the state changes it actually needs. It also tracks the current shader program and the enabled generic
+# vertex attribute arrays, for the shapes that draw with shaders (all of them, in core profile mode). It also counts
+# the GL calls made through it (and those reported to it by the shapes), so that the number of calls per frame can be
+# checked.
+
+# sentinel for "we don't know what this is set to", e.g. after a QPainter has messed with the GL state
+_UNKNOWN = object()
+
+_CLIENT_STATES = (GL_VERTEX_ARRAY, GL_COLOR_ARRAY, GL_TEXTURE_COORD_ARRAY)
+
+
+class GLStateCache:
+
+    def __init__(self, core_profile=False):
+        self.core_profile = core_profile
+        self.call_counts = Counter()
+        self.last_frame_call_counts = Counter()
+        self._client_states = {}
+        self._capabilities = {}
+        self._bound_texture = _UNKNOWN
+        self._bound_array_buffer = _UNKNOWN
+        self._bound_element_array_buffer = _UNKNOWN
+        self._line_width = _UNKNOWN
+        self._tex_env_mode = _UNKNOWN
+        self._blend_func = _UNKNOWN
+        self._color = _UNKNOWN
+        self._program = _UNKNOWN
+        self._vertex_attrib_arrays = {}
+        self._needs_flush = False
+
+    def invalidate(self):
+        # forget everything we know, since something outside of our control may have changed the GL state
+        self._client_states = {}
+        self._capabilities = {}
+        self._bound_texture = _UNKNOWN
+        self._bound_array_buffer = _UNKNOWN
+        self._bound_element_array_buffer = _UNKNOWN
+        self._line_width = _UNKNOWN
+        self._tex_env_mode = _UNKNOWN
+        self._blend_func = _UNKNOWN
+        self._color = _UNKNOWN
+        self._program = _UNKNOWN
+        # we still remember which attribute locations we've used, so that restore_defaults can turn them off
+        self._vertex_attrib_arrays = dict.fromkeys(self._vertex_attrib_arrays, _UNKNOWN)
+
+    # ------------------------------------ Frames -------------------------------------
+
+    def begin_frame(self):
+        # Qt may touch the GL state between frames, so we start every frame knowing nothing
+        self.call_counts = Counter()
+        self._needs_flush = False
+        self.invalidate()
+
+    def end_frame(self):
+        self.restore_defaults()
+        if self._needs_flush:
+            self.record_call("glFlush")
+            glFlush()
+            self._needs_flush = False
+        self.last_frame_call_counts = self.call_counts
+
+    def restore_defaults(self):
+        # puts back the state that other code (QPainter, Qt's compositing) expects to find
+        for location in list(self._vertex_attrib_arrays.keys()):
+            self.set_vertex_attrib_array(location, False)
+        self.use_program(None)
+        if not self.core_profile:
+            # client arrays and GL_TEXTURE_2D don't exist in a core profile context
+            for client_state in _CLIENT_STATES:
+                self.set_client_state(client_state, False)
+            self.set_capability(GL_TEXTURE_2D, False)
+        self.bind_array_buffer(0)
+        self.bind_element_array_buffer(0)
+
+    # ------------------------------------ Counting ------------------------------------
+
+    def record_call(self, gl_function_name, number=1):
+        # shapes report draw calls and pointer calls here, so that the counts include them
+        self.call_counts[gl_function_name] += number
+        if gl_function_name.startswith("glDraw") or gl_function_name.startswith("glMultiDraw"):
+            self._needs_flush = True
+
+    def get_last_frame_call_count(self):
+        return sum(self.last_frame_call_counts.values())
+
+    # ------------------------------------ State -------------------------------------
+
+    def set_client_state(self, client_state, enabled):
+        enabled = bool(enabled)
+        if self._client_states.get(client_state, _UNKNOWN) is enabled:
+            return
+        if enabled:
+            self.record_call("glEnableClientState")
+            glEnableClientState(client_state)
+        else:
+            self.record_call("glDisableClientState")
+            glDisableClientState(client_state)
+        self._client_states[client_state] = enabled
+        if client_state == GL_COLOR_ARRAY:
+            # the current color is undefined after drawing with a color array
+            self._color = _UNKNOWN
+
+    def set_client_states(self, vertex_array=True, color_array=False, tex_coord_array=False):
+        self.set_client_state(GL_VERTEX_ARRAY, vertex_array)
+        self.set_client_state(GL_COLOR_ARRAY, color_array)
+        self.set_client_state(GL_TEXTURE_COORD_ARRAY, tex_coord_array)
+
+    def set_capability(self, capability, enabled):
+        enabled = bool(enabled)
+        if self._capabilities.get(capability, _UNKNOWN) is enabled:
+            return
+        if enabled:
+            self.record_call("glEnable")
+            glEnable(capability)
+        else:
+            self.record_call("glDisable")
+            glDisable(capability)
+        self._capabilities[capability] = enabled
+
+    def bind_texture(self, texture):
+        # texture is a QOpenGLTexture
+        if self._bound_texture is texture:
+            return
+        self.record_call("glBindTexture")
+        texture.bind()
+        self._bound_texture = texture
+
+    def bind_array_buffer(self, buffer_id):
+        if self._bound_array_buffer == buffer_id:
+            return
+        self.record_call("glBindBuffer")
+        glBindBuffer(GL_ARRAY_BUFFER, buffer_id)
+        self._bound_array_buffer = buffer_id
+
+    def bind_element_array_buffer(self, buffer_id):
+        # the index buffer for glDrawElements; 0 means the indices are passed from client memory
+        if self._bound_element_array_buffer == buffer_id:
+            return
+        self.record_call("glBindBuffer")
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, buffer_id)
+        self._bound_element_array_buffer = buffer_id
+
+    def set_line_width(self, line_width):
+        if self._line_width == line_width:
+            return
+        self.record_call("glLineWidth")
+        glLineWidth(line_width)
+        self._line_width = line_width
+
+    def set_tex_env_mode(self, mode):
+        if self._tex_env_mode == mode:
+            return
+        self.record_call("glTexEnvi")
+        glTexEnvi(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, mode)
+        self._tex_env_mode = mode
+
+    def set_blend_func(self, source_factor, destination_factor):
+        if self._blend_func == (source_factor, destination_factor):
+            return
+        self.record_call("glBlendFunc")
+        glBlendFunc(source_factor, destination_factor)
+        self._blend_func = (source_factor, destination_factor)
+
+    def set_color(self, color):
+        color = tuple(color)
+        if self._color == color:
+            return
+        if len(color) == 4:
+            self.record_call("glColor4f")
+            glColor4f(*color)
+        else:
+            self.record_call("glColor3f")
+            glColor3f(*color)
+        self._color = color
+
+    def use_program(self, program):
+        # program is a ShaderProgram, or None for the fixed-function pipeline
+        if self._program is program:
+            return
+        self.record_call("glUseProgram")
+        glUseProgram(0 if program is None else program.program_id)
+        self._program = program
+
+    def set_vertex_attrib_array(self, location, enabled):
+        enabled = bool(enabled)
+        if self._vertex_attrib_arrays.get(location, _UNKNOWN) is enabled:
+            return
+        if enabled:
+            self.record_call("glEnableVertexAttribArray")
+            glEnableVertexAttribArray(location)
+        else:
+            self.record_call("glDisableVertexAttribArray")
+            glDisableVertexAttribArray(location)
+        self._vertex_attrib_arrays[location] = enabled
+
+    def set_vertex_attrib_arrays(self, enabled_locations):
+        # enables exactly the given generic attribute locations, disabling any others we know to be enabled
+        for location in list(self._vertex_attrib_arrays.keys()):
+            if location not in enabled_locations:
+                self.set_vertex_attrib_array(location, False)
+        for location in enabled_locations:
+            self.set_vertex_attrib_array(location, True)
@@ -0,0 +1,178 @@
+import math
+import numpy as np
+from PyQt5.QtGui import QImage, QPainter, QColor, QFontMetricsF, QOpenGLTexture
+from PyQt5.QtCore import QPointF, QRectF
+from .image_processing import MarcPyImageHandler
+from .marc_paint_shapes import get_goal_window_text_size, make_font, get_text_anchoring_adjustments
+
+# An alternative to the QPainter text path in TextShape: glyphs are rasterized once per (font, styles, pixel size)
+# into a texture atlas, and every string just becomes a bunch of textured quads. Since those quads are ordinary
+# Triangles sharing an atlas texture, lots of labels in the same font and color batch into a single draw call.
+# Glyphs are laid out using their horizontal advances, so kerning is ignored.
+
+# the raster sizes we use are rounded to these steps, so that slightly different text sizes share an atlas
+_PIXEL_SIZE_STEP = 4
+_MIN_PIXEL_SIZE = 8
+_MAX_PIXEL_SIZE = 128
+# spacing around each glyph in the atlas, so that linear filtering doesn't bleed in the neighbors
+_GLYPH_PADDING = 2
+
+
+class GlyphAtlasPage(MarcPyImageHandler):
+
+    def __init__(self, font, page_size=1024):
+        self.font = font
+        # non-premultiplied, so that modulating the white glyphs by a color gives exactly that color
+        self.image = QImage(page_size, page_size, QImage.Format_ARGB32)
+        self.image.fill(QColor(255, 255, 255, 0))
+        self.font_metrics = QFontMetricsF(self.font, self.image)
+        # char -> (pixel rect of the glyph in the atlas image, bounding rect relative to the pen position, advance)
+        self.glyphs = {}
+        self._cursor_x = self._cursor_y = _GLYPH_PADDING
+        self._row_height = 0
+        self.open_gl_texture = None
+        self._texture_is_stale = True
+
+    def _get_glyph_size(self, char):
+        bounding_rect = self.font_metrics.boundingRect(char)
+        return math.ceil(bounding_rect.width()) + 1, math.ceil(bounding_rect.height()) + 1
+
+    def has_room_for(self, chars):
+        # simulates the shelf packing, without actually drawing anything
+        x, y, row_height = self._cursor_x, self._cursor_y, self._row_height
+        for char in chars:
+            width, height = self._get_glyph_size(char)
+            if x + width + _GLYPH_PADDING > self.image.width():
+                x, y, row_height = _GLYPH_PADDING, y + row_height + _GLYPH_PADDING, 0
+            if y + height + _GLYPH_PADDING > self.image.height():
+                return False
+            x += width + _GLYPH_PADDING
+            row_height = max(row_height, height)
+        return True
+
+    def add_glyphs(self, chars):
+        painter = QPainter(self.image)
+        painter.setFont(self.font)
+        painter.setPen(QColor(255, 255, 255, 255))
+        painter.setRenderHint(QPainter.TextAntialiasing)
+        for char in chars:
+            width, height = self._get_glyph_size(char)
+            if self._cursor_x + width + _GLYPH_PADDING > self.image.width():
+                self._cursor_x = _GLYPH_PADDING
+                self._cursor_y += self._row_height + _GLYPH_PADDING
+                self._row_height = 0
+            bounding_rect = self.font_metrics.boundingRect(char)
+            # draw it so that the top left of its bounding rect lands on the cursor
+            painter.drawText(QPointF(self._cursor_x - bounding_rect.left(), self._cursor_y - bounding_rect.top()), char)
+            self.glyphs[char] = ((self._cursor_x, self._cursor_y, width, height), bounding_rect,
+                                 self.font_metrics.width(char))
+            self._cursor_x += width + _GLYPH_PADDING
+            self._row_height = max(self._row_height, height)
+        painter.end()
+        self._texture_is_stale = True
+
+    def get_current_image(self):
+        return self.image
+
+    def get_current_opengl_texture(self):
+        # called during painting, so the GL context is current; re-upload if glyphs were added since last time
+        if self._texture_is_stale:
+            if self.open_gl_texture is not None:
+                self.open_gl_texture.destroy()
+            self.open_gl_texture = QOpenGLTexture(self.image.mirrored())
+            self.open_gl_texture.setMinificationFilter(QOpenGLTexture.Linear)
+            self.open_gl_texture.setMagnificationFilter(QOpenGLTexture.Linear)
+            self._texture_is_stale = False
+        return self.open_gl_texture
+
+
+class GlyphAtlasCache:
+    """
+    Keeps one list of atlas pages per (font name, styles, pixel size). A string always gets all of its glyphs from a
+    single page, so that it can be drawn with a single texture.
+    """
+
+    def __init__(self, page_size=1024):
+        self.page_size = page_size
+        self.pages = {}
+
+    @staticmethod
+    def get_raster_pixel_size(goal_window_font_height):
+        pixel_size = int(math.ceil(goal_window_font_height / _PIXEL_SIZE_STEP)) * _PIXEL_SIZE_STEP
+        return min(max(pixel_size, _MIN_PIXEL_SIZE), _MAX_PIXEL_SIZE)
+
+    def get_page(self, text, font_name, styles, pixel_size):
+        key = (font_name, styles, pixel_size)
+        if key not in self.pages:
+            self.pages[key] = []
+        pages = self.pages[key]
+        for page in pages:
+            if all(char in page.glyphs for char in text):
+                return page
+        # unique new characters, in order of appearance
+        if len(pages) > 0:
+            missing = "".join(dict.fromkeys(char for char in text if char not in pages[-1].glyphs))
+            if pages[-1].has_room_for(missing):
+                pages[-1].add_glyphs(missing)
+                return pages[-1]
+        font = make_font(font_name, styles, 12)
+        font.setPixelSize(pixel_size)
+        new_page = GlyphAtlasPage(font, self.page_size)
+        new_page.add_glyphs("".join(dict.fromkeys(text)))
+        pages.append(new_page)
+        return new_page
+
+    def layout_text(self, text, font_name, styles, size, window_units_per_view_unit, anchor_type,
+                    include_descent_in_height):
+        """
+        Lays out a string as textured quads, sized and anchored the same way as a TextShape.
+
+        :return: tuple of (atlas page, vertices, tex_coords), where the vertices are six per glyph (two triangles),
+        in window coordinates relative to the draw location. Returns None if there's nothing visible to draw.
+        """
+        goal_window_font_height, goal_window_font_width = get_goal_window_text_size(size, window_units_per_view_unit)
+        page = self.get_page(text, font_name, styles, self.get_raster_pixel_size(goal_window_font_height))
+
+        # fit the text to the desired height or bounding box at the raster size, and then scale
+        bounding_rect = page.font_metrics.tightBoundingRect(text)
+        effective_height = bounding_rect.height() if include_descent_in_height \
+            else bounding_rect.height() - bounding_rect.bottom()
+        if bounding_rect.width() <= 0 or effective_height <= 0:
+            return None
+        scale = 1 / max(bounding_rect.width() / goal_window_font_width, effective_height / goal_window_font_height)
+        scaled_rect = QRectF(bounding_rect.left() * scale, bounding_rect.top() * scale,
+                             bounding_rect.width() * scale, bounding_rect.height() * scale)
+        x_adjustment, y_adjustment = get_text_anchoring_adjustments(
+            scaled_rect, goal_window_font_width, goal_window_font_height, isinstance(size, tuple), anchor_type,
+            include_descent_in_height
+        )
+
+        corners = []
+        atlas_corners = []
+        pen_x = 0
+        for char in text:
+            (atlas_x, atlas_y, width, height), glyph_rect, advance = page.glyphs[char]
+            if glyph_rect.width() > 0 and glyph_rect.height() > 0:
+                # left, top, right, bottom relative to the pen, y going down like the window
+                corners.append((pen_x + glyph_rect.left(), glyph_rect.top(),
+                                pen_x + glyph_rect.left() + width, glyph_rect.top() + height))
+                atlas_corners.append((atlas_x, atlas_y, atlas_x + width, atlas_y + height))
+            pen_x += advance
+        if len(corners) == 0:
+            return None
+
+        corners = np.array(corners) * scale + (x_adjustment, y_adjustment, x_adjustment, y_adjustment)
+        # the atlas texture is mirrored vertically when uploaded, so v runs from the bottom of the image
+        atlas_corners = np.array(atlas_corners, dtype=float) / page.image.width()
+        atlas_corners[:, 1::2] = 1 - atlas_corners[:, 1::2] * page.image.width() / page.image.height()
+
+        return page, _quads_to_triangles(corners), _quads_to_triangles(atlas_corners)
+
+
+def _quads_to_triangles(corners):
+    # corners is an N x 4 array of (left, top, right, bottom); returns the 6N x 2 array of triangle vertices
+    left, top, right, bottom = corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+    return np.stack([
+        np.column_stack((left, top)), np.column_stack((left, bottom)), np.column_stack((right, bottom)),
+        np.column_stack((left, top)), np.column_stack((right, bottom)), np.column_stack((right, top)),
+    ], axis=1).reshape(-1, 2)
@@ -1,12 +1,60 @@
 from abc import ABC, abstractmethod
-from PyQt5.QtGui import QImage, QImageReader, QOpenGLTexture
-import threading
+from PyQt5.QtGui import QImage, QImageReader, QOpenGLTexture, QPainter
+from PyQt5.QtCore import Qt
+from OpenGL.GL import glGetIntegerv, GL_MAX_TEXTURE_SIZE
+from .frame_stream import FrameStream, read_frames
+from bisect import bisect_right
+from itertools import accumulate
 import time
 # The MarcPyImage class takes a path to an image and reads it into one or several QImages (in the case of
 # an animated image). It also creates a QOpenGLTexture for each QImage.
 # For an animated image, animation can take place on the MarcPyImage itself (which would animate each image
 # simultaneously) or a MarcpyAnimatedImageHandler can be fashioned from a MarcPyImage so as to control
 # individual instances of an animated image.
+# Animations don't run on threads of their own. Instead, each one remembers when it was started on a FrameClock, and
+# works out which frame it's on from the time on that clock whenever it's asked. A MarcPaintWidget moves its clock
+# along with its animation frames, so all of its animated images advance together, once per frame.
+
+# GIFs often give a delay of 0 (or close to it), which browsers show at this many milliseconds per frame
+DEFAULT_FRAME_DELAY = 100
+MIN_FRAME_DELAY = 11
+
+
+class FrameClock:
+    """
+    The time (in seconds) that animated images go by. It only moves when set, so everything looking at it in between
+    sees the same time. A MarcPaintWidget sets the time on its clock every animation frame.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+
+    def set_time(self, time_value):
+        self.time = time_value
+
+
+class RealTimeFrameClock(FrameClock):
+    # for images that don't belong to a widget: just the time right now
+
+    @property
+    def time(self):
+        return time.perf_counter()
+
+    @time.setter
+    def time(self, time_value):
+        pass
+
+
+real_time_frame_clock = RealTimeFrameClock()
+
+# Animated images keep all their frames in one texture (a grid of frames), so that showing a different frame is just a
+# matter of texture coordinates: no rebinding, and sprites on different frames of the same image can be drawn
+# together. Atlases are limited to this size on a side (or the GL limit, if lower); bigger animations fall back to a
+# texture per frame.
+MAX_ATLAS_SIZE = 8192
+
+# animated images whose decoded frames would take more memory than this are streamed by default (see MarcPyImage)
+DEFAULT_STREAMING_MEMORY_BUDGET = 64 * 2 ** 20
 
 
 class MarcPyImageHandler(ABC):
@@ -19,63 +67,227 @@ class MarcPyImageHandler(ABC):
     def get_current_opengl_texture(self):
         pass
 
+    def get_texture_transform(self):
+        # (u offset, v offset, u scale, v scale) taking 0-1 texture coordinates into the part of the opengl texture
+        # showing the current image, or None if that's the whole texture
+        return None
+
+    def get_painted_state(self):
+        # what a painting of the current image depends on; a change means it needs painting again
+        return None
+
+    def get_texture_key(self):
+        # handlers with the same key always have the same opengl texture bound, so their shapes can be drawn together
+        return self
+
+
+class AnimatedImageAtlas:
+    """
+    All the frames of an animated image, laid out in a grid in a single QOpenGLTexture. Use make_atlas, which returns
+    None if the frames don't fit.
+    """
+
+    def __init__(self, frames, columns, rows):
+        frame_width, frame_height = frames[0].width(), frames[0].height()
+        atlas_width, atlas_height = columns * frame_width, rows * frame_height
+        atlas_image = QImage(atlas_width, atlas_height, QImage.Format_ARGB32)
+        atlas_image.fill(Qt.transparent)
+        painter = QPainter(atlas_image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        self.frame_transforms = []
+        for i, frame in enumerate(frames):
+            x, y = (i % columns) * frame_width, (i // columns) * frame_height
+            painter.drawImage(x, y, frame)
+            # The atlas gets mirrored, like single images, so that v goes up from the bottom. We also inset by half a
+            # texel, so that linear filtering never picks up the neighboring frame.
+            bottom = atlas_height - y - frame_height
+            self.frame_transforms.append(((x + 0.5) / atlas_width, (bottom + 0.5) / atlas_height,
+                                          (frame_width - 1) / atlas_width, (frame_height - 1) / atlas_height))
+        painter.end()
+        # no mipmaps, since the smaller levels would blend neighboring frames together
+        self.texture = QOpenGLTexture(atlas_image.mirrored(), QOpenGLTexture.DontGenerateMipMaps)
+        self.texture.setMinMagFilters(QOpenGLTexture.Linear, QOpenGLTexture.Linear)
+        self.texture.setWrapMode(QOpenGLTexture.ClampToEdge)
+
+    @staticmethod
+    def make_atlas(frames):
+        # must be called with a current GL context; returns None if the frames won't fit into one texture
+        if len(frames) == 0 or any(frame.size() != frames[0].size() for frame in frames):
+            return None
+        max_size = min(MAX_ATLAS_SIZE, glGetIntegerv(GL_MAX_TEXTURE_SIZE))
+        frame_width, frame_height = frames[0].width(), frames[0].height()
+        if frame_width < 2 or frame_height < 2 or frame_width > max_size or frame_height > max_size:
+            return None
+        # as square as possible, but no wider than the maximum
+        columns = min(len(frames), max_size // frame_width,
+                      max(1, int(round((len(frames) * frame_height / frame_width) ** 0.5))))
+        rows = -(-len(frames) // columns)
+        if rows * frame_height > max_size:
+            return None
+        return AnimatedImageAtlas(frames, columns, rows)
+
+
+class _ClockedAnimation:
+    # The playback state of an animated image: the frame is worked out from the time on the clock since the animation
+    # was started, by bisecting the frame end times (the running totals of the delays).
+
+    def _init_playback(self, clock, frame_end_times, loop_count):
+        self.clock = clock
+        # in milliseconds; frame i shows from frame_end_times[i - 1] until frame_end_times[i]
+        self._frame_end_times = frame_end_times
+        # -1 means loop infinitely, 0 means no loop, > 0 is finite # of loops
+        self.loop_count = loop_count
+        self.animating = False
+        self._start_time = None
+        # the frame to show while not animating
+        self._stopped_frame = 0
+
+    def start_animation(self):
+        # picks up from the frame we're on
+        frame = self.current_frame
+        self._start_time = self.clock.time - (self._frame_end_times[frame - 1] if frame > 0 else 0) / 1000.
+        self.animating = True
+
+    def stop_animation(self):
+        self._stopped_frame = self.current_frame
+        self.animating = False
+
+    def reset_animation(self):
+        self._stopped_frame = 0
+        self._start_time = self.clock.time
+
+    @property
+    def current_frame(self):
+        if not self.animating:
+            return self._stopped_frame
+        elapsed = (self.clock.time - self._start_time) * 1000.
+        loop_duration = self._frame_end_times[-1]
+        loops_done, position = divmod(max(0., elapsed), loop_duration)
+        if 0 <= self.loop_count < loops_done:
+            # played through the last loop, so we sit on the last frame
+            return len(self._frame_end_times) - 1
+        return min(bisect_right(self._frame_end_times, position), len(self._frame_end_times) - 1)
+
+    @current_frame.setter
+    def current_frame(self, frame):
+        # jumps to the given frame, carrying on animating from there if we were
+        self._stopped_frame = frame
+        if self.animating:
+            self.animating = False
+            self.start_animation()
+
 
-class MarcPyImage(MarcPyImageHandler):
+class MarcPyImage(_ClockedAnimation, MarcPyImageHandler):
 
-    def __init__(self, file_path, make_opengl_textures=True):
+    def __init__(self, file_path, make_opengl_textures=True, clock=None, streaming=None,
+                 memory_budget=DEFAULT_STREAMING_MEMORY_BUDGET):
+        """
+        :param clock: the FrameClock that animation goes by; by default, the real time
+        :param streaming: for animated images: if True, frames are decoded while playing rather than all up front (see
+            frame_stream.py), and textures are made only for the frames around the playhead. If None, streaming is
+            used when the decoded frames would take up more than memory_budget bytes.
+        :param memory_budget: roughly how many bytes of decoded frames a streaming image keeps
+        """
         image_reader = QImageReader(file_path)
         self.is_animated = image_reader.supportsAnimation()
+        self.made_opengl_textures = False
+        # the image as it gets uploaded (see prepare_for_upload)
+        self._upload_image = None
         if self.is_animated:
-            self.num_frames = image_reader.imageCount()
-            # -1 means loop infinitely, 0 means no loop, > 0 is finite # of loops
-            self.loop_count = image_reader.loopCount()
-            self.loops_remaining = 0
-            self.frames = []
-            self.delays = []
-            while image_reader.currentImageNumber() < image_reader.imageCount() - 1:
-                self.frames.append(image_reader.read())
-                self.delays.append(image_reader.nextImageDelay())
-
-            if make_opengl_textures:
-                self.open_gl_textures = [QOpenGLTexture(this_frame.mirrored()) for this_frame in self.frames]
-                self.made_opengl_textures = True
-
-            self.frames_and_delays = zip(self.frames, self.delays)
-
-            self.current_frame = 0
-            self.animating = False
+            if streaming is None:
+                frame_size = image_reader.size()
+                streaming = frame_size.width() * frame_size.height() * 4 * image_reader.imageCount() > memory_budget
+            self.atlas = None
+            self.open_gl_textures = None
+            if streaming:
+                self.frame_stream = FrameStream(file_path, memory_budget)
+                self.frames = None
+                self.delays = self.frame_stream.delays
+                loop_count = self.frame_stream.loop_count
+                # {frame number: QOpenGLTexture} for frames in the stream's window, and the texture handed out last,
+                # which stands in for frames that haven't been decoded yet
+                self._streamed_textures = {}
+                self._shown_texture = None
+                self._stand_in_texture = None
+            else:
+                self.frame_stream = None
+                self.frames = []
+                self.delays = []
+                for frame, delay in read_frames(image_reader):
+                    self.frames.append(frame)
+                    self.delays.append(delay)
+                loop_count = image_reader.loopCount()
+                self.frames_and_delays = zip(self.frames, self.delays)
+            self.num_frames = len(self.delays)
+
+            frame_end_times = list(accumulate(delay if delay >= MIN_FRAME_DELAY else DEFAULT_FRAME_DELAY
+                                              for delay in self.delays))
+            self._init_playback(real_time_frame_clock if clock is None else clock, frame_end_times, loop_count)
         else:
             self.image = image_reader.read()
             assert isinstance(self.image, QImage)
-            if make_opengl_textures:
-                self.open_gl_texture = QOpenGLTexture(self.image.mirrored())
-                self.made_opengl_textures = True
+            if self.image.isNull():
+                raise IOError("Could not read {}: {}".format(file_path, image_reader.errorString()))
+        if make_opengl_textures:
+            self.make_opengl_textures()
 
-    def start_animation(self):
-        threading.Thread(target=self.animate).start()
-        self.loops_remaining = self.loop_count
-
-    def animate(self):
-        while self.animating:
-            if self.current_frame < self.num_frames - 1:
-                # not the last frame
-                self.current_frame += 1
-            elif self.loops_remaining < 0:
-                # last frame and we have infinite loops
-                self.current_frame = 0
-            elif self.loops_remaining > 0:
-                # last frame and we have positive finite loops left
-                self.current_frame = 0
-                self.loops_remaining -= 1
-            # Note that if loops_remaining is 0 then nothing happens; we just sit on the last frame
-
-            time.sleep(self.delays[self.current_frame]/1000.)
+    def make_opengl_textures(self):
+        # Uploads the image to the gpu, which needs a current GL context. The constructor does this, unless told not to
+        # (e.g. because it's decoding on another thread).
+        if self.made_opengl_textures:
+            return
+        if not self.is_animated:
+            self.open_gl_texture = QOpenGLTexture(self._upload_image if self._upload_image is not None
+                                                  else self.image.mirrored())
+            self._upload_image = None
+        elif self.frame_stream is None:
+            self.atlas = AnimatedImageAtlas.make_atlas(self.frames)
+            # too big for an atlas, so each frame gets a texture of its own
+            self.open_gl_textures = None if self.atlas is not None \
+                else [QOpenGLTexture(this_frame.mirrored()) for this_frame in self.frames]
+        # (streamed frames get their textures as they come up)
+        self.made_opengl_textures = True
 
-    def stop_animation(self):
-        self.animating = False
+    def prepare_for_upload(self):
+        # Flips and converts a still image into the form the texture is made from ahead of time, so that doing it can
+        # happen on a loading thread rather than in make_opengl_textures. (QOpenGLTexture converts to RGBA8888 anyway.)
+        if not self.is_animated and not self.made_opengl_textures:
+            self._upload_image = self.image.mirrored().convertToFormat(QImage.Format_RGBA8888)
 
-    def reset_animation(self):
-        self.current_frame = 0
+    def get_frame_image(self, frame_number):
+        if self.frame_stream is not None:
+            return self.frame_stream.get_frame(frame_number)
+        return self.frames[frame_number]
+
+    def get_frame_opengl_texture(self, frame_number):
+        # the texture showing the given frame (for an atlas, along with the other frames); needs a current GL context
+        if not self.made_opengl_textures:
+            return None
+        if self.atlas is not None:
+            return self.atlas.texture
+        if self.frame_stream is None:
+            return self.open_gl_textures[frame_number]
+        texture = self._streamed_textures.get(frame_number)
+        if texture is None:
+            frame = self.frame_stream.try_get_frame(frame_number)
+            if frame is None:
+                # not decoded yet, so the last texture shown stands in for it (see get_painted_state)
+                if self._shown_texture is None:
+                    # (nothing has been shown yet, so one is made of the frame the stream stands in with)
+                    self._stand_in_texture = QOpenGLTexture(self.frame_stream.get_frame(frame_number).mirrored())
+                    self._shown_texture = self._stand_in_texture
+                return self._shown_texture
+            texture = QOpenGLTexture(frame.mirrored())
+            # getting the frame moved the stream's window along, so textures behind it can go
+            for old_frame_number in [old_frame_number for old_frame_number in self._streamed_textures
+                                     if not self.frame_stream.is_in_window(old_frame_number)]:
+                self._streamed_textures.pop(old_frame_number).destroy()
+            self._streamed_textures[frame_number] = texture
+        if self._stand_in_texture is not None:
+            self._stand_in_texture.destroy()
+            self._stand_in_texture = None
+        self._shown_texture = texture
+        return texture
 
     def get_current_image(self):
         if not self.is_animated:
@@ -83,7 +295,7 @@ class MarcPyImage(MarcPyImageHandler):
             return self.image
         else:
             # it's an animated image
-            return self.frames[self.current_frame]
+            return self.get_frame_image(self.current_frame)
 
     def get_current_opengl_texture(self):
         if not self.made_opengl_textures:
@@ -93,58 +305,51 @@ class MarcPyImage(MarcPyImageHandler):
             return self.open_gl_texture
         else:
             # it's an animated image
-            return self.open_gl_textures[self.current_frame]
+            return self.get_frame_opengl_texture(self.current_frame)
 
+    def get_painted_state(self):
+        # for a streamed image, a frame that was stood in for (see FrameStream) also needs painting once it comes in
+        if self.frame_stream is None:
+            return self.current_frame
+        return self.current_frame, self.frame_stream.arrived_frames
 
-class MarcpyAnimatedImageHandler(MarcPyImageHandler):
+    def get_texture_transform(self):
+        if not self.is_animated or self.atlas is None:
+            return None
+        return self.atlas.frame_transforms[self.current_frame]
 
-    def __init__(self, animated_marcpy_image):
-        assert isinstance(animated_marcpy_image, MarcPyImage)
-        assert animated_marcpy_image.is_animated
-        self.animated_image = animated_marcpy_image
-        self.loops_remaining = 0
-        self.current_frame = 0
-        self.animating = False
+    def get_texture_key(self):
+        return self if not self.is_animated or self.atlas is None else self.atlas
 
-    def start_animation(self):
-        anim_thread = threading.Thread(target=self.animate)
-        anim_thread.daemon = True
-        anim_thread.start()
-        self.loops_remaining = self.animated_image.loop_count
 
-    def animate(self):
-        self.animating = True
-        while self.animating:
-            frame_start = time.time()
-            if self.current_frame < self.animated_image.num_frames - 1:
-                # not the last frame
-                self.current_frame += 1
-            elif self.loops_remaining < 0:
-                # last frame and we have infinite loops
-                self.current_frame = 0
-            elif self.loops_remaining > 0:
-                # last frame and we have positive finite loops left
-                self.current_frame = 0
-                self.loops_remaining -= 1
-            # Note that if loops_remaining is 0 then nothing happens; we just sit on the last frame
-
-            # for some reason, time.sleep often overshoots significantly, so we keep sleeping for 80% of the
-            # desired interval until we've slept enough
-            delay_time = self.animated_image.delays[self.current_frame] / 1000.
-            while delay_time - (time.time() - frame_start) > 0:
-                time.sleep(max(0, (delay_time - (time.time() - frame_start)) * 0.8))
+class MarcpyAnimatedImageHandler(_ClockedAnimation, MarcPyImageHandler):
 
-    def stop_animation(self):
-        self.animating = False
+    is_animated = True
 
-    def reset_animation(self):
-        self.current_frame = 0
+    def __init__(self, animated_marcpy_image):
+        assert isinstance(animated_marcpy_image, MarcPyImage)
+        assert animated_marcpy_image.is_animated
+        self.animated_image = animated_marcpy_image
+        # same clock and frame timings as the image, but playing independently
+        self._init_playback(animated_marcpy_image.clock, animated_marcpy_image._frame_end_times,
+                            animated_marcpy_image.loop_count)
 
     def get_current_image(self):
-        return self.animated_image.frames[self.current_frame]
+        return self.animated_image.get_frame_image(self.current_frame)
 
     def get_current_opengl_texture(self):
-        if not self.animated_image.made_opengl_textures:
+        return self.animated_image.get_frame_opengl_texture(self.current_frame)
+
+    def get_painted_state(self):
+        if self.animated_image.frame_stream is None:
+            return self.current_frame
+        return self.current_frame, self.animated_image.frame_stream.arrived_frames
+
+    def get_texture_transform(self):
+        if self.animated_image.atlas is None:
             return None
-        else:
-            return self.animated_image.open_gl_textures[self.current_frame]
\ No newline at end of file
+        return self.animated_image.atlas.frame_transforms[self.current_frame]
+
+    def get_texture_key(self):
+        # handlers on an atlas all bind the same texture, whatever frame they're on
+        return self if self.animated_image.atlas is None else self.animated_image.atlas
\ No newline at end of file
@@ -0,0 +1,137 @@
+from .marc_paint_shapes import MarcGLShape, ShapeBatches
+from .spatial_index import ShapeIndex
+from .picking import PickIndex
+
+# the layer that drawing goes into when no other layer has been chosen
+DEFAULT_LAYER_NAME = "default"
+
+
+class PaintLayer:
+    """
+    A named list of shapes within a MarcPaintWidget (see MarcPaintWidget.layer). Layers are painted in order of z_order,
+    ties going by the order in which they were created, and can be hidden without losing their shapes.
+
+    A static layer keeps its (batched) geometry on the gpu from one frame to the next, which suits things like
+    backgrounds that are drawn once while the rest of the scene is cleared and redrawn every frame. Drawing into it or
+    clearing it updates it as usual; call invalidate after changing its shapes in place.
+
+    Drawing into a layer goes either through the layer itself, as in layer.fill_rects(...), or through the widget inside
+    a with block:
+
+        with widget.layer("background", static=True):
+            widget.fill_rects(...)
+    """
+
+    def __init__(self, host_widget, name, z_order=0, static=False):
+        self.host_widget = host_widget
+        self.name = name
+        self.shapes = []
+        self.visible = True
+        self.z_order = z_order
+        self.static = static
+        # animated textures used by the shapes of this layer, whose frame changes count as scene changes
+        self.animated_textures = {}
+        # the batches of self.shapes (see get_shapes_to_paint), and the list they were made from
+        self._batches = ShapeBatches()
+        self._batched_list = self.shapes
+        # (the list of shapes it was made from, its length, ShapeIndex); made when first culling, and kept until the
+        # shapes change
+        self._shape_index = None
+        # the items drawn into this layer with ids, for MarcPaintWidget.pick
+        self.pick_index = PickIndex()
+
+    def __enter__(self):
+        self.host_widget.push_layer(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.host_widget.pop_layer()
+        return False
+
+    def __getattr__(self, item):
+        # layer.draw_lines(...) and friends are the widget's drawing methods, drawing into this layer
+        if item.startswith("draw_") or item.startswith("fill_"):
+            widget_method = getattr(self.host_widget, item)
+
+            def draw_into_layer(*args, **kwargs):
+                with self:
+                    return widget_method(*args, **kwargs)
+            return draw_into_layer
+        raise AttributeError(item)
+
+    # ---------------------------------- Shapes -----------------------------------
+
+    def add_shape(self, shape):
+        # only the batch at the end is affected, which get_shapes_to_paint takes care of
+        self._shape_index = None
+        if self.static and isinstance(shape, MarcGLShape):
+            shape.retained = True
+        self.shapes.append(shape)
+        texture = getattr(shape, "texture", None)
+        if getattr(texture, "is_animated", False):
+            # an animated image (or a handler for one), which changes frame on its own
+            self.animated_textures[id(texture)] = texture
+        self.host_widget.mark_dirty()
+
+    def clear(self):
+        self._invalidate_batches()
+        for shape in self.shapes:
+            shape.release_vbos()
+        self.shapes = []
+        self.animated_textures = {}
+        self.pick_index.clear()
+        self.host_widget.mark_dirty()
+
+    def invalidate(self):
+        # throws away everything that was built from the shapes (batches and gpu buffers), so that it gets rebuilt
+        self._invalidate_batches()
+        for shape in self.shapes:
+            shape.release_vbos()
+        self.host_widget.mark_dirty()
+
+    def get_shapes_to_paint(self):
+        if not self.host_widget.batch_shapes:
+            return self.shapes
+        # Shapes that were added since the last paint are batched on to the end of the existing batches. This also
+        # catches shapes appended to the list directly; a list that was replaced or shortened is batched again.
+        if self._batched_list is not self.shapes or self._batches.num_shapes > len(self.shapes):
+            self._invalidate_batches()
+        for shape in self.shapes[self._batches.num_shapes:]:
+            self._batches.add(shape)
+        return self._batches.get_shapes()
+
+    def get_visible_shapes(self, view_bounds, pixel_size=(0.0, 0.0)):
+        # the shapes to paint that overlap view_bounds, in painting order (see ShapeIndex.get_visible_shapes)
+        shapes = self.get_shapes_to_paint()
+        if self._shape_index is None or self._shape_index[0] is not shapes or self._shape_index[1] != len(shapes):
+            self._shape_index = (shapes, len(shapes), ShapeIndex(shapes))
+        return self._shape_index[2].get_visible_shapes(view_bounds, pixel_size)
+
+    def _invalidate_batches(self):
+        # (any spatial index goes too, since it's made from the batches)
+        self._shape_index = None
+        self._batches.release_vbos()
+        self._batches = ShapeBatches()
+        self._batched_list = self.shapes
+
+    # --------------------------------- Properties ---------------------------------
+
+    def set_visible(self, visible):
+        if visible != self.visible:
+            self.visible = visible
+            self.host_widget.mark_dirty()
+
+    def set_z_order(self, z_order):
+        if z_order != self.z_order:
+            self.z_order = z_order
+            self.host_widget.mark_dirty()
+
+    def set_static(self, static):
+        if static == self.static:
+            return
+        self.static = static
+        for shape in self.shapes:
+            if isinstance(shape, MarcGLShape):
+                shape.retained = static
+        # the batches were made with the old setting, and non-static shapes shouldn't hold on to gpu buffers
+        self.invalidate()
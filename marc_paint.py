@@ -1,9 +1,22 @@
 from PyQt5.QtCore import QTimer, QPoint, QPointF, Qt
 from PyQt5 import QtWidgets
 import math
+import bisect
+from collections import Counter
 from PyQt5.QtGui import QSurfaceFormat
 from .marc_paint_shapes import *
 from .image_processing import *
+from .gl_state import GLStateCache
+from .glyph_atlas import GlyphAtlasCache
+from .frame_cache import FrameCache
+from .layers import PaintLayer, DEFAULT_LAYER_NAME
+from .recorder import FrameRecorder, PngSequenceWriter
+from .frame_scheduler import FrameScheduler, FrameSchedulingModes, FrameSkipPolicies
+from .texture_loader import TextureLoader, TextureLoadStates
+from .spatial_index import pad_bounds, get_bounds
+from .picking import PolygonTargets, LineTargets, ArcTargets, PickFramebuffer, encode_pick_colors, \
+    decode_pick_colors, get_fan_triangles
+from .shaders import *
 import time
 
 CornerTypes = enum(NONE="none", ROUNDED="rounded", FLAT_BRUSH="flat brush")
@@ -21,12 +34,29 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
 
     VERTICES_PER_SEMICIRCLE = 6
     DOUBLE_CLICK_TIME = 0.3
+    # bounds on the number of segments per arc when they are chosen automatically
+    MIN_LOD_SEGMENTS = 4
+    MAX_LOD_SEGMENTS = 512
 
     def __init__(self, parent=None, title="A Marc Paint Widget", view_bounds=(0, 1, 0, 1), window_size=(500, 500),
-                 bg_color=(0.0, 0.0, 0.0, 1.0), textures=None):
+                 bg_color=(0.0, 0.0, 0.0, 1.0), textures=None, use_vbos=False, batch_shapes=True, core_profile=False):
+        """
+        :param use_vbos: if True, each shape uploads its geometry into vertex buffer objects the first time it is
+        painted, and later paints just bind and draw. Good for static scenes with lots of vertices; wasteful if
+        everything is cleared and redrawn every frame.
+        :param batch_shapes: if True, adjacent compatible shapes (same draw mode, texture, line width and color
+        layout) are merged before drawing, so that lots of small draw calls become a few big ones.
+        :param core_profile: if True, asks for an OpenGL 3.3 core profile context and draws everything with shaders
+        instead of the fixed-function pipeline (no glOrtho, glColor, client arrays or glTexEnv). Shapes always live
+        in VBOs in this mode. The drawing methods work the same, but any raw GL in do_pre_painting or
+        do_extra_painting has to be core profile compatible too.
+        """
         super().__init__(parent)
         this_format = QSurfaceFormat()
         this_format.setSamples(16)
+        if core_profile:
+            this_format.setVersion(3, 3)
+            this_format.setProfile(QSurfaceFormat.CoreProfile)
         self.setFormat(this_format)
 
         # note: textures takes the form {name: path to image}
@@ -34,17 +64,22 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             textures = {}
         self.textures = {}
         self.textures_to_load = textures
+        self._texture_load_callbacks = {}
+        # decodes textures on other threads, for load_texture(asynchronous=True)
+        self.texture_loader = TextureLoader(self)
 
         self.setWindowTitle(title)
         self.view_bounds = view_bounds
-        self.setGeometry((get_screen_width() - window_size[0])/2,
-                         (get_screen_height() - window_size[1])/2,
-                         window_size[0], window_size[1])
+        self.setGeometry(int((get_screen_width() - window_size[0])/2),
+                         int((get_screen_height() - window_size[1])/2),
+                         int(window_size[0]), int(window_size[1]))
         self.bg_color = bg_color
         self.setAutoFillBackground(False)
         self.last_resize = None
         self.resize_mode = ResizeModes.ANCHOR_MIDDLE
         self.squash_factor = float(self.get_view_width()) * self.height() / self.width() / self.get_view_height()
+        # in pixels; see set_arc_error_tolerance
+        self.arc_error_tolerance = 0.25
 
         # track mouse movements
         self.setMouseTracking(True)
@@ -60,15 +95,65 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         self._keys_down = []
         self.use_shift_sensitive_key_codes = False
 
-        # animation timer
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self._do_animate_frame)
+        # animation scheduling (see start_animation)
+        self.frame_scheduler = FrameScheduler(self)
+        # what the widget's animated images go by; it follows the frame scheduler's animation clock
+        self.frame_clock = FrameClock()
         QTimer().singleShot(0, self.on_load)
-        self.last_animate = None
         self.animation_layers = []
 
-        # shapes to be drawn
-        self._shapes = []
+        # shapes to be drawn, in named layers (see layer); drawing goes into the top of the layer stack, or else into
+        # the default layer
+        self._layers = {DEFAULT_LAYER_NAME: PaintLayer(self, DEFAULT_LAYER_NAME)}
+        self._layer_stack = []
+        # retained mode: shapes keep their geometry on the gpu until they are cleared
+        self.use_vbos = use_vbos
+        self._buffers_to_delete = []
+        # merging adjacent compatible shapes into single draw calls; each layer caches its merged list until its shapes
+        # change
+        self.batch_shapes = batch_shapes
+        # tracks the GL state so that shapes only issue the changes they need, and counts GL calls per frame
+        self.core_profile = core_profile
+        self.gl_state = GLStateCache(core_profile)
+        # rasterized glyphs for the draw_text(use_glyph_atlas=True) path
+        self.glyph_atlases = GlyphAtlasCache()
+        # shader programs and template meshes for instanced drawing; both are made lazily, since they need a context
+        self._shader_programs = {}
+        self._instance_templates = {}
+        # element buffers shared by all shapes indexed with the same IndexPattern: {(pattern, index dtype): (buffer id,
+        # number of indices in it)}
+        self._index_pattern_buffers = {}
+        # core profile contexts need a vertex array object bound to draw anything; we just use one for everything
+        self._vertex_array_object = None
+        self._projection_matrix = None
+
+        # Change tracking, so that animation ticks that leave the scene as it was don't repaint it. The generation is
+        # bumped by anything that changes the shapes; see mark_dirty. Off by default, since subclasses that animate with
+        # raw GL in do_pre_painting or do_extra_painting, or change shapes in place, would have to call mark_dirty.
+        self.skip_unchanged_frames = False
+        self._scene_generation = 0
+        self._overlay_generation = 0
+        self._painted_scene_state = None
+        self._painted_overlay_generation = None
+        self.skipped_frame_count = 0
+        # if True, the last painted frame is kept in an FBO, so that overlay-only changes don't repaint the shapes
+        self.cache_frames = False
+        self._frame_cache = FrameCache()
+        # the FrameRecorder capturing painted frames, while recording (see start_recording), and whether the coming
+        # paint was asked for by an animation tick, rather than by Qt (exposing, resizing) or an update call
+        self.recorder = None
+        self._painting_animation_frame = False
+
+        # View culling (off unless turned on): shapes (and the elements of multi draw shapes) that are entirely out of
+        # view aren't painted. Shapes are found through a spatial index of each layer, so panning around a big scene
+        # only costs as much as what is in view. Culling goes by view_bounds, so it doesn't suit subclasses that
+        # transform the view in do_pre_painting. Lines are padded by half their width; the margin, in pixels, covers
+        # antialiasing and the like.
+        self.cull_to_view = False
+        self.cull_margin = 4
+        self.cull_stats = Counter()
+        # the offscreen buffer that pick(use_gpu=True) renders into
+        self._pick_framebuffer = PickFramebuffer()
 
     # ------------------------------ View and Window Stuff -----------------------------
 
@@ -92,9 +177,9 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         return math.hypot(self.get_view_width(), self.get_view_height())
 
     def set_window_size(self, width, height):
-        self.setGeometry((get_screen_width() - width)/2,
-                         (get_screen_height() - height)/2,
-                         width, height)
+        self.setGeometry(int((get_screen_width() - width)/2),
+                         int((get_screen_height() - height)/2),
+                         int(width), int(height))
         self.squash_factor = float(self.get_view_width()) * height / width / self.get_view_height()
 
     def window_to_view(self, point):
@@ -123,6 +208,9 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if self.context() is None:
             # If this is called before the GL Context is created, a godawful error will occur. This prevents that.
             return
+        if self.core_profile:
+            # the shaders get the projection from get_projection_matrix instead
+            return
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
         glOrtho(self.view_bounds[0], self.view_bounds[1], self.view_bounds[2], self.view_bounds[3], -1.0, 1.0)
@@ -131,13 +219,115 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
 
     def paintGL(self):
         self._load_queued_textures()
-        glClear(GL_COLOR_BUFFER_BIT)
-        self.setup_2d_view()
-        self.do_pre_painting()
-        for shape in self._shapes:
-            assert isinstance(shape, MarcShape)
-            shape.paint()
+        # asynchronously loaded textures only ever get uploaded here, before any shape paints, so that the upload
+        # budget is spent once per frame
+        self.texture_loader.begin_frame()
+        self.texture_loader.upload_decoded_textures()
+        self._delete_queued_buffers()
+        self.gl_state.begin_frame()
+        self.cull_stats = Counter()
+        scene_state = self._get_scene_state()
+        framebuffer_width, framebuffer_height = self._get_framebuffer_size()
+        if self.cache_frames and scene_state == self._painted_scene_state and \
+                self._frame_cache.matches(framebuffer_width, framebuffer_height):
+            # only the overlay changed, so we put back the frame as it was before do_extra_painting
+            self._frame_cache.restore(self.defaultFramebufferObject())
+            self.setup_2d_view()
+        else:
+            glClear(GL_COLOR_BUFFER_BIT)
+            self.setup_2d_view()
+            self.do_pre_painting()
+            for shape in self._get_shapes_to_paint():
+                assert isinstance(shape, MarcShape)
+                shape.paint()
+            if self.cache_frames:
+                self._frame_cache.store(self.defaultFramebufferObject(), framebuffer_width, framebuffer_height)
+            elif self._frame_cache.is_valid:
+                self._frame_cache.release()
         self.do_extra_painting()
+        if self.recorder is not None and self._painting_animation_frame:
+            self.recorder.capture_frame()
+        self._painting_animation_frame = False
+        self.gl_state.end_frame()
+        self._painted_scene_state = scene_state
+        self._painted_overlay_generation = self._overlay_generation
+
+    def mark_dirty(self, overlay_only=False):
+        """
+        Tells the widget that the next animation frame needs to be painted. The draw and fill methods, clear, and
+        changes of view, size or animated texture frame are noticed automatically; this is for changes they can't
+        see, like raw GL in do_pre_painting or do_extra_painting, or shapes modified in place.
+
+        :param overlay_only: if True, only what do_extra_painting draws has changed. With cache_frames on, this
+            means the shapes don't have to be repainted.
+        """
+        if overlay_only:
+            self._overlay_generation += 1
+        else:
+            self._scene_generation += 1
+
+    def needs_repaint(self):
+        return self._get_scene_state() != self._painted_scene_state or \
+            self._overlay_generation != self._painted_overlay_generation
+
+    def _get_scene_state(self):
+        # everything that the painted shapes depend on; the lengths catch shapes appended to the shape lists of the
+        # layers directly (as subclasses do with _shapes), rather than through the draw and fill methods
+        return (self._scene_generation, tuple(len(layer.shapes) for layer in self._layers.values()), self.view_bounds,
+                self.width(), self.height(), tuple(self.bg_color),
+                tuple(texture.get_painted_state() for layer in self._layers.values()
+                      for texture in layer.animated_textures.values()))
+
+    def _get_framebuffer_size(self):
+        return int(self.width() * self.devicePixelRatioF()), int(self.height() * self.devicePixelRatioF())
+
+    def get_paint_device(self):
+        # what QPainters (e.g. in TextShape) should paint on; the widget itself, unless rendering offscreen
+        return self
+
+    def get_gl_call_counts(self):
+        # a Counter of {gl function name: number of calls} made while painting the last frame
+        return self.gl_state.last_frame_call_counts
+
+    def _get_shapes_to_paint(self):
+        # the (batched) shapes of all visible layers that are in view, in painting order
+        cull_bounds = self.get_cull_bounds()
+        shapes_to_paint = []
+        for layer in self.get_layers():
+            if not layer.visible:
+                continue
+            if cull_bounds is None:
+                shapes_to_paint.extend(layer.get_shapes_to_paint())
+            else:
+                shapes_to_paint.extend(layer.get_visible_shapes(cull_bounds, self._get_view_pixel_size()))
+                self.cull_stats["shape_count"] += len(layer.get_shapes_to_paint())
+        if cull_bounds is not None:
+            self.cull_stats["culled_shape_count"] = self.cull_stats["shape_count"] - len(shapes_to_paint)
+        return shapes_to_paint
+
+    def get_cull_bounds(self, pixel_padding=0):
+        # the view bounds padded by cull_margin (plus pixel_padding) pixels, in order (x_min, x_max, y_min, y_max); None
+        # if not culling
+        if not self.cull_to_view:
+            return None
+        x_min, x_max = sorted(self.view_bounds[:2])
+        y_min, y_max = sorted(self.view_bounds[2:])
+        pixel_width, pixel_height = self._get_view_pixel_size()
+        padding = self.cull_margin + pixel_padding
+        return pad_bounds((x_min, x_max, y_min, y_max), padding * pixel_width, padding * pixel_height)
+
+    def _get_view_pixel_size(self):
+        # the width and height of a pixel in view units
+        return abs(self.get_view_width()) / max(1, self.width()), abs(self.get_view_height()) / max(1, self.height())
+
+    def get_cull_stats(self):
+        """
+        How much view culling left out of the last frame: shape_count and culled_shape_count for whole (batched)
+        shapes, and element_count and culled_element_count for the elements of multi draw shapes (e.g. the separate
+        fans of a batch of arcs) that were partly in view.
+        """
+        return {key: self.cull_stats[key] for key in ("shape_count", "culled_shape_count", "element_count",
+                                                      "culled_element_count")}
 
     def do_pre_painting(self):
         # for any opengl called to be done before the flat drawing
@@ -172,32 +362,124 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
 
     def initializeGL(self):
         # Called when the GL Context is created
+        self.context().aboutToBeDestroyed.connect(self._release_gl_resources)
         self._load_queued_textures()
+        self.restore_gl_state()
+
+    def _release_gl_resources(self):
+        # the widget's context is going away with it; the texture loader stops decoding, since there will be nothing to
+        # upload to, and the buffers of shapes that were already collected get deleted while they still can be
+        self.texture_loader.shutdown()
+        self.makeCurrent()
+        self._delete_queued_buffers()
+        self.doneCurrent()
+
+    def closeEvent(self, event):
+        # no point decoding textures for a closed window; the loader starts back up if asked to load more
+        self.texture_loader.shutdown()
+        super(MarcPaintWidget, self).closeEvent(event)
+
+    def restore_gl_state(self):
+        # Sets up the OpenGL state we draw with; also called by TextShape after a QPainter has changed it, and after
+        # picking. Unlike initializeGL, this never loads textures, since it can happen in the middle of painting.
+        self.gl_state.invalidate()
+        if self.core_profile:
+            if self._vertex_array_object is None:
+                self._vertex_array_object = glGenVertexArrays(1)
+            # (re)bound every time, since a QPainter may have bound its own
+            glBindVertexArray(self._vertex_array_object)
         self.setup_2d_view()
         if len(self.bg_color) == 3:
             glClearColor(*(self.bg_color + (1.0, )))
         else:
             glClearColor(*self.bg_color)
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        glEnable(GL_MULTISAMPLE)
+        self.gl_state.set_capability(GL_BLEND, True)
+        self.gl_state.set_blend_func(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        self.gl_state.set_capability(GL_MULTISAMPLE, True)
 
-    def load_texture(self, texture_name, texture_path):
-        # we can't just load textures at any time; it needs to be during the paintGL or initializeGL methods
-        # so this method schedules it to be loaded
-        self.textures_to_load[texture_name] = texture_path
+    def load_texture(self, texture_name, texture_path, asynchronous=False, callback=None):
+        """
+        We can't just load textures at any time; it needs to be during the paintGL or initializeGL methods, so this
+        method schedules it to be loaded.
+
+        :param asynchronous: if True, the image is decoded on a background thread and uploaded a few frames later,
+            rather than holding up the next paint. Until then, the texture isn't in self.textures, and drawing it does
+            nothing (see get_texture_load_state, and draw_image's placeholder_color).
+        :param callback: function(texture_name, marcpy_image) to call once the texture is loaded; marcpy_image is None
+            if it couldn't be loaded (the error is in texture_loader.failures)
+        """
+        if asynchronous:
+            self.texture_loader.load_asynchronously(texture_name, texture_path, callback)
+        else:
+            self.textures_to_load[texture_name] = texture_path
+            self._texture_load_callbacks[texture_name] = callback
 
     def _load_queued_textures(self):
-        # this actually does the loading of the texture, called during paintGL or initializeGL
+        # this actually does the loading of the (synchronously loaded) textures, called during paintGL or initializeGL
         for texture_name in list(self.textures_to_load.keys()):
-            self.textures[texture_name] = MarcPyImage(self.textures_to_load.pop(texture_name))
+            self.texture_loader.load_now(texture_name, self.textures_to_load.pop(texture_name),
+                                         self._texture_load_callbacks.pop(texture_name, None))
+
+    def get_texture_load_state(self, texture_name):
+        # one of the TextureLoadStates
+        if texture_name in self.textures_to_load:
+            return TextureLoadStates.LOADING
+        return self.texture_loader.get_state(texture_name)
+
+    def is_texture_loaded(self, texture_name):
+        return texture_name in self.textures
+
+    def queue_buffers_for_deletion(self, buffer_ids):
+        # like textures, buffers can only be deleted when the GL context is current, so we do it in paintGL
+        self._buffers_to_delete.extend(buffer_ids)
+
+    def _delete_queued_buffers(self):
+        if len(self._buffers_to_delete) > 0:
+            # swapped out first, since shapes being garbage collected can queue more buffers at any time
+            buffer_ids, self._buffers_to_delete = self._buffers_to_delete, []
+            glDeleteBuffers(len(buffer_ids), buffer_ids)
+
+    def get_shader_program(self, program_name):
+        # compiled the first time it's asked for, which has to be while painting
+        if program_name not in self._shader_programs:
+            vertex_source, fragment_source, attribute_locations = _SHADER_PROGRAM_SOURCES[program_name]
+            self._shader_programs[program_name] = ShaderProgram(vertex_source, fragment_source, attribute_locations,
+                                                                core_profile=self.core_profile)
+        return self._shader_programs[program_name]
+
+    def get_projection_matrix(self):
+        # for shaders: the same projection that setup_2d_view sets up for the fixed-function pipeline
+        if self._projection_matrix is None or self._projection_matrix[0] != self.view_bounds:
+            self._projection_matrix = (self.view_bounds, get_ortho_projection(self.view_bounds))
+        return self._projection_matrix[1]
+
+    def get_instance_template(self, template_key, draw_mode, vertices, tex_coords=None):
+        # template meshes are shared by all instanced shapes, and stay on the gpu for the life of the widget
+        if template_key not in self._instance_templates:
+            self._instance_templates[template_key] = InstanceTemplate(draw_mode, vertices, tex_coords)
+        return self._instance_templates[template_key]
+
+    def get_index_pattern_buffer(self, index_pattern, indices):
+        # The element buffer holding (at least) the given indices of an IndexPattern; it's made, or made bigger, as
+        # needed while painting, and stays on the gpu for the life of the widget.
+        key = (index_pattern, indices.dtype)
+        buffer_id, num_indices = self._index_pattern_buffers.get(key, (None, 0))
+        if num_indices < indices.shape[0]:
+            if buffer_id is None:
+                buffer_id = glGenBuffers(1)
+            # all of the pattern's cached indices, so that it doesn't have to grow again for every bigger shape
+            all_indices = index_pattern.get_cached_indices(indices.dtype)
+            self.gl_state.bind_element_array_buffer(buffer_id)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, all_indices, GL_STATIC_DRAW)
+            self._index_pattern_buffers[key] = (buffer_id, all_indices.shape[0])
+        return buffer_id
 
     def get_texture_handler(self, texture_name):
         # This method exists because of animated images. Animated images are complicated, because we may be wanting to
         # draw several of them at different stages in their animation. So in this case we need a handler for each
         # drawing instance. This returns that handler, which we can pass to the texture param of drawing methods
         if texture_name not in self.textures:
-            # return false if the texture doesn't exist or hasn't been processed yet
+            # return false if the texture doesn't exist or hasn't been processed yet (see get_texture_load_state)
             return False
         marcpy_image = self.textures[texture_name]
         assert isinstance(marcpy_image, MarcPyImage)
@@ -333,28 +615,53 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
 
     # ---------------------------------- Animation! -----------------------------------
 
-    def start_animation(self, interval):
-        # interval in seconds
-        def _first_animate():
-            self.last_animate = time.time()
-            a = time.time()
-            self._do_animate_frame()
-            self.timer.start(int(interval*1000))
-        QTimer().singleShot(0, _first_animate)
-
-    def _do_animate_frame(self):
-        now = time.time()
-        self.animate(now - self.last_animate)
+    def start_animation(self, interval, mode=FrameSchedulingModes.TIMER, frame_skip_policy=FrameSkipPolicies.CATCH_UP,
+                        max_steps_per_frame=5):
+        """
+        Starts calling animate (and the animation layers) regularly, and repainting when anything changed.
+
+        :param interval: in seconds; the time between frames in TIMER mode, and the fixed dt in FIXED_TIMESTEP mode
+        :param mode: a FrameSchedulingModes; see frame_scheduler.py
+        :param frame_skip_policy: a FrameSkipPolicies, for when frames run late
+        :param max_steps_per_frame: the most animate steps (or intervals' worth of dt) to catch up on in one frame
+        """
+        self.frame_scheduler.start(interval, mode, frame_skip_policy, max_steps_per_frame)
+
+    def _advance_animation(self, dt, animation_time):
+        # called by the frame scheduler for every animation step, with the time on its animation clock
+        self.frame_clock.set_time(animation_time)
+        self.animate(dt)
         continuing_animation_layers = []
         for animation_layer in self.animation_layers:
-            if animation_layer(now - self.last_animate, now - animation_layer.start_time):
+            if animation_layer(dt, animation_time - animation_layer.start_time):
                 continuing_animation_layers.append(animation_layer)
         self.animation_layers = continuing_animation_layers
-        self.last_animate = now
-        self.repaint()
+
+    def _present_animation_frame(self, synchronous=True):
+        # called by the frame scheduler once the steps of a frame are done; returns whether a repaint was requested
+        if self.skip_unchanged_frames and not self.needs_repaint():
+            self.skipped_frame_count += 1
+            if self.recorder is not None:
+                self.recorder.repeat_frame()
+            return False
+        self._painting_animation_frame = True
+        if synchronous:
+            self.repaint()
+        else:
+            # painted on the next display refresh
+            self.update()
+        return True
 
     def stop_animation(self):
-        self.timer.stop()
+        self.frame_scheduler.stop()
+
+    def get_interpolation_alpha(self):
+        # in FIXED_TIMESTEP mode, how far (from 0 to 1) real time is between the last animate step and the next one
+        return self.frame_scheduler.interpolation_alpha
+
+    def get_frame_stats(self):
+        # frame time statistics from the frame scheduler; see FrameScheduler.get_stats
+        return self.frame_scheduler.get_stats()
 
     def add_animation_layer(self, animation_function):
         """
@@ -362,13 +669,202 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         the last draw and the time since the start of the animation, respectively. Should return true if it wants to
         continue or False if it's time to end the animation.
         """
-        animation_function.start_time = time.time()
+        animation_function.start_time = self.frame_scheduler.animation_time
         self.animation_layers.append(animation_function)
 
+    def start_recording(self, output, max_queued_frames=16):
+        """
+        Records every animation frame from now on, until stop_recording. Animation ticks that skip painting because
+        nothing changed repeat the previous frame, and paints that aren't animation ticks (exposing, resizing, update
+        calls) aren't recorded, so the recording keeps the animation's frame rate. The widget's size has to stay the
+        same while recording; if it changes, the recording ends there, and stop_recording raises an error.
+
+        :param output: a directory to fill with a PNG sequence, or a frame writer (see recorder.py)
+        :param max_queued_frames: how many frames can wait to be written before new ones are dropped
+        :return: the FrameRecorder, whose get_stats reports queue depth and dropped frames as it goes
+        """
+        if self.recorder is not None:
+            self.stop_recording()
+        frame_writer = PngSequenceWriter(output) if isinstance(output, str) else output
+        self.recorder = FrameRecorder(self, frame_writer, max_queued_frames)
+        return self.recorder
+
+    def stop_recording(self):
+        # finishes writing the recording, and returns its statistics
+        if self.recorder is None:
+            return None
+        self.makeCurrent()
+        try:
+            return self.recorder.stop()
+        finally:
+            self.recorder = None
+            self.doneCurrent()
+
+    # ------------------------------------- Layers --------------------------------------
+
+    def layer(self, name, z_order=None, static=None):
+        """
+        Gets the PaintLayer with the given name, creating it if need be. New layers go on top of those with the same
+        z_order. Use it in a with block (or call its draw and fill methods) to draw into it.
+
+        :param z_order: if given, sets the layer's z_order; higher is painted later, and the default layer has 0
+        :param static: if given, sets whether the layer keeps its geometry on the gpu between frames
+        """
+        if name not in self._layers:
+            self._layers[name] = PaintLayer(self, name)
+            self.mark_dirty()
+        this_layer = self._layers[name]
+        if z_order is not None:
+            this_layer.set_z_order(z_order)
+        if static is not None:
+            this_layer.set_static(static)
+        return this_layer
+
+    def get_layers(self):
+        # sorted is stable, so layers with the same z_order stay in order of creation
+        return sorted(self._layers.values(), key=lambda this_layer: this_layer.z_order)
+
+    def remove_layer(self, name):
+        if name != DEFAULT_LAYER_NAME and name in self._layers:
+            self._layers.pop(name).clear()
+            self.mark_dirty()
+
+    def push_layer(self, this_layer):
+        self._layer_stack.append(this_layer)
+
+    def pop_layer(self):
+        return self._layer_stack.pop()
+
+    def get_current_layer(self):
+        # the layer that drawing currently goes into
+        return self._layer_stack[-1] if len(self._layer_stack) > 0 else self._layers[DEFAULT_LAYER_NAME]
+
+    def invalidate_batches_containing(self, shape):
+        # for shapes that change in place, which can no longer be painted as part of a merged copy
+        for this_layer in self._layers.values():
+            if any(layer_shape is shape for layer_shape in this_layer.shapes):
+                this_layer._invalidate_batches()
+
+    @property
+    def _shapes(self):
+        # the shapes of the default layer, for code written before there were layers
+        return self._layers[DEFAULT_LAYER_NAME].shapes
+
+    @_shapes.setter
+    def _shapes(self, shapes):
+        self._layers[DEFAULT_LAYER_NAME].shapes = shapes
+
     # ---------------------------------- Paint Calls! -----------------------------------
 
     def clear(self):
-        self._shapes = []
+        # clears the current layer (the default layer, unless drawing into another one); other layers are untouched
+        self.get_current_layer().clear()
+
+    def _add_shape(self, shape):
+        # The draw and fill methods that end up making a single shape return it, so that it can be changed in place
+        # later on with shape.update(...) rather than cleared and drawn again (see MarcGLShape.update). Those that make
+        # several shapes, or instanced ones, return None.
+        self.get_current_layer().add_shape(shape)
+        return shape
+
+    def _add_pick_targets(self, targets):
+        self.get_current_layer().pick_index.add(targets)
+
+    # ------------------------------------- Picking --------------------------------------
+
+    def pick(self, location, radius=0, use_gpu=False):
+        """
+        Finds the items drawn with ids (see the ids parameter of fill_rects, fill_arcs, draw_lines and fill_triangles,
+        and draw_text) that are at a location, e.g. self.pick(location) in on_mouse_move.
+
+        :param location: (x, y) in view coordinates
+        :param radius: in view units; items this close to the location count as well
+        :param use_gpu: By default, the items' geometry is tested against the location, which finds every item there,
+            including ones that are covered up. If True, the items are instead rendered into an offscreen buffer with
+            their ids encoded as colors, which finds only what is actually visible, exactly as rasterized. (The
+            geometry is drawn as given, so things drawn without ids don't cover anything up.)
+        :return: list of ids, without repeats, starting with the topmost (or with use_gpu, the one nearest the
+            location)
+        """
+        pixel_size = abs(self.get_view_width()) / max(1, self.width())
+        layers = [this_layer for this_layer in reversed(self.get_layers()) if this_layer.visible]
+        if use_gpu:
+            hits = self._pick_with_gpu(location, radius, pixel_size, layers)
+        else:
+            hits = [(this_layer, targets_number, item_number) for this_layer in layers
+                    for targets_number, item_number in this_layer.pick_index.pick(location, radius, pixel_size)]
+        ids = []
+        for this_layer, targets_number, item_number in hits:
+            item_id = this_layer.pick_index.targets[targets_number].get_id(item_number)
+            if item_id not in ids:
+                ids.append(item_id)
+        return ids
+
+    def _pick_with_gpu(self, location, radius, pixel_size, layers):
+        framebuffer_width, framebuffer_height = self._get_framebuffer_size()
+        self.makeCurrent()
+        try:
+            self._pick_framebuffer.bind(framebuffer_width, framebuffer_height)
+            glViewport(0, 0, framebuffer_width, framebuffer_height)
+            self.gl_state.invalidate()
+            if self.core_profile:
+                if self._vertex_array_object is None:
+                    self._vertex_array_object = glGenVertexArrays(1)
+                glBindVertexArray(self._vertex_array_object)
+            # the colors have to come out exactly as given
+            self.gl_state.set_capability(GL_BLEND, False)
+            glClearColor(0, 0, 0, 0)
+            glClear(GL_COLOR_BUFFER_BIT)
+            self.setup_2d_view()
+
+            # the items get codes 1, 2, 3... in painting order, so that later ones cover earlier ones as usual
+            code_starts = []
+            next_code = 1
+            for this_layer in reversed(layers):
+                for targets_number, targets in enumerate(this_layer.pick_index.targets):
+                    fans = targets.get_id_pass_fans(pixel_size)
+                    triangles_per_item = fans.shape[1] - 2
+                    colors = encode_pick_colors(np.arange(next_code, next_code + targets.num_items))
+                    shape = Triangles(self, get_fan_triangles(fans), colors.repeat(3 * triangles_per_item, axis=0))
+                    shape.paint()
+                    shape.release_vbos()
+                    code_starts.append((next_code, this_layer, targets_number))
+                    next_code += targets.num_items
+
+            # the square of pixels around the location
+            window_x, window_y = self.view_to_window(location)
+            device_pixel_ratio = framebuffer_width / max(1, self.width())
+            center_x = int(window_x * device_pixel_ratio)
+            center_y = int(framebuffer_height - window_y * device_pixel_ratio)
+            pixel_radius = int(math.ceil(radius / pixel_size * device_pixel_ratio))
+            x_start, x_end = max(0, center_x - pixel_radius), min(framebuffer_width, center_x + pixel_radius + 1)
+            y_start, y_end = max(0, center_y - pixel_radius), min(framebuffer_height, center_y + pixel_radius + 1)
+            if x_start >= x_end or y_start >= y_end:
+                return []
+            glPixelStorei(GL_PACK_ALIGNMENT, 1)
+            data = glReadPixels(x_start, y_start, x_end - x_start, y_end - y_start, GL_RGBA, GL_UNSIGNED_BYTE)
+        finally:
+            self.gl_state.restore_defaults()
+            glBindFramebuffer(GL_FRAMEBUFFER, self.defaultFramebufferObject())
+            # puts back the clear color, blending and so on
+            self.restore_gl_state()
+            self.doneCurrent()
+
+        codes = decode_pick_colors(np.frombuffer(data, dtype=np.uint8).reshape(y_end - y_start, x_end - x_start, 4))
+        pixel_xs, pixel_ys = np.meshgrid(np.arange(x_start, x_end) - center_x, np.arange(y_start, y_end) - center_y)
+        distances = np.hypot(pixel_xs, pixel_ys).reshape(-1)
+        codes = codes.reshape(-1)
+        in_radius = (distances <= max(pixel_radius, 0.5)) & (codes > 0)
+        codes, distances = codes[in_radius], distances[in_radius]
+        # nearest first, keeping the first appearance of each code
+        codes = codes[np.argsort(distances, kind="stable")]
+        codes = codes[np.sort(np.unique(codes, return_index=True)[1])]
+        first_codes = [first_code for first_code, _, _ in code_starts]
+        hits = []
+        for code in codes:
+            first_code, this_layer, targets_number = code_starts[bisect.bisect_right(first_codes, code) - 1]
+            hits.append((this_layer, targets_number, int(code - first_code)))
+        return hits
 
     def draw_points(self, vertices, colors, width=None):
         if not isinstance(vertices, np.ndarray):
@@ -388,22 +884,34 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
                                    [width/2, -width/2]]), (vertices.shape[0], 1))
             triangle_vertices = vertices.repeat(6, axis=0) + deviations
             if colors.ndim == 1:
-                self.fill_triangles(triangle_vertices, colors)
+                return self.fill_triangles(triangle_vertices, colors)
             else:
-                self.fill_triangles(triangle_vertices, colors.repeat(6, axis=0))
+                return self.fill_triangles(triangle_vertices, colors.repeat(6, axis=0))
         else:
-            self._shapes.append(Points(self, vertices, colors))
+            return self._add_shape(Points(self, vertices, colors))
 
-    def fill_triangles(self, vertices, colors=None, texture=None, tex_coords=None, tex_color_blend_mode=GL_MODULATE):
+    def fill_triangles(self, vertices, colors=None, texture=None, tex_coords=None, tex_color_blend_mode=GL_MODULATE,
+                       indices=None, ids=None):
         # takes a 2D array or list of vertices, and one of colors
         # either give a 1D array of RGB(A) values for color (all triangles painted that color)
         # or give a 2D array with one RGB(A) array for each vertex, or for each triangle
+        # If indices are given, each three of them make a triangle out of the vertices, so that vertices shared between
+        # triangles (as in a mesh) only need to be given once; colors then have to be one per vertex or a single one.
+        # If ids are given (a list with one for each triangle, or a single one for all of them), the triangles can be
+        # found with pick.
 
         if not isinstance(vertices, np.ndarray):
             vertices = np.array(vertices)
         if vertices.ndim == 1:
             vertices = np.array((vertices, ))
 
+        if ids is not None:
+            triangle_vertices = vertices
+            if indices is not None:
+                triangle_vertices = vertices[indices.get_indices(vertices.shape[0] // indices.vertices_per_piece)
+                                             if isinstance(indices, IndexPattern) else np.asarray(indices)]
+            self._add_pick_targets(PolygonTargets(triangle_vertices.reshape(-1, 3, 2), ids))
+
         if colors is not None:
             if not isinstance(colors, np.ndarray):
                 colors = np.array(colors)
@@ -420,8 +928,8 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if texture is None and colors is None:
             colors = np.array((0, 0, 0))
 
-        self._shapes.append(Triangles(self, vertices, colors=colors, texture=texture, tex_coords=tex_coords,
-                                      tex_color_blend_mode=tex_color_blend_mode))
+        return self._add_shape(Triangles(self, vertices, colors=colors, texture=texture, tex_coords=tex_coords,
+                                         tex_color_blend_mode=tex_color_blend_mode, indices=indices))
 
     def fill_triangle_fans(self, vertices, colors=None, starting_indices=None):
         # TODO: THIS IS INCOMPLETE: this method should really take a list of triangle fans and calculate the starting_indices from that
@@ -438,7 +946,7 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if colors is None:
             colors = np.array((0, 0, 0))
 
-        self._shapes.append(TriangleFans(self, vertices, colors=colors, starting_indices=starting_indices))
+        return self._add_shape(TriangleFans(self, vertices, colors=colors, starting_indices=starting_indices))
 
     def fill_triangle_strips(self, vertices, colors=None, starting_indices=None):
         if not isinstance(vertices, np.ndarray):
@@ -453,54 +961,23 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if colors is None:
             colors = np.array((0, 0, 0))
 
-        self._shapes.append(TriangleStrip(self, vertices, colors=colors, starting_indices=starting_indices))
+        return self._add_shape(TriangleStrip(self, vertices, colors=colors, starting_indices=starting_indices))
 
     def fill_quads(self, vertices, colors=None, texture=None, tex_coords=None, tex_color_blend_mode=GL_MODULATE):
+        # Takes the four corners of each quad, in order around its edge, and one color per quad, per vertex or for the
+        # whole thing. Each quad is drawn as two triangles that share two of the corners through an index buffer, so
+        # the corners (and their colors and texture coordinates) only have to be stored once.
         if not isinstance(vertices, np.ndarray):
             vertices = np.array(vertices)
 
         if vertices.ndim == 1:
             vertices = np.array((vertices, ))
 
-        first_corners = vertices[0::4]
-        second_corners = vertices[1::4]
-        third_corners = vertices[2::4]
-        fourth_corners = vertices[3::4]
-        triangle_vertices = np.empty([vertices.shape[0]*3//2, vertices.shape[1]])
-        triangle_vertices[0::3, :] = first_corners.repeat(2, 0)
-        triangle_vertices[2::3, :] = third_corners.repeat(2, 0)
-        triangle_vertices[1::6, :] = second_corners
-        triangle_vertices[4::6, :] = fourth_corners
-
-        if texture is None:
-            if colors is None:
-                colors = np.array((0, 0, 0))
-            if not isinstance(colors, np.ndarray):
-                colors = np.array(colors)
-
-            if colors.ndim == 2 and len(colors) == len(vertices):
-                # one color per vertex, so colors like the vertices
-                first_corners = colors[0::4]
-                second_corners = colors[1::4]
-                third_corners = colors[2::4]
-                fourth_corners = colors[3::4]
-                triangle_color_vertices = np.empty([colors.shape[0]*3//2, colors.shape[1]])
-                triangle_color_vertices[0::3, :] = first_corners.repeat(2, 0)
-                triangle_color_vertices[2::3, :] = third_corners.repeat(2, 0)
-                triangle_color_vertices[1::6, :] = second_corners
-                triangle_color_vertices[4::6, :] = fourth_corners
-                colors = triangle_color_vertices
-            elif colors.ndim == 2 and len(colors)*4 == len(vertices):
-                # one color per quad, so just repeat each color once since we're getting two triangles
-                colors = colors.repeat(2, 0)
-            elif colors.ndim == 1:
-                # nothing to do here: just one color for the whole thing
-                pass
-            else:
-                raise WrongNumberOfVerticesException
+        if texture is None and colors is None:
+            colors = np.array((0, 0, 0))
+        colors = _get_quad_vertex_colors(vertices, colors)
 
-            self.fill_triangles(triangle_vertices, colors)
-        else:
+        if texture is not None:
             if isinstance(texture, str):
                 if texture not in self.textures:
                     texture = None
@@ -509,17 +986,9 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             if not isinstance(tex_coords, np.ndarray):
                 tex_coords = np.array(tex_coords)
 
-            first_corners = tex_coords[0::4]
-            second_corners = tex_coords[1::4]
-            third_corners = tex_coords[2::4]
-            fourth_corners = tex_coords[3::4]
-            triangle_tex_vertices = np.empty([tex_coords.shape[0]*3//2, tex_coords.shape[1]])
-            triangle_tex_vertices[0::3, :] = first_corners.repeat(2, 0)
-            triangle_tex_vertices[2::3, :] = third_corners.repeat(2, 0)
-            triangle_tex_vertices[1::6, :] = second_corners
-            triangle_tex_vertices[4::6, :] = fourth_corners
-            self.fill_triangles(triangle_vertices, colors=colors, texture=texture, tex_coords=triangle_tex_vertices,
-                                tex_color_blend_mode=tex_color_blend_mode)
+        return self._add_shape(Triangles(self, vertices, colors=colors, texture=texture,
+                                         tex_coords=tex_coords if texture is not None else None,
+                                         tex_color_blend_mode=tex_color_blend_mode, indices=QUAD_TRIANGLE_INDICES))
 
     def draw_quads(self, vertices, colors=None, width=None, texture=None, tex_coords=None):
         if not isinstance(vertices, np.ndarray):
@@ -528,45 +997,17 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if vertices.ndim == 1:
             vertices = np.array((vertices, ))
 
-        first_corners = vertices[0::4]
-        second_corners = vertices[1::4]
-        third_corners = vertices[2::4]
-        fourth_corners = vertices[3::4]
-        line_vertices = np.empty([vertices.shape[0]*2, vertices.shape[1]])
-        line_vertices[0::8, :] = line_vertices[7::8, :] = first_corners
-        line_vertices[1::8, :] = line_vertices[2::8, :] = second_corners
-        line_vertices[3::8, :] = line_vertices[4::8, :] = third_corners
-        line_vertices[5::8, :] = line_vertices[6::8, :] = fourth_corners
-
-        if texture is None:
-            if colors is None:
-                colors = np.array((0, 0, 0))
-            if not isinstance(colors, np.ndarray):
-                colors = np.array(colors)
+        if texture is None and colors is None:
+            colors = np.array((0, 0, 0))
+        colors = _get_quad_vertex_colors(vertices, colors)
 
-            if colors.ndim == 2 and len(colors) == len(vertices):
-                # one color per vertex, so colors like the vertices
-                first_corners = colors[0::4]
-                second_corners = colors[1::4]
-                third_corners = colors[2::4]
-                fourth_corners = colors[3::4]
-                line_color_vertices = np.empty([vertices.shape[0]*2, colors.shape[1]])
-                line_color_vertices[0::8, :] = line_color_vertices[7::8, :] = first_corners
-                line_color_vertices[1::8, :] = line_color_vertices[2::8, :] = second_corners
-                line_color_vertices[3::8, :] = line_color_vertices[4::8, :] = third_corners
-                line_color_vertices[5::8, :] = line_color_vertices[6::8, :] = fourth_corners
-                colors = line_color_vertices
-            elif colors.ndim == 2 and len(colors)*4 == len(vertices):
-                # one color per quad, so just repeat each color once since we're getting four lines
-                colors = colors.repeat(4, 0)
-            elif colors.ndim == 1:
-                # nothing to do here: just one color for the whole thing
-                pass
-            else:
-                raise WrongNumberOfVerticesException
+        if width is not None and texture is None:
+            # thick outlines are built out of quads by draw_lines, which needs each side as a separate line
+            side_indices = QUAD_OUTLINE_INDICES.get_indices(vertices.shape[0] // 4)
+            return self.draw_lines(vertices[side_indices], colors if colors.ndim == 1 else colors[side_indices],
+                                   width=width)
 
-            self.draw_lines(line_vertices, colors, width=width)
-        else:
+        if texture is not None:
             if isinstance(texture, str):
                 if texture not in self.textures:
                     texture = None
@@ -575,20 +1016,23 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             if not isinstance(tex_coords, np.ndarray):
                 tex_coords = np.array(tex_coords)
 
-            first_corners = tex_coords[0::4]
-            second_corners = tex_coords[1::4]
-            third_corners = tex_coords[2::4]
-            fourth_corners = tex_coords[3::4]
-            line_tex_vertices = np.empty([tex_coords.shape[0]*2, tex_coords.shape[1]])
-            line_tex_vertices[0::8, :] = line_tex_vertices[7::8, :] = first_corners
-            line_tex_vertices[1::8, :] = line_tex_vertices[2::8, :] = second_corners
-            line_tex_vertices[3::8, :] = line_tex_vertices[4::8, :] = third_corners
-            line_tex_vertices[5::8, :] = line_tex_vertices[6::8, :] = fourth_corners
-
-            self.draw_lines(line_vertices, texture=texture, tex_coords=line_tex_vertices)
-
-    def draw_image(self, location, texture_name, width=None, height=None, center_anchored=False):
-        if texture_name not in list(self.textures.keys()):
+        # the four sides of each quad, sharing the corners through an index buffer
+        return self._add_shape(Lines(self, vertices, colors=colors, texture=texture,
+                                     tex_coords=tex_coords if texture is not None else None,
+                                     indices=QUAD_OUTLINE_INDICES))
+
+    def draw_image(self, location, texture_name, width=None, height=None, center_anchored=False, instanced=False,
+                   rotations=None, placeholder_color=None):
+        # If instanced is True, location can also be an N x 2 array of locations, and the image is drawn at all of
+        # them with a single instanced draw call, optionally rotated (in radians) around each location.
+        # If the texture hasn't loaded yet (see load_texture), a rectangle of placeholder_color is drawn in its place,
+        # or nothing at all if it's None.
+        if texture_name not in self.textures:
+            if placeholder_color is not None:
+                width = 1.0 if width is None else width
+                height = width if height is None else height
+                self.fill_rects(np.array(location, dtype=float).reshape(-1, 2), (width, height), placeholder_color,
+                                center_anchored=center_anchored)
             return
 
         if width is None:
@@ -602,7 +1046,14 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
                 height = width * self.textures[texture_name].get_current_image().height() / \
                          self.textures[texture_name].get_current_image().width() / self.squash_factor
 
-        if center_anchored:
+        if instanced:
+            locations = np.array(location, dtype=float)
+            if locations.ndim == 1:
+                locations = np.array((locations, ))
+            self._add_shape(InstancedShape(self, self._get_unit_quad_template(center_anchored),
+                                           make_instance_data(locations, (width, height), (1, 1, 1), rotations),
+                                           texture=self.textures[texture_name]))
+        elif center_anchored:
             self.fill_quads(((location[0]-width/2, location[1]-height/2), (location[0]-width/2, location[1]+height/2),
                              (location[0]+width/2, location[1]+height/2), (location[0]+width/2, location[1]-height/2)),
                             colors=(1, 1, 1), texture=texture_name, tex_coords=((0, 0), (0, 1),  (1, 1),  (1, 0)))
@@ -613,7 +1064,13 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         # returns size, if useful
         return width, height
 
-    def fill_rects(self, locations, dimensions, colors, center_anchored=False):
+    def fill_rects(self, locations, dimensions, colors, center_anchored=False, instanced=False, rotations=None,
+                   ids=None):
+        # If instanced is True, the rects are drawn by instancing a single unit quad, so that only a handful of floats
+        # per rect have to be prepared and sent to the gpu. This also allows for rotations (in radians, around each
+        # location). Instancing needs one color per rect or a single color; otherwise we fall back to regular drawing.
+        # If ids are given (a list with one for each rect, or a single one for all of them), the rects can be found
+        # with pick.
         if not isinstance(locations, np.ndarray):
             locations = np.array(locations)
         if not isinstance(dimensions, np.ndarray):
@@ -625,27 +1082,23 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if dimensions.ndim == 1:
             dimensions = np.array((dimensions, ))
 
-        vertices = np.empty((locations.shape[0]*4, 2))
-        if center_anchored:
-            (vertices[0::4])[:, 0] = locations[:, 0] - dimensions[:, 0]/2
-            (vertices[1::4])[:, 0] = locations[:, 0] - dimensions[:, 0]/2
-            (vertices[2::4])[:, 0] = locations[:, 0] + dimensions[:, 0]/2
-            (vertices[3::4])[:, 0] = locations[:, 0] + dimensions[:, 0]/2
-            (vertices[0::4])[:, 1] = locations[:, 1] - dimensions[:, 1]/2
-            (vertices[1::4])[:, 1] = locations[:, 1] + dimensions[:, 1]/2
-            (vertices[2::4])[:, 1] = locations[:, 1] + dimensions[:, 1]/2
-            (vertices[3::4])[:, 1] = locations[:, 1] - dimensions[:, 1]/2
-            self.fill_quads(vertices, colors)
-        else:
-            (vertices[0::4])[:, 0] = locations[:, 0]
-            (vertices[1::4])[:, 0] = locations[:, 0]
-            (vertices[2::4])[:, 0] = locations[:, 0] + dimensions[:, 0]
-            (vertices[3::4])[:, 0] = locations[:, 0] + dimensions[:, 0]
-            (vertices[0::4])[:, 1] = locations[:, 1]
-            (vertices[1::4])[:, 1] = locations[:, 1] + dimensions[:, 1]
-            (vertices[2::4])[:, 1] = locations[:, 1] + dimensions[:, 1]
-            (vertices[3::4])[:, 1] = locations[:, 1]
-            self.fill_quads(vertices, colors)
+        instanced = instanced and (colors.ndim == 1 or colors.shape[0] == locations.shape[0])
+        if ids is not None:
+            corners = get_rect_corners(np.zeros(locations.shape), dimensions, center_anchored).reshape(-1, 4, 2)
+            if instanced and rotations is not None:
+                # turned around the locations, like the instances are
+                rotations = np.broadcast_to(np.asarray(rotations, dtype=np.float32), locations.shape[:1])
+                cosines, sines = np.cos(rotations)[:, np.newaxis], np.sin(rotations)[:, np.newaxis]
+                corners = np.stack((corners[..., 0] * cosines - corners[..., 1] * sines,
+                                    corners[..., 0] * sines + corners[..., 1] * cosines), axis=-1)
+            self._add_pick_targets(PolygonTargets(corners + locations[:, np.newaxis], ids))
+
+        if instanced:
+            self._add_shape(InstancedShape(self, self._get_unit_quad_template(center_anchored),
+                                           make_instance_data(locations, dimensions, colors, rotations)))
+            return
+
+        return self.fill_quads(get_rect_corners(locations, dimensions, center_anchored), colors)
 
     def draw_rects(self, locations, dimensions, colors, width=None, center_anchored=False):
         if not isinstance(locations, np.ndarray):
@@ -659,29 +1112,13 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if dimensions.ndim == 1:
             dimensions = np.array((dimensions, ))
 
-        vertices = np.empty((locations.shape[0]*4, 2))
-        if center_anchored:
-            (vertices[0::4])[:, 0] = locations[:, 0] - dimensions[:, 0]/2
-            (vertices[1::4])[:, 0] = locations[:, 0] - dimensions[:, 0]/2
-            (vertices[2::4])[:, 0] = locations[:, 0] + dimensions[:, 0]/2
-            (vertices[3::4])[:, 0] = locations[:, 0] + dimensions[:, 0]/2
-            (vertices[0::4])[:, 1] = locations[:, 1] - dimensions[:, 1]/2
-            (vertices[1::4])[:, 1] = locations[:, 1] + dimensions[:, 1]/2
-            (vertices[2::4])[:, 1] = locations[:, 1] + dimensions[:, 1]/2
-            (vertices[3::4])[:, 1] = locations[:, 1] - dimensions[:, 1]/2
-            self.draw_quads(vertices, colors, width=width)
-        else:
-            (vertices[0::4])[:, 0] = locations[:, 0]
-            (vertices[1::4])[:, 0] = locations[:, 0]
-            (vertices[2::4])[:, 0] = locations[:, 0] + dimensions[:, 0]
-            (vertices[3::4])[:, 0] = locations[:, 0] + dimensions[:, 0]
-            (vertices[0::4])[:, 1] = locations[:, 1]
-            (vertices[1::4])[:, 1] = locations[:, 1] + dimensions[:, 1]
-            (vertices[2::4])[:, 1] = locations[:, 1] + dimensions[:, 1]
-            (vertices[3::4])[:, 1] = locations[:, 1]
-            self.draw_quads(vertices, colors, width=width)
-
-    def draw_lines(self, vertices, colors, width=None, corner_type=CornerTypes.NONE):
+        return self.draw_quads(get_rect_corners(locations, dimensions, center_anchored), colors, width=width)
+
+    def draw_lines(self, vertices, colors, width=None, corner_type=CornerTypes.NONE, instanced=False, ids=None):
+        # If instanced is True (and there's a width), only the line end points are sent to the gpu, and the lines
+        # shader builds the quads and round caps. Much cheaper for lots of lines, or lines that change every frame.
+        # If ids are given (a list with one for each line, or a single one for all of them), the lines can be found
+        # with pick.
         if not isinstance(vertices, np.ndarray):
             vertices = np.array(vertices)
         if not isinstance(colors, np.ndarray):
@@ -690,6 +1127,9 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if vertices.ndim == 1:
             vertices = np.array((vertices, ))
 
+        if ids is not None:
+            self._add_pick_targets(LineTargets(vertices[0::2], vertices[1::2], width, ids))
+
         if width is not None:
             assert vertices.shape[0] % 2 == 0
             assert colors.shape == (3,) or \
@@ -701,6 +1141,10 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             if colors.ndim == 2 and colors.shape[0]*2 == vertices.shape[0]:
                 colors = colors.repeat(2, axis=0)
 
+            if instanced:
+                self._add_instanced_lines(vertices, colors, width, corner_type, is_strip=False)
+                return
+
             differences = vertices[1:] - vertices[:-1]
             # checks which differences are zero
             # if between the start and end of a single line, remove that line, since it does nothing
@@ -723,7 +1167,7 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             unit_perps = np.column_stack((unit_differences[:, 1], -unit_differences[:, 0]))
 
             vertices = vertices.reshape([vertices.shape[0]*2, 2])
-            quad_vertices = np.empty((vertices.shape[0]*2, vertices.shape[1]))
+            quad_vertices = np.empty((vertices.shape[0]*2, vertices.shape[1]), dtype=np.float32)
             quad_vertices[::4] = vertices[::2] + (unit_perps[:] * width/2)
             quad_vertices[1::4] = vertices[::2] - (unit_perps[:] * width/2)
             quad_vertices[2::4] = vertices[1::2] - (unit_perps[:] * width/2)
@@ -735,14 +1179,14 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             else:
                 quad_colors = colors
             if corner_type == CornerTypes.ROUNDED:
-                self._shapes.append(DepthTestSwitch(self, True))
+                self._add_shape(DepthTestSwitch(self, True))
                 self.fill_quads(quad_vertices, quad_colors)
                 self.fill_arcs(vertices, np.full(vertices.shape[0], width/2), colors)
-                self._shapes.append(DepthTestSwitch(self, False))
+                self._add_shape(DepthTestSwitch(self, False))
             else:
-                self.fill_quads(quad_vertices, quad_colors)
+                return self.fill_quads(quad_vertices, quad_colors)
         else:
-            self._shapes.append(Lines(self, vertices, colors))
+            return self._add_shape(Lines(self, vertices, colors))
 
     def draw_polygons(self, vertices, colors, start_indices=None):
         if not isinstance(vertices, np.ndarray):
@@ -751,9 +1195,13 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             colors = np.array(colors)
         assert vertices.ndim == 2 and vertices.shape[1] == 2
 
-        self._shapes.append(LineLoops(self, vertices, colors, start_indices))
+        return self._add_shape(LineLoops(self, vertices, colors, starting_indices=start_indices))
 
-    def draw_line_strip(self, vertices, colors, width=None, corner_type=CornerTypes.ROUNDED, double_back=True):
+    def draw_line_strip(self, vertices, colors, width=None, corner_type=CornerTypes.ROUNDED, double_back=True,
+                        instanced=False):
+        # If instanced is True (and there's a width), just the points are uploaded, and the lines shader does the
+        # rest: round caps for ROUNDED, miters for FLAT_BRUSH (falling back to square ends at very sharp turns, in
+        # place of the double_back handling). This keeps very long polylines, like time series, cheap to draw.
         if not isinstance(vertices, np.ndarray):
             vertices = np.array(vertices)
         if not isinstance(colors, np.ndarray):
@@ -765,7 +1213,15 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             colors.shape[1] == 3 or colors.shape[1] == 4
 
         if width is not None:
-            if corner_type == CornerTypes.FLAT_BRUSH:
+            if instanced:
+                # repeated points would leave the segments next to them with nothing to miter with, so drop them
+                points_to_keep = np.concatenate(((True, ), (vertices[1:] != vertices[:-1]).any(axis=1)))
+                vertices = vertices[points_to_keep]
+                if colors.ndim == 2:
+                    colors = colors[points_to_keep]
+                if vertices.shape[0] >= 2:
+                    self._add_instanced_lines(vertices, colors, width, corner_type, is_strip=True)
+            elif corner_type == CornerTypes.FLAT_BRUSH:
                 # find differences between vertices
                 differences = vertices[1:] - vertices[:-1]
                 # which are zero?
@@ -824,35 +1280,87 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
 
                 if colors.ndim == 2:
                     tri_strip_colors = np.repeat(colors, 2, axis=0)
-                    self._shapes.append(TriangleStrip(self, tri_strip_vertices, tri_strip_colors))
+                    return self._add_shape(TriangleStrip(self, tri_strip_vertices, tri_strip_colors))
                 else:
-                    self._shapes.append(TriangleStrip(self, tri_strip_vertices, colors))
+                    return self._add_shape(TriangleStrip(self, tri_strip_vertices, colors))
             elif corner_type == CornerTypes.ROUNDED:
                 new_vertices = np.empty(((vertices.shape[0]-1)*2, vertices.shape[1]))
                 new_vertices[0::2] = vertices[:-1]
                 new_vertices[1::2] = vertices[1:]
                 if colors.ndim == 2:
                     new_colors = np.empty(((colors.shape[0]-1)*2, colors.shape[1]))
-                    new_colors[0::2] = new_colors[:-1]
-                    new_colors[1::2] = new_colors[1:]
+                    new_colors[0::2] = colors[:-1]
+                    new_colors[1::2] = colors[1:]
                     self.draw_lines(new_vertices, new_colors, width=width, corner_type=corner_type)
                 else:
                     self.draw_lines(new_vertices, colors, width=width, corner_type=corner_type)
         else:
-            self._shapes.append(LineStrip(self, vertices, colors))
+            return self._add_shape(LineStrip(self, vertices, colors))
+
+    def draw_streaming_line_strip(self, capacity, color=(0, 0, 0), line_width=1, per_vertex_colors=False):
+        """
+        Adds an empty StreamingLineStrip and returns it; points appended to it with its append method join the end of
+        the line, and once there are more than capacity of them, the oldest drop off the start. Appending only costs as
+        much as the points appended, however long the line is, so it suits scrolling plots of live data: append the
+        new samples with their actual x values and move the view along with set_view_bounds, rather than clearing and
+        redrawing everything.
+
+        :param line_width: in pixels
+        """
+        return self._add_shape(StreamingLineStrip(self, capacity, color, line_width=line_width,
+                                                  per_vertex_colors=per_vertex_colors))
 
     def draw_text(self, text, mouse_location, size, color, font_name, styles="",
-                  anchor_type=TextAnchorType.ANCHOR_BOTTOM_LEFT, include_descent_in_height=True):
-        self._shapes.append(TextShape(self, text, mouse_location, size, font_name, color, styles=styles,
-                                      anchor_type=anchor_type, include_descent_in_height=include_descent_in_height))
+                  anchor_type=TextAnchorType.ANCHOR_BOTTOM_LEFT, include_descent_in_height=True,
+                  use_glyph_atlas=False, ids=None):
+        """
+        See TextShape for the meaning of the parameters. If use_glyph_atlas is True, the text is drawn as textured
+        quads from a glyph atlas instead of with a QPainter, which is much faster when there are lots of labels, and
+        lets them batch with other geometry. The quads are laid out in view coordinates using the current view and
+        window size, so (like any other geometry) they scale when zooming; glyphs are rasterized at a fixed set of
+        pixel sizes, so very large text may look a little soft.
+
+        :param ids: if given, an id for the text, so that the box around it (as laid out for the current view and window
+            size) can be found with pick
+        """
+        if not use_glyph_atlas:
+            text_shape = TextShape(self, text, mouse_location, size, font_name, color, styles=styles,
+                                   anchor_type=anchor_type, include_descent_in_height=include_descent_in_height)
+            if ids is not None:
+                self._add_pick_targets(PolygonTargets(_get_box_corners(text_shape.get_view_rect()), ids))
+            self._add_shape(text_shape)
+            return
 
-    def fill_arcs(self, centers, radii, colors, angle_ranges=(0, 2*math.pi), num_segments=100):
+        size = (float(size[0]), float(size[1])) if hasattr(size, "__len__") else float(size)
+        layout = self.glyph_atlases.layout_text(text, font_name, styles.lower(), size,
+                                                self.height() / self.get_view_height(), anchor_type,
+                                                include_descent_in_height)
+        if layout is None:
+            return
+        atlas_page, window_offsets, tex_coords = layout
+        # window offsets are in pixels with y going down; convert to view coordinates around the draw location
+        vertices = np.empty(window_offsets.shape)
+        vertices[:, 0] = mouse_location[0] + window_offsets[:, 0] * self.get_view_width() / self.width()
+        vertices[:, 1] = mouse_location[1] - window_offsets[:, 1] * self.get_view_height() / self.height()
+        if ids is not None:
+            self._add_pick_targets(PolygonTargets(_get_box_corners(get_bounds(vertices)), ids))
+        self.fill_triangles(vertices, colors=np.array(color), texture=atlas_page, tex_coords=tex_coords)
+
+    def fill_arcs(self, centers, radii, colors, angle_ranges=(0, 2*math.pi), num_segments=100, instanced=False,
+                  ids=None):
         # takes a numpy N x 2 numpy array of center locations
         # a N length or N x 2 array of radii ( N x 2 allows for ellipses )
         # a single color, an N x (3 or 4) array of colors for each arc separately,
         #  or a 2*N x (3 or 4) array of inner and outer colors for each arc
         # and either a single angle range (default 0 -> 2*pi draws full circles) or a separate
         # angle range for each arc.
+        # If num_segments is None, the number of segments is chosen separately for each arc based on how big it is on
+        # screen (see set_arc_error_tolerance)
+        # If instanced is True, a single unit arc is uploaded once and drawn for every center, so only a handful of
+        # floats per arc are prepared and sent to the gpu. This works for a single angle range and one color per arc
+        # (or a single color); otherwise we fall back to regular drawing.
+        # If ids are given (a list with one for each arc, or a single one for all of them), the arcs can be found with
+        # pick.
         if not isinstance(centers, np.ndarray):
             centers = np.array(centers, dtype=float)
         if not isinstance(radii, np.ndarray):
@@ -866,7 +1374,7 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         if not isinstance(angle_ranges, np.ndarray):
             angle_ranges = np.array(angle_ranges)
 
-        assert num_segments >= 2
+        assert num_segments is None or num_segments >= 2
 
         if centers.ndim == 1:
             assert centers.shape[0] == 2
@@ -884,44 +1392,55 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
             (colors.shape[0] == centers.shape[0]*2 or
              colors.shape[0] == centers.shape[0])
 
-        # start with all the edges at the centers of each arc
-        edges = centers.repeat(num_segments + 1, axis=0)
-
-        # then calculate the displacements from the centers for each edge point
-        if angle_ranges.ndim == 1:
-            angles = np.linspace(angle_ranges[0], angle_ranges[1], num_segments+1)
-            displacements = np.tile(np.column_stack((np.cos(angles), np.sin(angles))), (centers.shape[0], 1))
-        else:
-            zero_to_one_ramps = np.tile(np.linspace(0, 1, num_segments+1), centers.shape[0])
-            ranges_repeated = angle_ranges.repeat(num_segments+1, axis=0)
-            angles = ranges_repeated[:, 0] * (1-zero_to_one_ramps) + ranges_repeated[:, 1] * zero_to_one_ramps
-            displacements = np.column_stack((np.cos(angles), np.sin(angles)))
-
-        if radii.ndim == 2:
-            edges += radii.repeat(num_segments+1, axis=0)*displacements
-        else:
-            edges += radii.repeat(num_segments+1, axis=0)[:, np.newaxis]*displacements
+        if ids is not None:
+            self._add_pick_targets(ArcTargets(centers, radii if radii.ndim == 2 else np.column_stack((radii, radii)),
+                                              angle_ranges, ids))
+
+        if instanced and angle_ranges.ndim == 1 and (colors.ndim == 1 or colors.shape[0] == centers.shape[0]):
+            if num_segments is None:
+                # one template for everything, so it has to be good enough for the biggest arc
+                num_segments = int(self._get_lod_segment_counts(radii, angle_ranges).max())
+            template_key = ("arc", float(angle_ranges[0]), float(angle_ranges[1]), num_segments)
+            template = self.get_instance_template(
+                template_key, GL_TRIANGLE_FAN, _get_templates_for_angle_ranges(angle_ranges, num_segments,
+                                                                               _get_arc_fractions)[0]
+            )
+            sizes = radii if radii.ndim == 2 else radii[:, np.newaxis]
+            self._add_shape(InstancedShape(self, template, make_instance_data(centers, sizes, colors)))
+            return
 
-        # finally, insert the centers
-        insert_locations = np.arange(0, edges.shape[0], num_segments+1)
+        # each arc is a triangle fan of the center followed by num_segments + 1 edge points; these come from a cached
+        # unit template, scaled by the radii and shifted to the centers in one broadcast operation
+        def get_arc_vertices(which, arc_num_segments):
+            templates = _get_templates_for_angle_ranges(
+                angle_ranges if angle_ranges.ndim == 1 else angle_ranges[which], arc_num_segments, _get_arc_fractions
+            )
+            if radii.ndim == 2:
+                return centers[which, np.newaxis, :] + radii[which, np.newaxis, :] * templates
+            else:
+                return centers[which, np.newaxis, :] + radii[which, np.newaxis, np.newaxis] * templates
 
-        vertices = np.insert(edges, insert_locations, centers, axis=0)
-        if centers.shape[0] == 1:
-            start_indices = None
+        if num_segments is None:
+            segment_counts = self._get_lod_segment_counts(radii, angle_ranges)
         else:
-            start_indices = np.arange(0, vertices.shape[0], num_segments+2)
+            segment_counts = np.full(centers.shape[0], num_segments)
+        vertices, arc_lengths, start_indices = _tessellate_by_segment_count(
+            segment_counts, lambda arc_num_segments: arc_num_segments + 2, get_arc_vertices
+        )
 
         if colors.ndim == 2:
             if colors.shape[0] == centers.shape[0]:
-                new_colors = colors.repeat(num_segments + 2, axis=0)
+                new_colors = colors.repeat(arc_lengths, axis=0)
             elif colors.shape[0] == centers.shape[0]*2:
                 # all but the starting center colors will be the edge colors
-                new_colors = colors[1::2].repeat(num_segments + 2, axis=0)
+                new_colors = colors[1::2].repeat(arc_lengths, axis=0)
                 # the the first color of each circle, however, will be the center color
-                new_colors[0::num_segments + 2] = colors[0::2]
-            self._shapes.append(TriangleFans(self, vertices, new_colors, starting_indices=start_indices))
-        else:
-            self._shapes.append(TriangleFans(self, vertices, colors, starting_indices=start_indices))
+                new_colors[start_indices] = colors[0::2]
+            colors = new_colors
+
+        if centers.shape[0] == 1:
+            start_indices = None
+        return self._add_shape(TriangleFans(self, vertices, colors, starting_indices=start_indices))
 
     def fill_rings(self, centers, inner_radii, outer_radii, colors, angle_ranges=(0, 2*math.pi), num_segments=100):
         # takes a numpy N x 2 numpy array of center locations
@@ -930,6 +1449,8 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         #  or a 2*N x (3 or 4) array of inner and outer colors for each arc
         # and either a single angle range (default 0 -> 2*pi draws full circles) or a separate
         # angle range for each arc.
+        # If num_segments is None, the number of segments is chosen separately for each ring based on how big it is on
+        # screen (see set_arc_error_tolerance)
         if not isinstance(centers, np.ndarray):
             centers = np.array(centers)
         if not isinstance(inner_radii, np.ndarray):
@@ -947,7 +1468,7 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         else:
             assert centers.ndim == 2 and centers.shape[1] == 2
 
-        assert num_segments >= 2
+        assert num_segments is None or num_segments >= 2
 
         if outer_radii.shape[0] == 1:
             outer_radii = outer_radii.repeat(centers.shape[0])
@@ -971,57 +1492,98 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         # outer edges go |__|__|__|__|_|
         # we alternate in-out-in-out
         # so six segments divides it into (6-1)*2+1 = 11 pieces
-        num_piece_subdivisions = (num_segments-1)*2 + 1
 
-        # start with all the edges at the centers of each arc
-        vertices = centers.repeat((num_segments+1)*2, axis=0)
-
-        # then calculate the displacements from the centers for each edge point
-        if angle_ranges.ndim == 1:
-            angles = np.linspace(angle_ranges[0], angle_ranges[1], num_piece_subdivisions+1)
-            angles = np.insert(angles, [0, angles.shape[0]], [angles[0], angles[angles.shape[0]-1]], axis=0)
-            displacements = np.tile(np.column_stack((np.cos(angles), np.sin(angles))), (centers.shape[0], 1))
-        else:
-            zero_to_one_ramps = np.tile(np.linspace(0, 1, num_piece_subdivisions+1), centers.shape[0])
-            ranges_repeated = angle_ranges.repeat(num_piece_subdivisions+1, axis=0)
-            angles = ranges_repeated[:, 0] * (1-zero_to_one_ramps) + ranges_repeated[:, 1] * zero_to_one_ramps
-            # we need to repeat the start and end angles, since both inner and outer edges use both
-            start_angles = np.arange(0, centers.shape[0])*(num_piece_subdivisions+1)
-            end_angles = start_angles + num_piece_subdivisions
-            to_repeat = np.concatenate([start_angles, end_angles])
-            angles =  np.insert(angles, to_repeat, angles[to_repeat])
-            displacements = np.column_stack((np.cos(angles), np.sin(angles)))
-
-        if inner_radii.ndim == 2:
-            vertices[0::2] += inner_radii.repeat(num_segments+1, axis=0)*displacements[0::2]
-        else:
-            vertices[0::2] += inner_radii.repeat(num_segments+1, axis=0)[:, np.newaxis]*displacements[0::2]
+        # the unit displacements come from a cached template, so all that's left is picking the inner or outer radius
+        # for each vertex, and then a broadcast multiply-add
+        def get_ring_vertices(which, ring_num_segments):
+            templates = _get_templates_for_angle_ranges(
+                angle_ranges if angle_ranges.ndim == 1 else angle_ranges[which], ring_num_segments, _get_ring_fractions
+            )
+            # radii for each vertex of each ring, alternating inner, outer, inner, outer...
+            vertex_radii = np.stack([inner_radii[which], outer_radii[which]], axis=1)[
+                :, np.tile([0, 1], ring_num_segments+1)
+            ]
+            if vertex_radii.ndim == 3:
+                return centers[which, np.newaxis, :] + vertex_radii * templates
+            else:
+                return centers[which, np.newaxis, :] + vertex_radii[:, :, np.newaxis] * templates
 
-        if outer_radii.ndim == 2:
-            vertices[1::2] += outer_radii.repeat(num_segments+1, axis=0)*displacements[1::2]
+        if num_segments is None:
+            segment_counts = self._get_lod_segment_counts(outer_radii, angle_ranges)
         else:
-            vertices[1::2] += outer_radii.repeat(num_segments+1, axis=0)[:, np.newaxis]*displacements[1::2]
+            segment_counts = np.full(centers.shape[0], num_segments)
+        vertices, ring_lengths, start_indices = _tessellate_by_segment_count(
+            segment_counts, lambda ring_num_segments: (ring_num_segments+1)*2, get_ring_vertices
+        )
 
         if centers.shape[0] == 1:
             start_indices = None
-        else:
-            start_indices = np.arange(0, vertices.shape[0], (num_segments+1)*2)
 
         if colors.ndim == 2:
             if colors.shape[0] == centers.shape[0]:
-                new_colors = colors.repeat((num_segments+1)*2, axis=0)
+                new_colors = colors.repeat(ring_lengths, axis=0)
             elif colors.shape[0] == centers.shape[0]*2:
+                # every ring has an even number of vertices, so inner and outer alternate all the way through
                 inner_colors = colors[0::2]
                 outer_colors = colors[1::2]
-                inner_colors = inner_colors.repeat(num_segments+1, axis=0)
-                outer_colors = outer_colors.repeat(num_segments+1, axis=0)
+                inner_colors = inner_colors.repeat(ring_lengths // 2, axis=0)
+                outer_colors = outer_colors.repeat(ring_lengths // 2, axis=0)
                 new_colors = np.empty([vertices.shape[0], colors.shape[1]])
                 new_colors[0::2] = inner_colors
                 new_colors[1::2] = outer_colors
 
-            self._shapes.append(TriangleStrip(self, vertices, new_colors, start_indices))
+            return self._add_shape(TriangleStrip(self, vertices, new_colors, starting_indices=start_indices))
+        else:
+            return self._add_shape(TriangleStrip(self, vertices, colors, starting_indices=start_indices))
+
+    def _add_instanced_lines(self, vertices, colors, width, corner_type, is_strip):
+        shape = InstancedLines(self, self._get_line_segment_template(), vertices, colors, width,
+                               _LINE_CORNER_TYPES[corner_type], is_strip)
+        if corner_type == CornerTypes.ROUNDED:
+            # the round caps overlap, so the depth test trick keeps translucent lines from being blended twice there
+            self._add_shape(DepthTestSwitch(self, True))
+            self._add_shape(shape)
+            self._add_shape(DepthTestSwitch(self, False))
         else:
-            self._shapes.append(TriangleStrip(self, vertices, colors, start_indices))
+            self._add_shape(shape)
+
+    def _get_line_segment_template(self):
+        # a quad going from x = 0 at the start of a segment to x = 1 at the end, and from y = -1 to 1 across it
+        return self.get_instance_template("line segment", GL_TRIANGLE_STRIP,
+                                          np.array(((0, -1), (0, 1), (1, -1), (1, 1)), dtype=float))
+
+    def _get_unit_quad_template(self, center_anchored):
+        # a unit square as a triangle strip, either from (0, 0) to (1, 1) or centered on the origin
+        vertices = np.array(((0, 0), (1, 0), (0, 1), (1, 1)), dtype=float)
+        tex_coords = vertices.copy()
+        if center_anchored:
+            vertices -= 0.5
+        return self.get_instance_template(("quad", center_anchored), GL_TRIANGLE_STRIP, vertices, tex_coords)
+
+    def set_arc_error_tolerance(self, tolerance):
+        # the largest distance, in pixels, that the polygon of an arc drawn with num_segments=None is allowed to stray
+        # from the true arc. Smaller is smoother, but takes more vertices.
+        self.arc_error_tolerance = tolerance
+
+    def _get_lod_segment_counts(self, radii, angle_ranges):
+        # Picks a number of segments for each arc based on its radius in pixels, such that the chords never stray
+        # more than arc_error_tolerance pixels from the arc. Counts are rounded up to powers of two, so that there are
+        # only a handful of distinct counts to build.
+        pixels_per_view_unit = self.width() / self.get_view_width()
+        if radii.ndim == 2:
+            window_radii = np.maximum(radii[:, 0], radii[:, 1] * self.squash_factor) * pixels_per_view_unit
+        else:
+            window_radii = radii * max(1.0, self.squash_factor) * pixels_per_view_unit
+        if angle_ranges.ndim == 1:
+            angle_spans = abs(angle_ranges[1] - angle_ranges[0])
+        else:
+            angle_spans = np.abs(angle_ranges[:, 1] - angle_ranges[:, 0])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # a chord spanning angle a strays r * (1 - cos(a/2)) from the arc
+            max_segment_angles = 2 * np.arccos(np.clip(1 - self.arc_error_tolerance / window_radii, -1, 1))
+        segment_counts = np.ceil(angle_spans / np.maximum(max_segment_angles, 1e-6))
+        segment_counts = np.clip(segment_counts, MarcPaintWidget.MIN_LOD_SEGMENTS, MarcPaintWidget.MAX_LOD_SEGMENTS)
+        return (2 ** np.ceil(np.log2(segment_counts))).astype(int)
 
     # ------------------------ User interaction methods to implement ---------------------------
 
@@ -1062,6 +1624,154 @@ class MarcPaintWidget(QtWidgets.QOpenGLWidget):
         pass
 
 
+# unit displacement templates for fill_arcs and fill_rings, keyed on (template type, angle range, num_segments)
+tessellation_template_cache = LRUCache(max_size=256)
+# if there are more distinct angle ranges than this in a single call, caching them is pointless
+_MAX_TEMPLATES_PER_CALL = 64
+# calls with up to this many separate angle ranges look up a template for each, without sorting out the distinct ones
+_MAX_RANGES_LOOKED_UP_ONE_BY_ONE = 16
+
+
+_SHADER_PROGRAM_SOURCES = {
+    "instanced": (INSTANCED_VERTEX_SOURCE, INSTANCED_FRAGMENT_SOURCE, INSTANCE_ATTRIBUTE_LOCATIONS),
+    # the core profile stand-ins for the fixed-function pipeline
+    "flat": (FLAT_VERTEX_SOURCE, FLAT_FRAGMENT_SOURCE, SHAPE_ATTRIBUTE_LOCATIONS),
+    "vertex_color": (VERTEX_COLOR_VERTEX_SOURCE, VERTEX_COLOR_FRAGMENT_SOURCE, SHAPE_ATTRIBUTE_LOCATIONS),
+    "textured": (TEXTURED_VERTEX_SOURCE, TEXTURED_FRAGMENT_SOURCE, SHAPE_ATTRIBUTE_LOCATIONS),
+    "lines": (LINES_VERTEX_SOURCE, LINES_FRAGMENT_SOURCE, LINE_ATTRIBUTE_LOCATIONS),
+}
+
+# how each CornerType is done by the lines shader
+_LINE_CORNER_TYPES = {CornerTypes.NONE: LINE_CORNER_NONE, CornerTypes.ROUNDED: LINE_CORNER_ROUNDED,
+                      CornerTypes.FLAT_BRUSH: LINE_CORNER_MITER}
+
+
+def _get_box_corners(bounds):
+    # the corners of an (x_min, x_max, y_min, y_max) box, as a 1 x 4 x 2 array (for PolygonTargets)
+    x_min, x_max, y_min, y_max = bounds
+    return np.array([((x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min))])
+
+
+def get_rect_corners(locations, dimensions, center_anchored=False):
+    """
+    The corners of rectangles, in the form fill_quads and draw_quads take them (and the shapes returned by fill_rects
+    and draw_rects hold them, e.g. for updating in place)
+
+    :param locations: N x 2 array of bottom left corners, or centers if center_anchored
+    :param dimensions: N x 2 array of (width, height), or anything that broadcasts to it
+    :return: 4N x 2 float32 array
+    """
+    locations = np.asarray(locations, dtype=np.float32).reshape(-1, 2)
+    dimensions = np.broadcast_to(np.asarray(dimensions, dtype=np.float32).reshape(-1, 2), locations.shape)
+    lower_lefts = locations - dimensions / 2 if center_anchored else locations
+    vertices = np.empty((locations.shape[0], 4, 2), dtype=np.float32)
+    vertices[:, 0] = lower_lefts
+    vertices[:, 1, 0] = lower_lefts[:, 0]
+    vertices[:, 1, 1] = lower_lefts[:, 1] + dimensions[:, 1]
+    vertices[:, 2] = lower_lefts + dimensions
+    vertices[:, 3, 0] = lower_lefts[:, 0] + dimensions[:, 0]
+    vertices[:, 3, 1] = lower_lefts[:, 1]
+    return vertices.reshape(-1, 2)
+
+
+def _get_quad_vertex_colors(vertices, colors):
+    # indexed quads need one color per corner (or a single color), so colors given per quad are repeated
+    if colors is None:
+        return None
+    if not isinstance(colors, np.ndarray):
+        colors = np.array(colors)
+    if colors.ndim == 2 and len(colors) == len(vertices):
+        # one color per vertex, so nothing to do
+        return colors
+    elif colors.ndim == 2 and len(colors)*4 == len(vertices):
+        # one color per quad, for each of its corners
+        return colors.repeat(4, 0)
+    elif colors.ndim == 1:
+        # nothing to do here: just one color for the whole thing
+        return colors
+    else:
+        raise WrongNumberOfVerticesException
+
+
+def _tessellate_by_segment_count(segment_counts, get_shape_length, get_vertices):
+    """
+    Builds the vertices of a bunch of round shapes (arcs or rings) that may each have a different number of segments.
+    Shapes with the same count are built together, and then everything is put back in the original order, so that the
+    result can be drawn with a single multi draw call.
+
+    :param segment_counts: the number of segments for each shape
+    :param get_shape_length: function from number of segments to number of vertices in a shape
+    :param get_vertices: function (indices or slice of shapes, number of segments) -> K x shape length x 2 array
+    :return: tuple of (vertices, number of vertices in each shape, starting index of each shape)
+    """
+    unique_counts = np.unique(segment_counts)
+    shape_lengths = get_shape_length(segment_counts)
+    start_indices = np.concatenate([[0], np.cumsum(shape_lengths)[:-1]])
+    if unique_counts.shape[0] == 1:
+        return get_vertices(slice(None), int(unique_counts[0])).reshape(-1, 2), shape_lengths, start_indices
+    vertices = np.empty((shape_lengths.sum(), 2), dtype=np.float32)
+    for num_segments in unique_counts:
+        which = np.flatnonzero(segment_counts == num_segments)
+        group_vertices = get_vertices(which, int(num_segments))
+        positions = start_indices[which, np.newaxis] + np.arange(group_vertices.shape[1])
+        vertices[positions.reshape(-1)] = group_vertices.reshape(-1, 2)
+    return vertices, shape_lengths, start_indices
+
+
+def _get_arc_fractions(num_segments):
+    # how far along its angle range each vertex of an arc's triangle fan is; the first vertex is the center, which
+    # isn't anywhere along the range, so it gets a NaN
+    return np.concatenate([[np.nan], np.linspace(0, 1, num_segments+1)])
+
+
+def _get_ring_fractions(num_segments):
+    # the ring pieces are split as in fill_rings, and both the inner and outer edges use the start and end angles
+    fractions = np.linspace(0, 1, (num_segments-1)*2 + 2)
+    return np.concatenate([fractions[:1], fractions, fractions[-1:]])
+
+
+def _get_unit_displacements(start_angles, end_angles, fractions):
+    # start_angles and end_angles are either floats or N x 1 arrays; NaN fractions become zero displacements. The trig
+    # is done in float32 (which is what the vertices end up in), several times quicker than in float64.
+    angles = (start_angles * (1 - fractions) + end_angles * fractions).astype(np.float32)
+    return np.nan_to_num(np.stack((np.cos(angles), np.sin(angles)), axis=-1))
+
+
+def _get_templates_for_angle_ranges(angle_ranges, num_segments, get_fractions):
+    """
+    :param angle_ranges: either a single (start, end) angle range, or an N x 2 array of them
+    :param get_fractions: _get_arc_fractions or _get_ring_fractions
+    :return: an array of unit displacements that broadcasts against N x 1 x 2 centers; either 1 x M x 2 for a single
+    angle range or N x M x 2 for separate ranges
+    """
+    def get_template(start_angle, end_angle):
+        key = (get_fractions, start_angle, end_angle, num_segments)
+        template = tessellation_template_cache.get(key)
+        if template is None:
+            template = _get_unit_displacements(start_angle, end_angle, get_fractions(num_segments))
+            tessellation_template_cache.put(key, template)
+        return template
+
+    if angle_ranges.ndim == 1:
+        return get_template(float(angle_ranges[0]), float(angle_ranges[1]))[np.newaxis]
+    if angle_ranges.shape[0] <= _MAX_RANGES_LOOKED_UP_ONE_BY_ONE:
+        # for a few arcs, looking up each range is quicker than sorting out the distinct ones
+        return np.stack([get_template(float(start), float(end)) for start, end in angle_ranges])
+    # each (start, end) as one complex number, which np.unique sorts many times quicker than rows
+    range_keys = np.ascontiguousarray(angle_ranges, dtype=np.float64).view(np.complex128).reshape(-1)
+    # if the first few arcs already have too many distinct ranges, so will the lot
+    if np.unique(range_keys[:4 * _MAX_TEMPLATES_PER_CALL]).shape[0] <= _MAX_TEMPLATES_PER_CALL:
+        unique_keys, which_range = np.unique(range_keys, return_inverse=True)
+        if unique_keys.shape[0] == 1:
+            # all the same, so a single template that broadcasts, rather than a copy for each arc
+            return get_template(unique_keys[0].real, unique_keys[0].imag)[np.newaxis]
+        if unique_keys.shape[0] <= _MAX_TEMPLATES_PER_CALL:
+            templates = np.stack([get_template(key.real, key.imag) for key in unique_keys])
+            return np.take(templates, which_range.reshape(-1), axis=0)
+    # too many distinct ranges to bother caching, so just do the trig for all of them
+    return _get_unit_displacements(angle_ranges[:, 0:1], angle_ranges[:, 1:2], get_fractions(num_segments))
+
+
 def get_screen_width():
     return QtWidgets.QDesktopWidget().availableGeometry().width()
 
@@ -1,9 +1,23 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+import copy
+import weakref
 from OpenGL.GL import *
+# PyOpenGL's unwrapped entry points, for the calls made on every paint; they take raw pointers (see array_pointer) and
+# skip the wrapper's argument conversion and error checking
+from OpenGL.raw.GL.VERSION.GL_1_1 import glVertexPointer as raw_glVertexPointer, \
+    glColorPointer as raw_glColorPointer, glTexCoordPointer as raw_glTexCoordPointer, \
+    glDrawElements as raw_glDrawElements
+from OpenGL.raw.GL.VERSION.GL_1_4 import glMultiDrawArrays as raw_glMultiDrawArrays
+from OpenGL.raw.GL.VERSION.GL_1_5 import glBufferData as raw_glBufferData, glBufferSubData as raw_glBufferSubData
 import numpy as np
 from PyQt5.QtGui import QFont, QFontMetricsF, QPainter, QColor
-from PyQt5.QtCore import QRectF
+from PyQt5.QtCore import QRectF, QPointF
 from .image_processing import MarcPyImageHandler
+from .spatial_index import get_bounds, get_element_bounds, union_bounds, pad_bounds, bounds_contain, boxes_intersect
+from .shaders import INSTANCE_ATTRIBUTE_LOCATIONS, INSTANCE_ATTRIBUTE_LAYOUT, INSTANCE_FLOATS, \
+    SHAPE_ATTRIBUTE_LOCATIONS, TEX_ENV_MODE_NUMBERS, LINE_ATTRIBUTE_LOCATIONS, IDENTITY_TEX_TRANSFORM
+import ctypes
 
 from marcpy.utilities import enum
 
@@ -17,15 +31,268 @@ TextAnchorType = enum(ANCHOR_CENTER="anchor center", ANCHOR_CENTER_LEFT="anchor
                       ANCHOR_BOTTOM_RIGHT="anchor bottom right")
 
 
+def get_goal_window_text_size(size, window_units_per_view_unit):
+    # size is either a height or a (width, height) tuple in view coordinates; returns (height, width) in the window
+    goal_view_font_height = size[1] if isinstance(size, tuple) else size
+    goal_view_font_width = size[0] if isinstance(size, tuple) else float("inf")
+    return goal_view_font_height * window_units_per_view_unit, goal_view_font_width * window_units_per_view_unit
+
+
+def make_font(font_name, styles, point_size):
+    font = QFont(font_name)
+    font.setPointSizeF(point_size)
+    if "italic" in styles:
+        font.setItalic(True)
+    if "bold" in styles:
+        font.setBold(True)
+    return font
+
+
+def get_text_anchoring_adjustments(bounding_rect, goal_window_font_width, goal_window_font_height, is_bounding_box,
+                                   anchor_type, include_descent_in_height):
+    """
+    Figures out where to put the text baseline, relative to the draw location, so that the text is anchored properly.
+
+    :param bounding_rect: the tight bounding rect of the text (at its final size), relative to its baseline origin
+    :param goal_window_font_width: the width of the bounding box in window coordinates (inf if there is none)
+    :param goal_window_font_height: the height of the text or the bounding box in window coordinates
+    :param is_bounding_box: whether the size was given as a (width, height) bounding box rather than just a height
+    :param anchor_type: one of the TextAnchorTypes
+    :param include_descent_in_height: see TextShape
+    :return: tuple of (x adjustment, y adjustment) in window coordinates
+    """
+    if include_descent_in_height:
+        x_zeroing_adjustment, y_zeroing_adjustment = -bounding_rect.left(), -bounding_rect.bottom()
+        effective_height = bounding_rect.height()
+    else:
+        x_zeroing_adjustment, y_zeroing_adjustment = -bounding_rect.left(), 0
+        effective_height = bounding_rect.height() - bounding_rect.bottom()
+
+    if anchor_type in (TextAnchorType.ANCHOR_CENTER_TOP, TextAnchorType.ANCHOR_TOP_LEFT,
+                       TextAnchorType.ANCHOR_TOP_RIGHT):
+        # top vertically
+        if is_bounding_box:
+            y_anchoring_adjustment = effective_height - goal_window_font_height
+        else:
+            # point location
+            y_anchoring_adjustment = effective_height
+    elif anchor_type in (TextAnchorType.ANCHOR_CENTER, TextAnchorType.ANCHOR_CENTER_LEFT,
+                         TextAnchorType.ANCHOR_CENTER_RIGHT):
+        # centered vertically
+        if is_bounding_box:
+            y_anchoring_adjustment = (effective_height - goal_window_font_height) / 2
+        else:
+            # point location
+            y_anchoring_adjustment = effective_height / 2
+    else:
+        # (default) bottom vertically
+        y_anchoring_adjustment = 0
+
+    if anchor_type in (TextAnchorType.ANCHOR_TOP_RIGHT, TextAnchorType.ANCHOR_CENTER_RIGHT,
+                       TextAnchorType.ANCHOR_BOTTOM_RIGHT):
+        # right horizontally
+        if is_bounding_box:
+            x_anchoring_adjustment = -bounding_rect.width() + goal_window_font_width
+        else:
+            # point location
+            x_anchoring_adjustment = -bounding_rect.width()
+    elif anchor_type in (TextAnchorType.ANCHOR_CENTER_TOP, TextAnchorType.ANCHOR_CENTER,
+                         TextAnchorType.ANCHOR_CENTER_BOTTOM):
+        # center horizontally
+        if is_bounding_box:
+            x_anchoring_adjustment = (-bounding_rect.width() + goal_window_font_width) / 2
+        else:
+            # point location
+            x_anchoring_adjustment = -bounding_rect.width() / 2
+    else:
+        # (default) left horizontally
+        x_anchoring_adjustment = 0
+
+    return x_zeroing_adjustment + x_anchoring_adjustment, y_zeroing_adjustment + y_anchoring_adjustment
+
+
+class LRUCache:
+    """
+    A least-recently-used cache with a bounded size, that counts its hits and misses. Used for things like fitted text
+    metrics and tessellation templates, which get requested with the same keys frame after frame.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Fitted text metrics, so that drawing the same strings at the same size every frame doesn't redo the two passes of
+# font sizing. Keys are (text, font_name, styles, size, window units per view unit, anchor_type,
+# include_descent_in_height), and values are (font, x adjustment, y adjustment).
+text_metrics_cache = LRUCache(max_size=4096)
+
+
+def get_fitted_text_metrics(text, font_name, styles, size, window_units_per_view_unit, anchor_type,
+                            include_descent_in_height):
+    """
+    Sizes a font so that the text fills the desired height or bounding box, and works out how to anchor it.
+
+    :return: tuple of (QFont at the right point size, x adjustment, y adjustment), the adjustments being in window
+    coordinates relative to the draw location. The returned font is shared, so don't modify it.
+    """
+    key = (text, font_name, styles, size, window_units_per_view_unit, anchor_type, include_descent_in_height)
+    cached = text_metrics_cache.get(key)
+    if cached is not None:
+        return cached
+
+    goal_window_font_height, goal_window_font_width = get_goal_window_text_size(size, window_units_per_view_unit)
+    font = make_font(font_name, styles, goal_window_font_height)
+
+    font_met = QFontMetricsF(font)
+    bounding_rect = font_met.tightBoundingRect(text)
+    effective_height = bounding_rect.height() if include_descent_in_height \
+        else bounding_rect.height() - bounding_rect.bottom()
+    resize_ratio = max(bounding_rect.width() / goal_window_font_width, effective_height / goal_window_font_height)
+    font.setPointSizeF(font.pointSizeF() / resize_ratio)
+
+    # at this point, we should have the font at the right size to fill the desired height or bounding box
+    # recalculate its metrics
+    font_met = QFontMetricsF(font)
+    bounding_rect = font_met.tightBoundingRect(text)
+    assert isinstance(bounding_rect, QRectF)
+    x_adjustment, y_adjustment = get_text_anchoring_adjustments(
+        bounding_rect, goal_window_font_width, goal_window_font_height, isinstance(size, tuple), anchor_type,
+        include_descent_in_height
+    )
+    result = (font, x_adjustment, y_adjustment)
+    text_metrics_cache.put(key, result)
+    return result
+
+
+def as_gl_floats(array):
+    # Geometry is kept in the form GL_FLOAT attribute arrays take: float32 and C-contiguous. Otherwise PyOpenGL quietly
+    # makes a converted copy every time the array is handed over, i.e. on every paint. No copy if it's already right.
+    return np.ascontiguousarray(array, dtype=np.float32)
+
+
+def as_gl_ints(array):
+    # same for the GLint arrays of glMultiDrawArrays
+    return np.ascontiguousarray(array, dtype=np.int32)
+
+
+def array_pointer(array):
+    # A raw pointer to the data of an array made by as_gl_floats or as_gl_ints, for the raw_gl functions. Unlike the
+    # wrapped functions, these don't hold on to the array, so it has to stay alive until the draw call has been made.
+    return ctypes.c_void_p(array.ctypes.data)
+
+
+def as_gl_indices(array, num_vertices):
+    # indices for glDrawElements: 16 bit if the vertices can all be reached that way, which halves the index data
+    return np.ascontiguousarray(array, dtype=np.uint16 if num_vertices <= 65536 else np.uint32)
+
+
+def get_index_type(indices):
+    return GL_UNSIGNED_SHORT if indices.dtype == np.uint16 else GL_UNSIGNED_INT
+
+
+class IndexPattern:
+    """
+    The indices of geometry made of identical pieces, like the two triangles of each quad, where piece k uses the
+    piece indices offset by k times the vertices per piece. The indices for any number of pieces are a slice of one
+    cached array, and in VBO mode all shapes with the same pattern draw from one element buffer that the host widget
+    shares between them (see MarcPaintWidget.get_index_pattern_buffer), so they needn't upload any indices at all.
+    """
+
+    # the cached 32 bit indices grow in steps of at least this many pieces
+    MIN_32_BIT_PIECES = 65536
+
+    def __init__(self, piece_indices, vertices_per_piece):
+        self.piece_indices = np.array(piece_indices, dtype=np.uint32)
+        self.vertices_per_piece = vertices_per_piece
+        # {index dtype: indices for as many pieces as we've needed so far}
+        self._cached_indices = {}
+
+    def get_indices(self, num_pieces):
+        index_dtype = np.dtype(np.uint16 if num_pieces * self.vertices_per_piece <= 65536 else np.uint32)
+        cached_indices = self._cached_indices.get(index_dtype)
+        if cached_indices is None or cached_indices.shape[0] < num_pieces * self.piece_indices.shape[0]:
+            if index_dtype == np.uint16:
+                # all the pieces 16 bits can reach; this is only a few hundred kilobytes
+                num_cached_pieces = 65536 // self.vertices_per_piece
+            else:
+                num_cached_pieces = max(num_pieces, 2 * (0 if cached_indices is None else
+                                                         cached_indices.shape[0] // self.piece_indices.shape[0]),
+                                        IndexPattern.MIN_32_BIT_PIECES)
+            piece_offsets = np.arange(num_cached_pieces, dtype=np.uint32)[:, np.newaxis] * self.vertices_per_piece
+            cached_indices = (piece_offsets + self.piece_indices).reshape(-1).astype(index_dtype)
+            self._cached_indices[index_dtype] = cached_indices
+        return cached_indices[:num_pieces * self.piece_indices.shape[0]]
+
+    def get_cached_indices(self, index_dtype):
+        # all the indices of the given dtype cached so far, which is at least as many as get_indices last returned
+        return self._cached_indices[index_dtype]
+
+
+# quads given as their four corners in order around the edge: two triangles, or the four sides as separate lines
+QUAD_TRIANGLE_INDICES = IndexPattern((0, 1, 2, 0, 3, 2), 4)
+QUAD_OUTLINE_INDICES = IndexPattern((0, 1, 1, 2, 2, 3, 3, 0), 4)
+
+
 class MarcShape(ABC):
 
     def __init__(self, host_widget):
         self.host_widget = host_widget
+        # the ids of the gpu buffers the shape has made (see _add_buffers)
+        self._buffer_ids = _watch_buffers(self, host_widget)
 
     @abstractmethod
     def paint(self):
         pass
 
+    def release_vbos(self):
+        # shapes that keep buffers on the gpu hand them back to the host widget here when they are dropped
+        pass
+
+    def _add_buffers(self, *buffer_ids):
+        # Buffers still listed when the shape is garbage collected are queued for deletion then, so that shapes dropped
+        # without release_vbos (replaced by a subclass, say) don't leak them.
+        self._buffer_ids.extend(buffer_id for buffer_id in buffer_ids if buffer_id is not None)
+
+    def _queue_buffers_for_deletion(self):
+        # buffers can only be deleted with the GL context current, so we hand them to the host widget, which
+        # deletes them at the start of the next paintGL
+        if len(self._buffer_ids) > 0:
+            self.host_widget.queue_buffers_for_deletion(list(self._buffer_ids))
+            self._buffer_ids.clear()
+
+    def get_bounds(self):
+        # (x_min, x_max, y_min, y_max) in view coordinates, for culling shapes that are out of view; None means the
+        # shape is always painted
+        return None
+
+    def get_pixel_padding(self):
+        # how many pixels beyond its bounds the shape can paint, e.g. half the width of wide lines
+        return 0
+
 
 class TextShape(MarcShape):
     def __init__(self, host_widget, text, location, size, font_name, color, styles="",
@@ -66,108 +333,71 @@ class TextShape(MarcShape):
         self.styles = styles.lower()
 
     def set_font_and_position(self):
-        goal_view_font_height = self.size[1] if isinstance(self.size, tuple) else self.size
-        goal_window_font_height = goal_view_font_height / self.host_widget.get_view_height() * self.host_widget.height()
-        goal_view_font_width = self.size[0] if isinstance(self.size, tuple) else float("inf")
-        goal_window_font_width = goal_view_font_width / self.host_widget.get_view_height() * self.host_widget.height()
-
-        self.font = QFont(self.font_name, goal_window_font_height)
-
-        if "italic" in self.styles:
-            self.font.setItalic(True)
-        if "bold" in self.styles:
-            self.font.setBold(True)
-
-        font_met = QFontMetricsF(self.font)
-        bounding_rect = font_met.tightBoundingRect(self.text)
-        effective_height = bounding_rect.height() if self.include_descent_in_height \
-            else bounding_rect.height() - bounding_rect.bottom()
-        resize_ratio = max(bounding_rect.width() / goal_window_font_width, effective_height / goal_window_font_height)
-        self.font.setPointSizeF(self.font.pointSizeF() / resize_ratio)
-
-        # at this point, we should have the font at the right size to fill the desired height or bounding box
-        # recalculate its metrics
-        font_met = QFontMetricsF(self.font)
-        bounding_rect = font_met.tightBoundingRect(self.text)
-        assert isinstance(bounding_rect,QRectF)
+        # the fitted font and anchoring only depend on things that rarely change between frames, so they come out of
+        # the text_metrics_cache; all we really need to recompute is where the location ended up in the window
+        window_units_per_view_unit = self.host_widget.height() / self.host_widget.get_view_height()
+        self.font, x_adjustment, y_adjustment = get_fitted_text_metrics(
+            self.text, self.font_name, self.styles, self.size, window_units_per_view_unit, self.anchor_type,
+            self.include_descent_in_height
+        )
         self.position = self.host_widget.view_to_window(self.view_location)
+        self.position = self.position[0] + x_adjustment, self.position[1] + y_adjustment
 
-        if self.include_descent_in_height:
-            x_zeroing_adjustment, y_zeroing_adjustment = -bounding_rect.left(), -bounding_rect.bottom()
-            effective_height = bounding_rect.height()
-        else:
-            x_zeroing_adjustment, y_zeroing_adjustment = -bounding_rect.left(), 0
-            effective_height = bounding_rect.height() - bounding_rect.bottom()
-
-        if self.anchor_type in (TextAnchorType.ANCHOR_CENTER_TOP, TextAnchorType.ANCHOR_TOP_LEFT,
-                                TextAnchorType.ANCHOR_TOP_RIGHT):
-            # top vertically
-            if hasattr(self.size, "__len__"):
-                y_anchoring_adjustment = effective_height - goal_window_font_height
-            else:
-                # point location
-                y_anchoring_adjustment = effective_height
-        elif self.anchor_type in (TextAnchorType.ANCHOR_CENTER, TextAnchorType.ANCHOR_CENTER_LEFT,
-                                TextAnchorType.ANCHOR_CENTER_RIGHT):
-            # centered vertically
-            if hasattr(self.size, "__len__"):
-                y_anchoring_adjustment = (effective_height - goal_window_font_height) / 2
-            else:
-                # point location
-                y_anchoring_adjustment = effective_height / 2
-        else:
-            # (default) bottom vertically
-            y_anchoring_adjustment = 0
-
-        if self.anchor_type in (TextAnchorType.ANCHOR_TOP_RIGHT, TextAnchorType.ANCHOR_CENTER_RIGHT,
-                                  TextAnchorType.ANCHOR_BOTTOM_RIGHT):
-            # right horizontally
-            if hasattr(self.size, "__len__"):
-                x_anchoring_adjustment = -bounding_rect.width() + goal_window_font_width
-            else:
-                # point location
-                x_anchoring_adjustment = -bounding_rect.width()
-        elif self.anchor_type in (TextAnchorType.ANCHOR_CENTER_TOP, TextAnchorType.ANCHOR_CENTER,
-                                  TextAnchorType.ANCHOR_CENTER_BOTTOM):
-            # center horizontally
-            if hasattr(self.size, "__len__"):
-                x_anchoring_adjustment = (-bounding_rect.width() + goal_window_font_width) / 2
-            else:
-                # point location
-                x_anchoring_adjustment = -bounding_rect.width() / 2
-        else:
-            # (default) left horizontally
-            x_anchoring_adjustment = 0
-
-        self.position = self.position[0] + x_zeroing_adjustment + x_anchoring_adjustment, \
-                        self.position[1] + y_zeroing_adjustment + y_anchoring_adjustment
+    def get_view_rect(self):
+        # (x_min, x_max, y_min, y_max) of the box around the text, in view coordinates, for the current view and size
+        self.set_font_and_position()
+        rect = QFontMetricsF(self.font).tightBoundingRect(self.text)
+        x, y = self.position
+        x_1, y_1 = self.host_widget.window_to_view((x + rect.left(), y + rect.bottom()))
+        x_2, y_2 = self.host_widget.window_to_view((x + rect.right(), y + rect.top()))
+        # (the view can be flipped either way)
+        return min(x_1, x_2), max(x_1, x_2), min(y_1, y_2), max(y_1, y_2)
 
     def paint(self):
         self.set_font_and_position()
-        painter = QPainter(self.host_widget)
+        # QPainter expects to find the default GL state
+        self.host_widget.gl_state.restore_defaults()
+        painter = QPainter(self.host_widget.get_paint_device())
         painter.setPen(QColor(*self.color))
         painter.setFont(self.font)
-        painter.drawText(self.position[0], self.position[1], self.text)
+        painter.drawText(QPointF(*self.position), self.text)
         painter.end()
         # Resets the OpenGL states we need for drawing
-        self.host_widget.initializeGL()
+        self.host_widget.restore_gl_state()
 
 
 class MarcGLShape(MarcShape):
 
     def __init__(self, host_widget, draw_mode, vertices, colors=None, texture=None, tex_coords=None,
-                 tex_color_blend_mode=GL_MODULATE, element_length=1, starting_indices=None):
+                 tex_color_blend_mode=GL_MODULATE, element_length=1, starting_indices=None, indices=None):
         """
         :param vertices: a 2D numpy array of shape [N, 2], where N is a multiple of 3
         :param colors: a 2D numpy array of shape [N, 3] or [N, 4]
         :param texture: a MarcPyImageHandler
         :param tex_coords: The coordinates within the texture, normalized to 0-1 on each axis
         :param tex_color_blend_mode: how texture is blended with color. Generally GL_MODULATE, but could be different
+        :param indices: for indexed geometry, either an array of indices into the vertices, or an IndexPattern that
+            the vertices are whole pieces of. The elements are then made of the indexed vertices, so that vertices
+            shared by several of them only need to be given once; colors have to be one per vertex (or just one).
         """
 
         super().__init__(host_widget)
         assert isinstance(vertices, np.ndarray)
-        assert vertices.shape[0] % element_length == 0 and vertices.shape[1] == 2
+        assert vertices.shape[1] == 2
+        self.index_pattern = None
+        if indices is not None:
+            assert starting_indices is None
+            if isinstance(indices, IndexPattern):
+                assert vertices.shape[0] % indices.vertices_per_piece == 0
+                self.index_pattern = indices
+                indices = indices.get_indices(vertices.shape[0] // indices.vertices_per_piece)
+            else:
+                indices = as_gl_indices(indices, vertices.shape[0])
+            assert indices.shape[0] % element_length == 0
+        else:
+            assert vertices.shape[0] % element_length == 0
+        # per element colors would need vertices of their own, which is what indexing is meant to avoid
+        color_element_length = element_length if indices is None else 1
 
         # if neither a texture not a color is defined, assume black
         if texture is None and colors is None:
@@ -190,14 +420,15 @@ class MarcGLShape(MarcShape):
                 # then we check if colors.shape[0] * element_length == vertices.shape[0]. If variable, like in a
                 # triangle fan using GLMultiDrawArrays, then we check that we have the same number of colors as
                 # we have starting indices
-                assert colors.shape[0] == vertices.shape[0] or colors.shape[0] * element_length == vertices.shape[0] or\
+                assert colors.shape[0] == vertices.shape[0] or \
+                       colors.shape[0] * color_element_length == vertices.shape[0] or \
                        (starting_indices is not None and colors.shape[0] == starting_indices.shape[0])
                 assert colors.shape[1] == 3 or colors.shape[1] == 4
 
                 # one color per shape, with fixed shape length; we need to replicate the vertices
-                if element_length > 1 and colors.shape[0]*element_length == vertices.shape[0]:
-                    colors = np.column_stack([colors] * element_length).reshape(
-                        [colors.shape[0] * element_length, colors.shape[1]]
+                if color_element_length > 1 and colors.shape[0]*color_element_length == vertices.shape[0]:
+                    colors = np.column_stack([colors] * color_element_length).reshape(
+                        [colors.shape[0] * color_element_length, colors.shape[1]]
                     )
 
                 # one color per shape, with a variable shape length; we need to replicate the vertices
@@ -205,6 +436,9 @@ class MarcGLShape(MarcShape):
                     repeats = np.diff(np.concatenate([starting_indices, [vertices.shape[0]]]))
                     colors = colors.repeat(repeats, axis=0)
 
+                # per vertex colors go into an attribute array like the vertices (a single color is set with glColor)
+                colors = as_gl_floats(colors)
+
         elif texture is not None:
             # this is important: if we're using a texture with no color info, we need to make sure the color is
             # changed to black or it might just have a weird color left over
@@ -213,56 +447,570 @@ class MarcGLShape(MarcShape):
         if texture is not None:
             # texture is an image handler (either a MarcPyImage or a MarcpyAnimatedImageHandler)
             assert isinstance(texture, MarcPyImageHandler)
+            tex_coords = as_gl_floats(tex_coords)
         self.texture = texture
 
-        self.vertices = vertices
+        # converted once here, so that painting never has to
+        self.vertices = as_gl_floats(vertices)
         self.colors = colors
         self.element_length = element_length
         self.draw_mode = draw_mode
         self.tex_coords = tex_coords
         self.tex_color_blend_mode = tex_color_blend_mode
-        self.starting_indices = starting_indices
+        self.starting_indices = None if starting_indices is None else as_gl_ints(starting_indices)
+        self.indices = indices
+        # only the line-based subclasses set this; None means we leave the line width alone
+        self.line_width = None
         self.counts = None if self.starting_indices is None \
-            else np.diff(np.concatenate([starting_indices, [vertices.shape[0]]]))
-
-    def paint(self):
-        if self.colors.ndim == 1:
-            if self.colors.shape == (4,):
-                glColor4f(*self.colors)
-            elif self.colors.shape == (3,):
-                glColor3f(*self.colors)
+            else as_gl_ints(np.diff(np.concatenate([starting_indices, [vertices.shape[0]]])))
+
+        # vertex buffer object ids when the host widget is in retained (use_vbos) mode; these are created lazily
+        # during the first paint, since that's the only time we're guaranteed to have a current GL context
+        self.vertex_vbo = None
+        self.color_vbo = None
+        self.tex_coord_vbo = None
+        # an element buffer of our own, for indices that don't follow an IndexPattern
+        self.index_vbo = None
+        # true for shapes that were created by merging several compatible shapes in batch_shapes
+        self.is_batch = False
+        # true for shapes that keep their vbos even if the host widget isn't in use_vbos mode (e.g. in static layers)
+        self.retained = False
+        # for batches of shapes whose textures are different handlers on the same atlas: (texture, first vertex,
+        # number of vertices) for each of them, since each can be on a different frame
+        self.texture_ranges = None
+        # (texture transforms, texture coordinates) for the frames the textures were on when last painted
+        self._frame_tex_coords = None
+        # true once the shape has been changed in place (see update); dynamic shapes always keep their geometry in
+        # vbos, only re-uploading what changed, and are never merged into batches, which would hold copies
+        self.dynamic = False
+        # {array name: [(start, end), ...]}, the rows changed since the vbos were last brought up to date
+        self._updated_ranges = {}
+        # the bounding box of the vertices, and for multi draw shapes, that of each element (made when first needed)
+        self.bounds = None
+        self._bounds_outdated = True
+        self._element_bounds = None
+
+    def batch_key(self):
+        # Shapes with equal batch keys can be concatenated into a single draw call. Single colors have to match
+        # exactly, since they are set with glColor rather than stored per vertex.
+        if self.dynamic:
+            return None
+        if self.colors is None:
+            color_layout = None
+        elif self.colors.ndim == 1:
+            color_layout = ("single", tuple(self.colors.tolist()))
+        else:
+            color_layout = ("per vertex", self.colors.shape[1])
+        return (type(self), self.draw_mode, id(self.texture.get_texture_key()) if self.texture is not None else None,
+                self.tex_color_blend_mode, self.line_width, color_layout, self.indices is not None)
 
-        glEnableClientState(GL_VERTEX_ARRAY)
+    def has_vbos(self):
+        return self.vertex_vbo is not None
 
+    def upload_vbos(self):
+        # copies the geometry into GPU memory once, so that later paints only need to bind and draw
+        usage = GL_DYNAMIC_DRAW if self.dynamic else GL_STATIC_DRAW
+        self.vertex_vbo = _make_static_vbo(self.vertices, usage)
+        if self.colors is not None and self.colors.ndim > 1:
+            self.color_vbo = _make_static_vbo(self.colors, usage)
         if self.texture is not None:
-            tex = self.texture.get_current_opengl_texture()
-            glEnable(GL_TEXTURE_2D)
-            glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-            glTexEnvi(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, self.tex_color_blend_mode)
+            self.tex_coord_vbo = _make_static_vbo(self._get_current_tex_coords()[0], usage)
+        self._updated_ranges = {}
+        if self.indices is not None and self.index_pattern is None:
+            self.index_vbo = glGenBuffers(1)
+            self.host_widget.gl_state.bind_element_array_buffer(self.index_vbo)
+            raw_glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, array_pointer(self.indices), GL_STATIC_DRAW)
+        self._add_buffers(self.vertex_vbo, self.color_vbo, self.tex_coord_vbo, self.index_vbo)
 
-        glVertexPointer(2, GL_FLOAT, 0, self.vertices)
+    # ------------------------------- In place updates --------------------------------
+
+    def update(self, vertices=None, colors=None, tex_coords=None, start=0):
+        """
+        Overwrites part of the shape's geometry in place, e.g. to move the rects of a live plot without clearing and
+        redrawing it. Only the rows that changed are sent to the gpu when the shape is next painted.
+
+        :param vertices: rows to write into the vertices, starting at vertex number start
+        :param colors: rows to write into the per vertex colors, starting at vertex number start, or a new single
+            color. (Switching between a single color and per vertex colors replaces the colors entirely.)
+        :param tex_coords: rows to write into the texture coordinates, starting at vertex number start
+        :param start: the first vertex to overwrite
+        """
+        if vertices is not None:
+            self._write_rows(self.vertices, vertices, start)
+            self.mark_updated(start, start + len(vertices), ("vertices", ))
+        if colors is not None:
+            colors = np.asarray(colors)
+            if colors.ndim == 2 and self.colors.ndim == 2 and colors.shape[1] == self.colors.shape[1]:
+                self._write_rows(self.colors, colors, start)
+                self.mark_updated(start, start + len(colors), ("colors", ))
+            elif colors.ndim == 1 and colors.shape[0] in (3, 4) or \
+                    colors.ndim == 2 and colors.shape[0] == len(self.vertices) and colors.shape[1] in (3, 4):
+                # a new single color, or all new per vertex colors
+                had_color_array = self.colors.ndim > 1
+                self.colors = colors.copy() if colors.ndim == 1 else as_gl_floats(colors).copy()
+                if had_color_array or self.colors.ndim > 1:
+                    # the color buffer has to be made, resized or dropped, so everything gets uploaded again
+                    self.release_vbos()
+                self.mark_updated(0, 0)
+            else:
+                raise ValueError("Colors of shape {} can't be written into colors of shape {} at vertex {}."
+                                 .format(colors.shape, self.colors.shape, start))
+        if tex_coords is not None:
+            if self.tex_coords is None:
+                raise ValueError("This shape has no texture coordinates to update.")
+            self._write_rows(self.tex_coords, tex_coords, start)
+            # the coordinates for the current frame of an animated texture need working out again
+            self._frame_tex_coords = None
+            self.mark_updated(start, start + len(tex_coords), ("tex_coords", ))
+
+    def mark_updated(self, start=0, end=None, array_names=("vertices", "colors", "tex_coords")):
+        """
+        Lets the shape know that rows start to end of its arrays have changed, for when writing straight into
+        shape.vertices (or colors or tex_coords) rather than going through update.
+        """
+        end = len(self.vertices) if end is None else end
+        if not self.dynamic:
+            self.dynamic = True
+            # any batch this shape was merged into has a copy of the old geometry
+            self.host_widget.invalidate_batches_containing(self)
+        if end > start:
+            for array_name in array_names:
+                self._updated_ranges[array_name] = _add_range(self._updated_ranges.get(array_name, []), start, end)
+            if "vertices" in array_names:
+                self._bounds_outdated = True
+                self._element_bounds = None
+        self.host_widget.mark_dirty()
+
+    def get_bounds(self):
+        if self._bounds_outdated:
+            self.bounds = get_bounds(self.vertices)
+            self._bounds_outdated = False
+        return self.bounds
+
+    def get_pixel_padding(self):
+        # lines are line_width pixels wide around their vertices, and points a pixel across
+        if self.line_width is not None:
+            return self.line_width / 2
+        return 0.5 if self.draw_mode == GL_POINTS else 0
+
+    def get_element_bounds(self):
+        # an N x 4 array with the bounds of each element of a multi draw shape (each fan, strip or loop)
+        if self._element_bounds is None:
+            self._element_bounds = get_element_bounds(self.vertices, self.starting_indices)
+        return self._element_bounds
+
+    @staticmethod
+    def _write_rows(target, rows, start):
+        rows = np.asarray(rows)
+        if rows.ndim != 2 or rows.shape[1] != target.shape[1] or start < 0 or start + rows.shape[0] > len(target):
+            raise ValueError("Rows of shape {} don't fit into an array of shape {} at row {}; shapes can be updated "
+                             "in place, but not grown.".format(rows.shape, target.shape, start))
+        target[start:start + rows.shape[0]] = rows
+
+    def _upload_updated_ranges(self):
+        # brings the vbos up to date with glBufferSubData calls covering just the rows that changed
+        gl_state = self.host_widget.gl_state
+        for array_name, ranges in self._updated_ranges.items():
+            if array_name == "vertices":
+                array, vbo = self.vertices, self.vertex_vbo
+            elif array_name == "colors":
+                array, vbo = self.colors, self.color_vbo
+            elif self.texture is not None:
+                array, vbo = self._get_current_tex_coords()[0], self.tex_coord_vbo
+            else:
+                continue
+            if vbo is None:
+                # e.g. a single color, which isn't in a buffer
+                continue
+            gl_state.bind_array_buffer(vbo)
+            row_size = array.strides[0]
+            for start, end in ranges:
+                raw_glBufferSubData(GL_ARRAY_BUFFER, start * row_size, (end - start) * row_size,
+                                    ctypes.c_void_p(array.ctypes.data + start * row_size))
+                gl_state.record_call("glBufferSubData")
+        self._updated_ranges = {}
+
+    def _get_current_tex_coords(self):
+        # Animated images on an atlas show their current frame through a transform of the texture coordinates, so we
+        # keep the transformed coordinates until a frame changes. Returns the coordinates and whether they changed
+        # since the last call.
+        ranges = self.texture_ranges if self.texture_ranges is not None else ((self.texture, 0, len(self.tex_coords)), )
+        transforms = tuple(texture.get_texture_transform() for texture, _, _ in ranges)
+        if transforms[0] is None:
+            return self.tex_coords, False
+        if self._frame_tex_coords is not None and self._frame_tex_coords[0] == transforms:
+            return self._frame_tex_coords[1], False
+        per_vertex_transforms = np.repeat(np.array(transforms, dtype=np.float32), [count for _, _, count in ranges],
+                                          axis=0)
+        tex_coords = self.tex_coords * per_vertex_transforms[:, 2:] + per_vertex_transforms[:, :2]
+        self._frame_tex_coords = (transforms, as_gl_floats(tex_coords))
+        return self._frame_tex_coords[1], True
+
+    def release_vbos(self):
+        self._queue_buffers_for_deletion()
+        self.vertex_vbo = self.color_vbo = self.tex_coord_vbo = self.index_vbo = None
 
+    def paint(self):
+        # all state changes go through the host widget's GLStateCache, so that we only touch what actually differs
+        # from the previous shape. Client states are left enabled for the next shape, and the host widget flushes
+        # once at the end of the frame.
+        if self.host_widget.core_profile:
+            self._paint_with_shaders()
+            return
+
+        gl_state = self.host_widget.gl_state
+        use_vbos = self.host_widget.use_vbos or self.retained or self.dynamic
+        if use_vbos and not self.has_vbos():
+            self.upload_vbos()
+        elif use_vbos and len(self._updated_ranges) > 0:
+            self._upload_updated_ranges()
+        tex_coords, tex_coords_changed = (None, False) if self.texture is None else self._get_current_tex_coords()
+
+        # in case the previous shape was drawn with a shader
+        gl_state.use_program(None)
+        gl_state.set_vertex_attrib_arrays(())
+        uses_color_array = self.colors.ndim > 1
+        gl_state.set_client_states(vertex_array=True, color_array=uses_color_array,
+                                   tex_coord_array=self.texture is not None)
+        if not uses_color_array:
+            gl_state.set_color(self.colors.tolist())
+
+        gl_state.set_capability(GL_TEXTURE_2D, self.texture is not None)
         if self.texture is not None:
-            tex.bind()
-            glTexCoordPointer(2, GL_FLOAT, 0, self.tex_coords)
+            gl_state.bind_texture(self.texture.get_current_opengl_texture())
+            gl_state.set_tex_env_mode(self.tex_color_blend_mode)
 
-        if self.colors is not None and self.colors.ndim > 1:
-            glEnableClientState(GL_COLOR_ARRAY)
-            glColorPointer(self.colors.shape[1], GL_FLOAT, 0, self.colors)
+        if self.line_width is not None:
+            gl_state.set_line_width(self.line_width)
 
-        if self.starting_indices is not None:
-            glMultiDrawArrays(self.draw_mode, self.starting_indices, self.counts, len(self.starting_indices))
+        if use_vbos:
+            gl_state.bind_array_buffer(self.vertex_vbo)
+            glVertexPointer(2, GL_FLOAT, 0, None)
         else:
-            glDrawArrays(self.draw_mode, 0, len(self.vertices))
+            gl_state.bind_array_buffer(0)
+            raw_glVertexPointer(2, GL_FLOAT, 0, array_pointer(self.vertices))
+        gl_state.record_call("glVertexPointer")
 
-        glFlush()
-        glDisableClientState(GL_VERTEX_ARRAY)
+        if self.texture is not None:
+            if use_vbos:
+                gl_state.bind_array_buffer(self.tex_coord_vbo)
+                if tex_coords_changed:
+                    # an animated texture moved on to another frame
+                    raw_glBufferData(GL_ARRAY_BUFFER, tex_coords.nbytes, array_pointer(tex_coords), GL_DYNAMIC_DRAW)
+                    gl_state.record_call("glBufferData")
+                glTexCoordPointer(2, GL_FLOAT, 0, None)
+            else:
+                raw_glTexCoordPointer(2, GL_FLOAT, 0, array_pointer(tex_coords))
+            gl_state.record_call("glTexCoordPointer")
 
-        if self.colors is not None and self.colors.ndim > 1:
-            glDisableClientState(GL_COLOR_ARRAY)
+        if uses_color_array:
+            if use_vbos:
+                gl_state.bind_array_buffer(self.color_vbo)
+                glColorPointer(self.colors.shape[1], GL_FLOAT, 0, None)
+            else:
+                raw_glColorPointer(self.colors.shape[1], GL_FLOAT, 0, array_pointer(self.colors))
+            gl_state.record_call("glColorPointer")
+
+        self._draw(gl_state, use_vbos)
+
+    def _paint_with_shaders(self):
+        # Core profile: there are no client arrays, glColor or glTexEnv, so the geometry always lives in VBOs (whatever
+        # use_vbos says), and color and texturing are done by one of the core shader programs.
+        gl_state = self.host_widget.gl_state
+        if not self.has_vbos():
+            self.upload_vbos()
+        elif len(self._updated_ranges) > 0:
+            self._upload_updated_ranges()
+        tex_coords, tex_coords_changed = (None, False) if self.texture is None else self._get_current_tex_coords()
+
+        uses_color_array = self.colors.ndim > 1
+        if self.texture is not None:
+            program = self.host_widget.get_shader_program("textured")
+        elif uses_color_array:
+            program = self.host_widget.get_shader_program("vertex_color")
+        else:
+            program = self.host_widget.get_shader_program("flat")
+        gl_state.use_program(program)
+        program.set_uniform_matrix("u_projection", self.host_widget.get_projection_matrix())
+
+        position_location = SHAPE_ATTRIBUTE_LOCATIONS["a_position"]
+        color_location = SHAPE_ATTRIBUTE_LOCATIONS["a_color"]
+        tex_coord_location = SHAPE_ATTRIBUTE_LOCATIONS["a_tex_coord"]
+        enabled_locations = [position_location]
+        if uses_color_array:
+            enabled_locations.append(color_location)
+        if self.texture is not None:
+            enabled_locations.append(tex_coord_location)
+        gl_state.set_vertex_attrib_arrays(enabled_locations)
+
+        single_color = None if uses_color_array else tuple(self.colors.tolist())
+        if single_color is not None and len(single_color) == 3:
+            single_color += (1.0, )
+        if self.texture is None:
+            if single_color is not None:
+                program.set_uniform_float("u_color", *single_color)
+        else:
+            gl_state.bind_texture(self.texture.get_current_opengl_texture())
+            program.set_uniform_int("u_texture", 0)
+            program.set_uniform_int("u_tex_env_mode", TEX_ENV_MODE_NUMBERS.get(self.tex_color_blend_mode, 0))
+            if single_color is not None:
+                # a disabled attribute array reads this constant value instead
+                glVertexAttrib4f(color_location, *single_color)
+
+        if self.line_width is not None:
+            gl_state.set_line_width(self.line_width)
+
+        gl_state.bind_array_buffer(self.vertex_vbo)
+        glVertexAttribPointer(position_location, 2, GL_FLOAT, GL_FALSE, 0, None)
+        gl_state.record_call("glVertexAttribPointer")
         if self.texture is not None:
-            glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-            tex.release()
+            gl_state.bind_array_buffer(self.tex_coord_vbo)
+            if tex_coords_changed:
+                raw_glBufferData(GL_ARRAY_BUFFER, tex_coords.nbytes, array_pointer(tex_coords), GL_DYNAMIC_DRAW)
+                gl_state.record_call("glBufferData")
+            glVertexAttribPointer(tex_coord_location, 2, GL_FLOAT, GL_FALSE, 0, None)
+            gl_state.record_call("glVertexAttribPointer")
+        if uses_color_array:
+            gl_state.bind_array_buffer(self.color_vbo)
+            glVertexAttribPointer(color_location, self.colors.shape[1], GL_FLOAT, GL_FALSE, 0, None)
+            gl_state.record_call("glVertexAttribPointer")
+
+        self._draw(gl_state, True)
+
+    def _draw(self, gl_state, use_vbos):
+        if self.indices is not None:
+            if not use_vbos:
+                gl_state.bind_element_array_buffer(0)
+                raw_glDrawElements(self.draw_mode, self.indices.shape[0], get_index_type(self.indices),
+                                   array_pointer(self.indices))
+            else:
+                gl_state.bind_element_array_buffer(
+                    self.index_vbo if self.index_pattern is None
+                    else self.host_widget.get_index_pattern_buffer(self.index_pattern, self.indices)
+                )
+                raw_glDrawElements(self.draw_mode, self.indices.shape[0], get_index_type(self.indices), None)
+            gl_state.record_call("glDrawElements")
+        elif self.starting_indices is not None:
+            starting_indices, counts = self._get_elements_in_view()
+            if len(starting_indices) == 0:
+                return
+            raw_glMultiDrawArrays(self.draw_mode, array_pointer(starting_indices), array_pointer(counts),
+                                  len(starting_indices))
+            gl_state.record_call("glMultiDrawArrays")
+        else:
+            glDrawArrays(self.draw_mode, 0, len(self.vertices))
+            gl_state.record_call("glDrawArrays")
+
+    def _get_elements_in_view(self):
+        # The starting indices and counts of the elements of a multi draw that are in view. Shapes that are only partly
+        # in view (like a batch of arcs spread over a big map) skip the elements that are out of it.
+        cull_bounds = self.host_widget.get_cull_bounds(self.get_pixel_padding())
+        bounds = self.get_bounds()
+        if cull_bounds is None or bounds is None or len(self.starting_indices) < 2 or \
+                bounds_contain(cull_bounds, bounds):
+            return self.starting_indices, self.counts
+        in_view = boxes_intersect(self.get_element_bounds(), cull_bounds)
+        self.host_widget.cull_stats["element_count"] += len(in_view)
+        num_in_view = int(np.count_nonzero(in_view))
+        self.host_widget.cull_stats["culled_element_count"] += len(in_view) - num_in_view
+        if num_in_view == len(in_view):
+            return self.starting_indices, self.counts
+        return self.starting_indices[in_view], self.counts[in_view]
+
+
+# draw modes where each primitive stands on its own, so that concatenating vertex arrays just works
+_INDEPENDENT_PRIMITIVE_MODES = (GL_POINTS, GL_LINES, GL_TRIANGLES)
+
+
+def batch_shapes(shapes):
+    """
+    Merges runs of adjacent MarcGLShapes that share draw mode, texture, line width and color layout, so that each run
+    can be drawn with a single draw call. Painter's order is preserved, since only neighbors are merged, and nothing
+    is merged across other kinds of shapes (like a TextShape or a DepthTestSwitch).
+
+    :param shapes: a list of MarcShapes
+    :return: a new list of MarcShapes, where each run of compatible MarcGLShapes has been replaced by one shape
+    """
+    batches = ShapeBatches()
+    for shape in shapes:
+        batches.add(shape)
+    return batches.get_shapes()
+
+
+class ShapeBatches:
+    """
+    The batches of a list of shapes (see batch_shapes), kept up to date as shapes are added to the end of it, so that
+    adding a shape doesn't mean merging everything again.
+
+    Shapes added since the last get_shapes are merged then, all at once, so a scene that is cleared and drawn again
+    every frame is copied just once per frame. A run of compatible shapes that carries on from one get_shapes to the
+    next (like a plot that gets a few more points every frame) is kept as a few merged chunks, each more than twice
+    the size of the next. New shapes make a chunk of their own, which is merged with the chunks before it that aren't
+    more than twice its size, like the carries of a binary counter. That way each vertex is only copied O(log n)
+    times as the run grows to n vertices, rather than n times by merging the whole run again, and the run still only
+    takes O(log n) draw calls.
+    """
+
+    def __init__(self):
+        # the unmerged shapes and merged chunks to paint, in order
+        self.shapes = []
+        # how many shapes have been added
+        self.num_shapes = 0
+        self._pending_shapes = []
+        # the batch key of the run at the end of self.shapes, and how many chunks of it there are there
+        self._run_key = None
+        self._num_run_chunks = 0
+
+    def add(self, shape):
+        self._pending_shapes.append(shape)
+        self.num_shapes += 1
+
+    def get_shapes(self):
+        # a new list whenever there were shapes to add, so that anything made from the last one can tell
+        if len(self._pending_shapes) > 0:
+            self.shapes = list(self.shapes)
+            pending_shapes, self._pending_shapes = self._pending_shapes, []
+            run = []
+            for shape in pending_shapes:
+                key = shape.batch_key() if isinstance(shape, MarcGLShape) else None
+                if key is None or key != self._run_key:
+                    self._add_chunk(run)
+                    run = []
+                    self._run_key = key
+                    self._num_run_chunks = 0
+                    if key is None:
+                        self.shapes.append(shape)
+                        continue
+                run.append(shape)
+            self._add_chunk(run)
+        return self.shapes
+
+    def release_vbos(self):
+        # the merged chunks are ours, while the rest of the shapes belong to whoever added them
+        for shape in self.shapes:
+            if isinstance(shape, MarcGLShape) and shape.is_batch:
+                shape.release_vbos()
+
+    def _add_chunk(self, run):
+        if len(run) == 0:
+            return
+        num_vertices = sum(shape.vertices.shape[0] for shape in run)
+        while self._num_run_chunks > 0 and self.shapes[-1].vertices.shape[0] <= 2 * num_vertices:
+            previous_chunk = self.shapes.pop()
+            self._num_run_chunks -= 1
+            run.insert(0, previous_chunk)
+            num_vertices += previous_chunk.vertices.shape[0]
+        chunk = _merge_shapes(run)
+        if chunk is not run[0]:
+            for shape in run:
+                if shape.is_batch:
+                    shape.release_vbos()
+        self.shapes.append(chunk)
+        self._num_run_chunks += 1
+
+
+def _merge_shapes(run):
+    if len(run) == 1:
+        return run[0]
+    first = run[0]
+    # copying keeps the class (and hence things like line width handling in paint) of the original shapes
+    merged = copy.copy(first)
+    merged.vertices = np.concatenate([shape.vertices for shape in run])
+    if first.colors is not None and first.colors.ndim > 1:
+        merged.colors = np.concatenate([shape.colors for shape in run])
+    if first.texture is not None:
+        merged.tex_coords = np.concatenate([shape.tex_coords for shape in run])
+        if any(shape.texture is not first.texture or shape.texture_ranges is not None for shape in run):
+            # different handlers on the same atlas, each possibly on a different frame
+            merged.texture_ranges = []
+            vertex_offset = 0
+            for shape in run:
+                shape_ranges = shape.texture_ranges if shape.texture_ranges is not None \
+                    else ((shape.texture, 0, shape.vertices.shape[0]), )
+                merged.texture_ranges.extend((texture, vertex_offset + start, count)
+                                             for texture, start, count in shape_ranges)
+                vertex_offset += shape.vertices.shape[0]
+
+    if first.indices is not None:
+        # (the batch key keeps indexed and unindexed shapes apart)
+        if all(shape.index_pattern is first.index_pattern for shape in run) and first.index_pattern is not None:
+            # the pieces just carry on from one shape to the next
+            merged.indices = first.index_pattern.get_indices(merged.vertices.shape[0] //
+                                                             first.index_pattern.vertices_per_piece)
+        else:
+            merged.index_pattern = None
+            vertex_offsets = np.cumsum([0] + [shape.vertices.shape[0] for shape in run[:-1]])
+            merged.indices = as_gl_indices(np.concatenate([
+                shape.indices.astype(np.uint32) + offset for shape, offset in zip(run, vertex_offsets)
+            ]), merged.vertices.shape[0])
+    elif first.draw_mode in _INDEPENDENT_PRIMITIVE_MODES and all(shape.starting_indices is None for shape in run):
+        merged.starting_indices = merged.counts = None
+    else:
+        # strips, fans and loops can't just be glued together, so each becomes a separate element of a multi draw
+        vertex_offsets = np.cumsum([0] + [shape.vertices.shape[0] for shape in run[:-1]])
+        merged.starting_indices = as_gl_ints(np.concatenate([
+            (np.array([0]) if shape.starting_indices is None else shape.starting_indices) + offset
+            for shape, offset in zip(run, vertex_offsets)
+        ]))
+        merged.counts = as_gl_ints(np.diff(np.concatenate([merged.starting_indices, [merged.vertices.shape[0]]])))
+
+    merged.vertex_vbo = merged.color_vbo = merged.tex_coord_vbo = merged.index_vbo = None
+    # (the copy would otherwise share the buffer list of the first shape)
+    merged._buffer_ids = _watch_buffers(merged, merged.host_widget)
+    merged._frame_tex_coords = None
+    merged._updated_ranges = {}
+    # (worked out from the merged vertices if culling ever needs them)
+    merged.bounds = None
+    merged._bounds_outdated = True
+    merged._element_bounds = None
+    merged.is_batch = True
+    return merged
+
+
+# past this many separate ranges, the closest ones are merged, uploading a few unchanged rows to save on calls
+_MAX_UPDATED_RANGES = 16
+
+
+def _add_range(ranges, start, end):
+    # adds [start, end) to a sorted list of disjoint ranges, merging any that it overlaps or touches
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append((range_start, range_end))
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append((start, end))
+    merged.sort()
+    while len(merged) > _MAX_UPDATED_RANGES:
+        gaps = [merged[i + 1][0] - merged[i][1] for i in range(len(merged) - 1)]
+        i = gaps.index(min(gaps))
+        merged[i:i + 2] = [(merged[i][0], merged[i + 1][1])]
+    return merged
+
+
+def _watch_buffers(shape, host_widget):
+    # The list a shape keeps the ids of its buffers in. Whatever is still in it when the shape is garbage collected
+    # is queued for deletion with the host widget (if that's still around; its context goes with it otherwise).
+    buffer_ids = []
+    finalizer = weakref.finalize(shape, _queue_dropped_buffers, weakref.ref(host_widget), buffer_ids)
+    # at exit, the context is going away anyway
+    finalizer.atexit = False
+    return buffer_ids
+
+
+def _queue_dropped_buffers(host_widget_ref, buffer_ids):
+    host_widget = host_widget_ref()
+    if host_widget is not None and len(buffer_ids) > 0:
+        host_widget.queue_buffers_for_deletion(list(buffer_ids))
+
+
+def _make_static_vbo(array, usage=GL_STATIC_DRAW):
+    vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    array = as_gl_floats(array)
+    raw_glBufferData(GL_ARRAY_BUFFER, array.nbytes, array_pointer(array), usage)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    return vbo
 
 
 class Points(MarcGLShape):
@@ -274,16 +1022,11 @@ class Points(MarcGLShape):
 
 class Lines(MarcGLShape):
     def __init__(self, host_widget, vertices, colors=None, texture=None, tex_coords=None,
-                 tex_color_blend_mode=GL_MODULATE, line_width=1):
+                 tex_color_blend_mode=GL_MODULATE, line_width=1, indices=None):
         super().__init__(host_widget, GL_LINES, vertices, colors=colors, texture=texture, tex_coords=tex_coords,
-                         tex_color_blend_mode=tex_color_blend_mode, element_length=2)
+                         tex_color_blend_mode=tex_color_blend_mode, element_length=2, indices=indices)
         self.line_width = line_width
 
-    def paint(self):
-        glLineWidth(self.line_width)
-        super().paint()
-        glLineWidth(1)
-
 
 class LineStrip(MarcGLShape):
     def __init__(self, host_widget, vertices, colors=None, texture=None, tex_coords=None,
@@ -292,18 +1035,98 @@ class LineStrip(MarcGLShape):
                          tex_color_blend_mode=tex_color_blend_mode)
         self.line_width = line_width
 
-    def paint(self):
-        glLineWidth(self.line_width)
-        super().paint()
-        glLineWidth(1)
+
+class StreamingLineStrip(MarcGLShape):
+    """
+    A line strip through the latest capacity points appended to it, e.g. a scrolling time series. Appending k points
+    costs O(k), however many are shown: the points live in a ring buffer that is written twice over (at i and at
+    i + capacity), so that the visible points are always one contiguous run of rows, drawn straight from the vertex
+    buffer, and only the newly written rows get uploaded.
+    """
+
+    def __init__(self, host_widget, capacity, color=(0, 0, 0), line_width=1, per_vertex_colors=False):
+        """
+        :param capacity: how many of the latest points to keep
+        :param color: the color of the line, or with per_vertex_colors, of points appended without colors
+        :param per_vertex_colors: if True, each appended point can have a color of its own
+        """
+        assert capacity >= 2
+        color = np.asarray(color, dtype=np.float32)
+        colors = np.tile(color, (2 * capacity, 1)) if per_vertex_colors else color
+        super().__init__(host_widget, GL_LINE_STRIP, np.zeros((2 * capacity, 2), dtype=np.float32), colors=colors)
+        self.line_width = line_width
+        self.capacity = capacity
+        self.color = color
+        # the visible points are rows head to head + count of the vertices (and colors)
+        self.head = 0
+        self.count = 0
+        self.dynamic = True
+        # Grows to take in appended points, but doesn't shrink as old points drop off the start, since working it out
+        # again would cost as much as the whole line. (It's only used for culling, so being too big is harmless.)
+        self.bounds = None
+
+    def append(self, points, colors=None):
+        """
+        :param points: an array of shape [k, 2] (or a single point); once there are more than capacity points, the
+            oldest ones drop off the start of the line
+        :param colors: with per_vertex_colors, an array of shape [k, 3 or 4], or a single color for all of them
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        if colors is None:
+            colors = self.color
+        elif self.colors.ndim < 2:
+            raise ValueError("Points can only be given colors of their own with per_vertex_colors=True.")
+        if len(points) > self.capacity:
+            # only the last capacity points would survive anyway
+            points = points[-self.capacity:]
+            colors = colors if np.ndim(colors) < 2 else colors[-self.capacity:]
+        num_points = len(points)
+        if num_points == 0:
+            return
+        end = (self.head + self.count) % self.capacity
+        self._write_ring(self.vertices, "vertices", end, points, num_points)
+        if self.colors.ndim > 1:
+            self._write_ring(self.colors, "colors", end, colors, num_points)
+        self.count = min(self.count + num_points, self.capacity)
+        self.head = (end + num_points - self.count) % self.capacity
+        self.bounds = union_bounds(self.bounds, get_bounds(points))
+
+    def _write_ring(self, array, array_name, end, rows, num_rows):
+        # writes the rows at ring positions end, end + 1, ... in both halves of the array
+        array[end:end + num_rows] = rows
+        first_half_end = min(end + num_rows, self.capacity)
+        array[end + self.capacity:first_half_end + self.capacity] = array[end:first_half_end]
+        wrapped = end + num_rows - self.capacity
+        if wrapped > 0:
+            array[:wrapped] = array[self.capacity:self.capacity + wrapped]
+        self.mark_updated(end, end + num_rows, (array_name, ))
+        self.mark_updated(end + self.capacity, first_half_end + self.capacity, (array_name, ))
+        self.mark_updated(0, wrapped, (array_name, ))
+
+    def get_points(self):
+        # the visible points, oldest first (a view into the ring buffer, so it changes with later appends)
+        return self.vertices[self.head:self.head + self.count]
+
+    def clear(self):
+        self.head = self.count = 0
+        self.bounds = None
+        self.host_widget.mark_dirty()
+
+    def get_bounds(self):
+        return self.bounds
+
+    def _draw(self, gl_state, use_vbos):
+        if self.count >= 2:
+            glDrawArrays(self.draw_mode, self.head, self.count)
+            gl_state.record_call("glDrawArrays")
 
 
 class Triangles(MarcGLShape):
 
     def __init__(self, host_widget, vertices, colors=None, texture=None, tex_coords=None,
-                 tex_color_blend_mode=GL_MODULATE):
+                 tex_color_blend_mode=GL_MODULATE, indices=None):
         super().__init__(host_widget, GL_TRIANGLES, vertices, colors=colors, texture=texture, tex_coords=tex_coords,
-                         tex_color_blend_mode=tex_color_blend_mode, element_length=3)
+                         tex_color_blend_mode=tex_color_blend_mode, element_length=3, indices=indices)
 
 
 class LineLoops(MarcGLShape):
@@ -314,11 +1137,6 @@ class LineLoops(MarcGLShape):
                          tex_color_blend_mode=tex_color_blend_mode, starting_indices=starting_indices)
         self.line_width = line_width
 
-    def paint(self):
-        glLineWidth(self.line_width)
-        super().paint()
-        glLineWidth(1)
-
 
 class TriangleStrip(MarcGLShape):
 
@@ -336,6 +1154,230 @@ class TriangleFans(MarcGLShape):
                          tex_color_blend_mode=tex_color_blend_mode, starting_indices=starting_indices)
 
 
+class InstanceTemplate:
+    """
+    A small mesh (a unit circle, a unit quad...) that is uploaded to the gpu once and then drawn many times by
+    InstancedShapes. The upload happens lazily, the first time it's drawn.
+    """
+
+    def __init__(self, draw_mode, vertices, tex_coords=None):
+        self.draw_mode = draw_mode
+        self.vertices = as_gl_floats(vertices)
+        self.tex_coords = as_gl_floats(np.zeros(vertices.shape) if tex_coords is None else tex_coords)
+        self.num_vertices = vertices.shape[0]
+        self.vertex_vbo = None
+        self.tex_coord_vbo = None
+
+    def bind_attributes(self, gl_state):
+        if self.vertex_vbo is None:
+            self.vertex_vbo = _make_static_vbo(self.vertices)
+            self.tex_coord_vbo = _make_static_vbo(self.tex_coords)
+        for attribute_name, vbo in (("a_position", self.vertex_vbo), ("a_tex_coord", self.tex_coord_vbo)):
+            location = INSTANCE_ATTRIBUTE_LOCATIONS[attribute_name]
+            gl_state.bind_array_buffer(vbo)
+            gl_state.set_vertex_attrib_array(location, True)
+            glVertexAttribPointer(location, 2, GL_FLOAT, GL_FALSE, 0, None)
+            gl_state.record_call("glVertexAttribPointer")
+
+
+class InstancedShape(MarcShape):
+
+    def __init__(self, host_widget, template, instance_data, texture=None):
+        """
+        Draws one copy of the template for each instance, with a single instanced draw call. The template is scaled by
+        the instance size, rotated around its origin, moved to the instance center and colored (modulating the texture,
+        if there is one).
+
+        :param template: an InstanceTemplate (see MarcPaintWidget.get_instance_template)
+        :param instance_data: N x INSTANCE_FLOATS array of (center x, center y, size x, size y, r, g, b, a, rotation)
+        :param texture: a MarcPyImageHandler, or None
+        """
+        super().__init__(host_widget)
+        assert isinstance(template, InstanceTemplate)
+        assert instance_data.ndim == 2 and instance_data.shape[1] == INSTANCE_FLOATS
+        if texture is not None:
+            assert isinstance(texture, MarcPyImageHandler)
+        self.template = template
+        self.instance_data = as_gl_floats(instance_data)
+        self.texture = texture
+        self.instance_vbo = None
+        # each instance fits in a circle around its center, whatever its rotation
+        template_radius = np.hypot(template.vertices[:, 0], template.vertices[:, 1]).max()
+        radii = np.abs(self.instance_data[:, 2:4]).max(axis=1, keepdims=True) * template_radius
+        centers = self.instance_data[:, 0:2]
+        self.bounds = get_bounds(np.concatenate((centers - radii, centers + radii)))
+
+    def get_bounds(self):
+        return self.bounds
+
+    def release_vbos(self):
+        self._queue_buffers_for_deletion()
+        self.instance_vbo = None
+
+    def paint(self):
+        gl_state = self.host_widget.gl_state
+        # the fixed-function client arrays have to be off, since we're using generic vertex attributes
+        gl_state.restore_defaults()
+        if self.instance_vbo is None:
+            self.instance_vbo = _make_static_vbo(self.instance_data)
+            self._add_buffers(self.instance_vbo)
+
+        program = self.host_widget.get_shader_program("instanced")
+        gl_state.use_program(program)
+        program.set_uniform_matrix("u_projection", self.host_widget.get_projection_matrix())
+        program.set_uniform_int("u_use_texture", 0 if self.texture is None else 1)
+        if self.texture is not None:
+            gl_state.bind_texture(self.texture.get_current_opengl_texture())
+            program.set_uniform_int("u_texture", 0)
+            texture_transform = self.texture.get_texture_transform()
+            program.set_uniform_float("u_tex_transform", *(IDENTITY_TEX_TRANSFORM if texture_transform is None
+                                                           else texture_transform))
+
+        self.template.bind_attributes(gl_state)
+        gl_state.bind_array_buffer(self.instance_vbo)
+        stride = INSTANCE_FLOATS * 4
+        instance_locations = []
+        for attribute_name, num_floats, offset in INSTANCE_ATTRIBUTE_LAYOUT:
+            location = INSTANCE_ATTRIBUTE_LOCATIONS[attribute_name]
+            gl_state.set_vertex_attrib_array(location, True)
+            glVertexAttribPointer(location, num_floats, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset * 4))
+            glVertexAttribDivisor(location, 1)
+            gl_state.record_call("glVertexAttribPointer")
+            instance_locations.append(location)
+
+        glDrawArraysInstanced(self.template.draw_mode, 0, self.template.num_vertices, self.instance_data.shape[0])
+        gl_state.record_call("glDrawArraysInstanced")
+
+        # the attribute arrays and program are left for the next shape to switch off (through the GLStateCache), but
+        # the divisors aren't tracked, so they go back to per-vertex
+        for location in instance_locations:
+            glVertexAttribDivisor(location, 0)
+
+
+def make_instance_data(centers, sizes, colors, rotations=None):
+    """
+    Packs per-instance attributes into the layout InstancedShape expects.
+
+    :param centers: N x 2 array
+    :param sizes: N x 2 array (or anything that broadcasts to it)
+    :param colors: a single RGB(A) color or an N x (3 or 4) array of them
+    :param rotations: None, a single angle or N angles in radians
+    """
+    instance_data = np.empty((centers.shape[0], INSTANCE_FLOATS), dtype=np.float32)
+    instance_data[:, 0:2] = centers
+    instance_data[:, 2:4] = sizes
+    colors = np.asarray(colors)
+    instance_data[:, 4:4 + colors.shape[-1]] = colors
+    if colors.shape[-1] == 3:
+        instance_data[:, 7] = 1
+    instance_data[:, 8] = 0 if rotations is None else rotations
+    return instance_data
+
+
+class InstancedLines(MarcShape):
+
+    def __init__(self, host_widget, template, vertices, colors, width, corner_type, is_strip):
+        """
+        Thick lines where only the line points go to the gpu; the lines shader turns each segment into a quad (with
+        round caps or miters, depending on corner_type) using one instance of the template per segment.
+
+        :param template: the unit segment InstanceTemplate (see MarcPaintWidget._get_line_segment_template)
+        :param vertices: N x 2 array; either the points of a line strip, or pairs of points for separate lines
+        :param colors: a single RGB(A) color, or an N x (3 or 4) array with one color per vertex
+        :param width: line width in view units
+        :param corner_type: one of the LINE_CORNER_* values of the lines shader
+        :param is_strip: whether vertices form a single connected line strip
+        """
+        super().__init__(host_widget)
+        assert isinstance(template, InstanceTemplate)
+        colors = as_gl_floats(colors)
+        self.template = template
+        self.width = float(width)
+        self.corner_type = corner_type
+        vertices = as_gl_floats(vertices)
+        if is_strip:
+            # Padded with a repeat of the first and last points, so that instance i can read (prev, p0, p1, next) from
+            # points i to i + 3. The repeated points look like neighbors of length zero, meaning "no neighbor".
+            self.points = np.concatenate((vertices[:1], vertices, vertices[-1:]))
+            if colors.ndim == 2:
+                colors = np.concatenate((colors[:1], colors, colors[-1:]))
+            self.num_instances = vertices.shape[0] - 1
+            self.points_per_instance = 1
+            self.attribute_offsets = {"a_prev": 0, "a_p0": 1, "a_p1": 2, "a_next": 3}
+        else:
+            # each instance reads its own pair of points; prev and next just repeat the ends, so there are no joins
+            self.points = vertices
+            self.num_instances = vertices.shape[0] // 2
+            self.points_per_instance = 2
+            self.attribute_offsets = {"a_prev": 0, "a_p0": 0, "a_p1": 1, "a_next": 1}
+        self.colors = as_gl_floats(colors)
+        self.point_vbo = None
+        self.color_vbo = None
+        # miters can reach out up to twice the width from the line points (see MITER_LIMIT in the lines shader)
+        line_bounds = get_bounds(vertices)
+        self.bounds = None if line_bounds is None else pad_bounds(line_bounds, 2 * self.width)
+
+    def get_bounds(self):
+        return self.bounds
+
+    def release_vbos(self):
+        self._queue_buffers_for_deletion()
+        self.point_vbo = self.color_vbo = None
+
+    def paint(self):
+        if self.num_instances <= 0:
+            return
+        gl_state = self.host_widget.gl_state
+        gl_state.restore_defaults()
+        if self.point_vbo is None:
+            self.point_vbo = _make_static_vbo(self.points)
+            if self.colors.ndim == 2:
+                self.color_vbo = _make_static_vbo(self.colors)
+            self._add_buffers(self.point_vbo, self.color_vbo)
+
+        program = self.host_widget.get_shader_program("lines")
+        gl_state.use_program(program)
+        program.set_uniform_matrix("u_projection", self.host_widget.get_projection_matrix())
+        program.set_uniform_float("u_width", self.width)
+        program.set_uniform_int("u_corner_type", self.corner_type)
+
+        self.template.bind_attributes(gl_state)
+        instance_locations = []
+        stride = self.points_per_instance * 2 * 4
+        gl_state.bind_array_buffer(self.point_vbo)
+        for attribute_name, offset in self.attribute_offsets.items():
+            location = LINE_ATTRIBUTE_LOCATIONS[attribute_name]
+            gl_state.set_vertex_attrib_array(location, True)
+            glVertexAttribPointer(location, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset * 2 * 4))
+            glVertexAttribDivisor(location, 1)
+            gl_state.record_call("glVertexAttribPointer")
+            instance_locations.append(location)
+
+        for attribute_name, point_attribute_name in (("a_color0", "a_p0"), ("a_color1", "a_p1")):
+            location = LINE_ATTRIBUTE_LOCATIONS[attribute_name]
+            if self.colors.ndim == 2:
+                # the colors are laid out just like the points
+                num_floats = self.colors.shape[1]
+                gl_state.bind_array_buffer(self.color_vbo)
+                gl_state.set_vertex_attrib_array(location, True)
+                stride = self.points_per_instance * num_floats * 4
+                offset = self.attribute_offsets[point_attribute_name] * num_floats * 4
+                glVertexAttribPointer(location, num_floats, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+                glVertexAttribDivisor(location, 1)
+                gl_state.record_call("glVertexAttribPointer")
+                instance_locations.append(location)
+            else:
+                gl_state.set_vertex_attrib_array(location, False)
+                color = tuple(self.colors.tolist())
+                glVertexAttrib4f(location, *(color + (1.0, ) if len(color) == 3 else color))
+
+        glDrawArraysInstanced(self.template.draw_mode, 0, self.template.num_vertices, self.num_instances)
+        gl_state.record_call("glDrawArraysInstanced")
+
+        for location in instance_locations:
+            glVertexAttribDivisor(location, 0)
+
+
 class DepthTestSwitch(MarcShape):
     def __init__(self, host_widget, on_or_off, includes_alpha=True):
         super().__init__(host_widget)
@@ -343,8 +1385,6 @@ class DepthTestSwitch(MarcShape):
         self.on_or_off = on_or_off
 
     def paint(self):
+        self.host_widget.gl_state.set_capability(GL_DEPTH_TEST, self.on_or_off)
         if self.on_or_off:
-            glEnable(GL_DEPTH_TEST)
-            glClear(GL_DEPTH_BUFFER_BIT)
-        else:
-            glDisable(GL_DEPTH_TEST)
\ No newline at end of file
+            glClear(GL_DEPTH_BUFFER_BIT)
\ No newline at end of file
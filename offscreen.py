@@ -0,0 +1,170 @@
+from OpenGL.GL import *
+import numpy as np
+from PyQt5.QtGui import QOpenGLContext, QOffscreenSurface, QOpenGLFramebufferObject, QOpenGLFramebufferObjectFormat, \
+    QOpenGLPaintDevice, QSurfaceFormat, QImage
+from PyQt5.QtCore import QSize
+from .marc_paint import MarcPaintWidget
+
+# Headless rendering: an OffscreenMarcPaintWidget takes the same draw and fill calls as a MarcPaintWidget, but paints
+# into a framebuffer object and hands back the pixels, without ever showing a window. This works on servers without a
+# display (QT_QPA_PLATFORM=offscreen), as long as the platform can create OpenGL contexts (Mesa's llvmpipe is fine).
+# A QApplication still has to exist, since the renderer is a QWidget underneath. For example:
+#
+#     app = QtWidgets.QApplication([])
+#     renderer = OffscreenMarcPaintWidget(size=(256, 256))
+#     for i, data in enumerate(datasets):
+#         renderer.clear()
+#         renderer.fill_arcs(data.centers, data.radii, data.colors)
+#         renderer.render_to_file("thumbnail_%d.png" % i)
+#
+# Reusing one renderer (or several renderers sharing an OffscreenContext) keeps the context, framebuffers, shader
+# programs and templates around between images, which is what makes batch exports fast.
+
+
+class OffscreenRenderingError(Exception):
+    pass
+
+
+class OffscreenContext:
+    """
+    An OpenGL context together with an offscreen surface to make it current on. Contexts are expensive to create, so by
+    default all OffscreenMarcPaintWidgets with the same profile share one (see get_shared).
+    """
+
+    _shared_contexts = {}
+
+    def __init__(self, core_profile=False):
+        surface_format = QSurfaceFormat()
+        if core_profile:
+            surface_format.setVersion(3, 3)
+            surface_format.setProfile(QSurfaceFormat.CoreProfile)
+        self.context = QOpenGLContext()
+        self.context.setFormat(surface_format)
+        if not self.context.create():
+            raise OffscreenRenderingError("Could not create an OpenGL context")
+        self.surface = QOffscreenSurface()
+        self.surface.setFormat(self.context.format())
+        self.surface.create()
+        if not self.surface.isValid():
+            raise OffscreenRenderingError("Could not create an offscreen surface")
+
+    @classmethod
+    def get_shared(cls, core_profile=False):
+        if core_profile not in cls._shared_contexts:
+            cls._shared_contexts[core_profile] = cls(core_profile)
+        return cls._shared_contexts[core_profile]
+
+    def make_current(self):
+        if not self.context.makeCurrent(self.surface):
+            raise OffscreenRenderingError("Could not make the offscreen OpenGL context current")
+
+
+class OffscreenMarcPaintWidget(MarcPaintWidget):
+
+    def __init__(self, size=(500, 500), view_bounds=(0, 1, 0, 1), bg_color=(0.0, 0.0, 0.0, 1.0), textures=None,
+                 samples=4, use_vbos=False, batch_shapes=True, core_profile=False, offscreen_context=None):
+        """
+        :param size: (width, height) of the rendered images in pixels
+        :param samples: number of samples per pixel for multisample antialiasing; 0 turns it off
+        :param offscreen_context: an OffscreenContext to render with; by default, the shared one for the profile
+        See MarcPaintWidget for the rest.
+        """
+        super().__init__(title="Offscreen Marc Paint Widget", view_bounds=view_bounds, window_size=size,
+                         bg_color=bg_color, textures=textures, use_vbos=use_vbos, batch_shapes=batch_shapes,
+                         core_profile=core_profile)
+        self.offscreen_context = OffscreenContext.get_shared(core_profile) if offscreen_context is None \
+            else offscreen_context
+        self.samples = samples
+        # the framebuffer we paint into, and (if multisampled) a plain one to resolve it into for reading
+        self._framebuffer = None
+        self._resolve_framebuffer = None
+        self._paint_device = None
+        self._rendered_size = None
+
+    # --------------------------- Standing in for the window ----------------------------
+
+    def context(self):
+        return self.offscreen_context.context
+
+    def makeCurrent(self):
+        self.offscreen_context.make_current()
+
+    def doneCurrent(self):
+        self.offscreen_context.context.doneCurrent()
+
+    def defaultFramebufferObject(self):
+        return 0 if self._framebuffer is None else self._framebuffer.handle()
+
+    def get_paint_device(self):
+        # QPainters (in TextShape) paint into whatever framebuffer is bound, which is ours during render
+        if self._paint_device is None or self._paint_device.size() != self._framebuffer.size():
+            self._paint_device = QOpenGLPaintDevice(self._framebuffer.size())
+        return self._paint_device
+
+    def restore_gl_state(self):
+        # also called by TextShape once its QPainter is done, which may have bound a different framebuffer
+        if self._framebuffer is not None:
+            self._framebuffer.bind()
+        super().restore_gl_state()
+
+    def _get_framebuffer_size(self):
+        # no screen involved, so no device pixel ratio
+        return self.width(), self.height()
+
+    # ------------------------------------ Rendering -------------------------------------
+
+    def set_output_size(self, width, height):
+        # the view bounds follow the widget's resize mode, just like when a window is resized
+        self.resize(int(width), int(height))
+
+    def render(self):
+        """
+        Paints the current shapes and reads back the result.
+
+        :return: a height x width x 4 numpy array of RGBA bytes, with the top row first
+        """
+        width, height = self._get_framebuffer_size()
+        self.offscreen_context.make_current()
+        if self._framebuffer is None or self._framebuffer.size() != QSize(width, height):
+            self._make_framebuffers(width, height)
+        self._framebuffer.bind()
+        glViewport(0, 0, width, height)
+        # done every time, since other renderers sharing the context may have changed its state
+        self.restore_gl_state()
+        if self._rendered_size != (width, height):
+            self.resizeGL(width, height)
+            self._rendered_size = (width, height)
+        # each render is a frame of its own, as far as recording goes (see start_recording)
+        self._painting_animation_frame = True
+        self.paintGL()
+        pixels = self._read_pixels(width, height)
+        self._framebuffer.release()
+        return pixels
+
+    def render_to_file(self, file_path, file_format=None):
+        # file_format is anything QImage can write ("PNG", "JPG"...); by default it goes by the file extension
+        pixels = self.render()
+        height, width = pixels.shape[:2]
+        # the bytes have to outlive the QImage, which doesn't copy them
+        pixel_bytes = pixels.tobytes()
+        image = QImage(pixel_bytes, width, height, width * 4, QImage.Format_RGBA8888)
+        if not image.save(file_path, file_format):
+            raise OffscreenRenderingError("Could not write " + file_path)
+
+    def _make_framebuffers(self, width, height):
+        framebuffer_format = QOpenGLFramebufferObjectFormat()
+        # DepthTestSwitch needs a depth buffer
+        framebuffer_format.setAttachment(QOpenGLFramebufferObject.CombinedDepthStencil)
+        framebuffer_format.setSamples(self.samples)
+        self._framebuffer = QOpenGLFramebufferObject(width, height, framebuffer_format)
+        self._resolve_framebuffer = QOpenGLFramebufferObject(width, height) if self.samples > 0 else None
+
+    def _read_pixels(self, width, height):
+        if self._resolve_framebuffer is not None:
+            # multisampled buffers can't be read directly, so they get resolved into a plain one first
+            QOpenGLFramebufferObject.blitFramebuffer(self._resolve_framebuffer, self._framebuffer)
+            self._resolve_framebuffer.bind()
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE)
+        # GL's rows go from the bottom up
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)[::-1].copy()
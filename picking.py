@@ -0,0 +1,287 @@
+from OpenGL.GL import *
+import numpy as np
+from .spatial_index import SpatialGrid, pad_bounds
+
+# Picking: finding out which drawn items are at a location, e.g. under the mouse. Items drawn with ids (see the ids
+# parameter of fill_rects, fill_arcs, draw_lines, fill_triangles and draw_text) are recorded as PickTargets in the layer
+# they were drawn into, keeping the geometry the way it was given (rects as corners, arcs as centers and radii...) so
+# that each kind can be tested exactly, and all at once with numpy. Each layer keeps a PickIndex, a spatial grid over
+# the bounding boxes of all of its items, so that a pick only has to test the few items near the location.
+#
+# The tests go by the geometry, and don't know about anything drawn over an item. MarcPaintWidget.pick can also render
+# the items into an offscreen buffer, each in a color encoding its number, and read back the pixels around the location,
+# which gives exactly what is visible there, at the cost of a render.
+
+# how many segments the id pass draws arcs with
+ID_PASS_ARC_SEGMENTS = 32
+
+
+class PickTargets:
+    """
+    The items drawn by one draw or fill call, each with an id.
+    """
+
+    def __init__(self, num_items, ids):
+        """
+        :param ids: either a list, tuple or array with an id for each item, or a single id for all of them
+        """
+        self.num_items = num_items
+        if isinstance(ids, (list, tuple)) or isinstance(ids, np.ndarray) and ids.ndim > 0:
+            if len(ids) != num_items:
+                raise ValueError("Got {} ids for {} items; give one id for each item, or a single id that isn't a "
+                                 "list, tuple or array".format(len(ids), num_items))
+            self.ids = list(ids)
+            self.single_id = None
+        else:
+            self.ids = None
+            self.single_id = ids
+
+    def get_id(self, item_number):
+        return self.single_id if self.ids is None else self.ids[item_number]
+
+    def get_boxes(self):
+        # N x 4 array of the bounding box of each item
+        raise NotImplementedError
+
+    def hit_test(self, item_numbers, location, radius, pixel_size):
+        """
+        :param item_numbers: array of the items to test
+        :param location: (x, y) in view coordinates
+        :param radius: how far from the location (in view units) an item can be and still count
+        :param pixel_size: the size of a pixel in view units, for things like thin lines that are drawn in pixels
+        :return: boolean array saying which of the items were hit
+        """
+        raise NotImplementedError
+
+    def get_id_pass_fans(self, pixel_size):
+        # an N x K x 2 array with a polygon for each item, to be drawn as a triangle fan from its first vertex
+        raise NotImplementedError
+
+
+class PolygonTargets(PickTargets):
+    """
+    Convex polygons, all with the same number of vertices: rects (possibly rotated), triangles, the boxes around text.
+    """
+
+    def __init__(self, polygons, ids):
+        """
+        :param polygons: N x K x 2 array of polygon vertices, going around either way
+        """
+        self.polygons = np.asarray(polygons, dtype=np.float64)
+        super().__init__(self.polygons.shape[0], ids)
+
+    def get_boxes(self):
+        boxes = np.empty((self.num_items, 4))
+        boxes[:, 0::2] = self.polygons.min(axis=1)
+        boxes[:, 1::2] = self.polygons.max(axis=1)
+        return boxes
+
+    def hit_test(self, item_numbers, location, radius, pixel_size):
+        polygons = self.polygons[item_numbers]
+        edges = np.roll(polygons, -1, axis=1) - polygons
+        to_location = np.asarray(location, dtype=np.float64) - polygons
+        # which side of each edge the location is on; inside means the same side of all of them
+        crosses = edges[..., 0] * to_location[..., 1] - edges[..., 1] * to_location[..., 0]
+        inside = (crosses >= 0).all(axis=1) | (crosses <= 0).all(axis=1)
+        if radius > 0:
+            inside |= _get_segment_distances(polygons, polygons + edges, location).min(axis=1) <= radius
+        return inside
+
+    def get_id_pass_fans(self, pixel_size):
+        return self.polygons
+
+
+class LineTargets(PickTargets):
+    """
+    Line segments, with a width in view units, or drawn one pixel wide if the width is None.
+    """
+
+    def __init__(self, starts, ends, width, ids):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        self.width = width
+        super().__init__(self.starts.shape[0], ids)
+
+    def _get_half_width(self, pixel_size):
+        # thin lines get a pixel of leeway each side, or they'd be nearly impossible to hit
+        return pixel_size if self.width is None else max(self.width / 2, pixel_size / 2)
+
+    def get_boxes(self):
+        # thin lines are widened by the pixel padding of the grid queries
+        half_width = 0 if self.width is None else self.width / 2
+        boxes = np.empty((self.num_items, 4))
+        boxes[:, 0::2] = np.minimum(self.starts, self.ends) - half_width
+        boxes[:, 1::2] = np.maximum(self.starts, self.ends) + half_width
+        return boxes
+
+    def hit_test(self, item_numbers, location, radius, pixel_size):
+        distances = _get_segment_distances(self.starts[item_numbers], self.ends[item_numbers], location)
+        return distances <= self._get_half_width(pixel_size) + radius
+
+    def get_id_pass_fans(self, pixel_size):
+        differences = self.ends - self.starts
+        lengths = np.hypot(differences[:, 0], differences[:, 1])[:, np.newaxis]
+        perpendiculars = np.column_stack((-differences[:, 1], differences[:, 0])) / np.maximum(lengths, 1e-300)
+        perpendiculars *= self._get_half_width(pixel_size)
+        return np.stack((self.starts + perpendiculars, self.starts - perpendiculars,
+                         self.ends - perpendiculars, self.ends + perpendiculars), axis=1)
+
+
+class ArcTargets(PickTargets):
+    """
+    Filled circles and ellipses, or pie slices of them.
+    """
+
+    def __init__(self, centers, radii, angle_ranges, ids):
+        """
+        :param radii: N x 2 array of (x radius, y radius)
+        :param angle_ranges: a single (start, end) angle range in radians, or an N x 2 array of them
+        """
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.angle_ranges = np.broadcast_to(np.asarray(angle_ranges, dtype=np.float64), self.centers.shape)
+        super().__init__(self.centers.shape[0], ids)
+
+    def get_boxes(self):
+        boxes = np.empty((self.num_items, 4))
+        boxes[:, 0::2] = self.centers - np.abs(self.radii)
+        boxes[:, 1::2] = self.centers + np.abs(self.radii)
+        return boxes
+
+    def hit_test(self, item_numbers, location, radius, pixel_size):
+        offsets = np.asarray(location, dtype=np.float64) - self.centers[item_numbers]
+        radii = np.abs(self.radii[item_numbers])
+        # in units of the (grown) radii, so that ellipses become unit circles
+        scaled = offsets / np.maximum(radii + radius, 1e-300)
+        in_ellipse = scaled[:, 0] ** 2 + scaled[:, 1] ** 2 <= 1
+        # the angle is tested at the location itself, so the radius only widens slices at the rim
+        start_angles = self.angle_ranges[item_numbers].min(axis=1)
+        angle_spans = np.abs(self.angle_ranges[item_numbers, 1] - self.angle_ranges[item_numbers, 0])
+        angles = np.arctan2(offsets[:, 1] / np.maximum(radii[:, 1], 1e-300),
+                            offsets[:, 0] / np.maximum(radii[:, 0], 1e-300))
+        in_slice = (angle_spans >= 2 * np.pi) | (np.mod(angles - start_angles, 2 * np.pi) <= angle_spans) | \
+            (np.hypot(offsets[:, 0], offsets[:, 1]) <= radius)
+        return in_ellipse & in_slice
+
+    def get_id_pass_fans(self, pixel_size):
+        fractions = np.linspace(0, 1, ID_PASS_ARC_SEGMENTS + 1)
+        angles = self.angle_ranges[:, 0:1] * (1 - fractions) + self.angle_ranges[:, 1:2] * fractions
+        rims = self.centers[:, np.newaxis] + self.radii[:, np.newaxis] * np.stack((np.cos(angles), np.sin(angles)),
+                                                                                  axis=-1)
+        return np.concatenate((self.centers[:, np.newaxis], rims), axis=1)
+
+
+class PickIndex:
+    """
+    The PickTargets of a layer, with a SpatialGrid over all of their items that is made when first needed (and made
+    again after more targets are added).
+    """
+
+    def __init__(self):
+        self.targets = []
+        self._grid = None
+        # for each item in the grid, which targets it belongs to and its number within them
+        self._target_numbers = None
+        self._item_numbers = None
+
+    def add(self, targets):
+        self.targets.append(targets)
+        self._grid = None
+
+    def clear(self):
+        self.targets = []
+        self._grid = None
+
+    def get_num_items(self):
+        return sum(targets.num_items for targets in self.targets)
+
+    def _build(self):
+        boxes = [targets.get_boxes() for targets in self.targets]
+        self._grid = SpatialGrid(np.concatenate(boxes) if len(boxes) > 0 else np.empty((0, 4)))
+        self._target_numbers = np.repeat(np.arange(len(self.targets)), [len(target_boxes) for target_boxes in boxes])
+        self._item_numbers = np.concatenate([np.arange(len(target_boxes)) for target_boxes in boxes]) \
+            if len(boxes) > 0 else np.empty(0, dtype=np.int64)
+
+    def pick(self, location, radius, pixel_size):
+        """
+        :return: list of (targets number, item number) for the items hit, the last drawn (topmost) first
+        """
+        if self._grid is None:
+            self._build()
+        # thin lines and the like can reach a little beyond their boxes
+        padding = radius + 2 * pixel_size
+        candidates = self._grid.query(pad_bounds((location[0], location[0], location[1], location[1]), padding))
+        hits = []
+        for target_number in np.unique(self._target_numbers[candidates]):
+            item_numbers = self._item_numbers[candidates[self._target_numbers[candidates] == target_number]]
+            hit_numbers = item_numbers[self.targets[target_number].hit_test(item_numbers, location, radius,
+                                                                             pixel_size)]
+            hits.extend((int(target_number), int(item_number)) for item_number in hit_numbers)
+        hits.reverse()
+        return hits
+
+
+class PickFramebuffer:
+    """
+    The offscreen buffer that items are rendered into for picking on the gpu. It has no multisampling, since the
+    colors at the edges of items have to stay exactly as drawn.
+    """
+
+    def __init__(self):
+        self.framebuffer = None
+        self.renderbuffer = None
+        self.size = None
+
+    def bind(self, width, height):
+        # binds the buffer (made, or made again at a new size, as need be); the GL context must be current
+        if self.size != (width, height):
+            self.release()
+            self.renderbuffer = glGenRenderbuffers(1)
+            glBindRenderbuffer(GL_RENDERBUFFER, self.renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+            glBindRenderbuffer(GL_RENDERBUFFER, 0)
+            self.framebuffer = glGenFramebuffers(1)
+            glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.renderbuffer)
+            self.size = (width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+
+    def release(self):
+        # must be called with the GL context current
+        if self.framebuffer is not None:
+            glDeleteFramebuffers(1, [self.framebuffer])
+            glDeleteRenderbuffers(1, [self.renderbuffer])
+        self.framebuffer = self.renderbuffer = None
+        self.size = None
+
+
+def encode_pick_colors(codes):
+    # RGB colors (as 0-1 floats) spelling out codes 1 to 2^24 - 1 in their bytes; 0 is left for the background
+    codes = np.asarray(codes, dtype=np.int64)
+    return np.stack((codes & 255, (codes >> 8) & 255, (codes >> 16) & 255), axis=-1) / 255.0
+
+
+def decode_pick_colors(pixels):
+    # the codes in an array of RGB(A) bytes
+    pixels = pixels.astype(np.int64)
+    return pixels[..., 0] | (pixels[..., 1] << 8) | (pixels[..., 2] << 16)
+
+
+def get_fan_triangles(fans):
+    # N x K x 2 fans to an (N * (K - 2) * 3) x 2 array of triangle vertices, in order of fan
+    num_fans, fan_length = fans.shape[:2]
+    triangles = np.empty((num_fans, fan_length - 2, 3, 2), dtype=np.float32)
+    triangles[:, :, 0] = fans[:, :1]
+    triangles[:, :, 1] = fans[:, 1:-1]
+    triangles[:, :, 2] = fans[:, 2:]
+    return triangles.reshape(-1, 2)
+
+
+def _get_segment_distances(starts, ends, location):
+    # the distance from location to each of the segments from starts to ends (arrays of any matching shape [..., 2])
+    location = np.asarray(location, dtype=np.float64)
+    segments = ends - starts
+    lengths_squared = (segments ** 2).sum(axis=-1)
+    along = ((location - starts) * segments).sum(axis=-1) / np.maximum(lengths_squared, 1e-300)
+    closest = starts + np.clip(along, 0, 1)[..., np.newaxis] * segments
+    return np.hypot(location[0] - closest[..., 0], location[1] - closest[..., 1])
@@ -0,0 +1,255 @@
+from OpenGL.GL import *
+import numpy as np
+import ctypes
+import os
+import queue
+import subprocess
+import threading
+
+# Recording animations. While a FrameRecorder is attached (see MarcPaintWidget.start_recording), every animation frame
+# is read back into one of two pixel buffer objects. Reading into a PBO doesn't wait for the GPU, and by the time the next
+# frame is painted the previous one has arrived, so we map that buffer and copy it out instead. The copies go on a
+# queue to a background thread, which flips them right side up and hands them to a frame writer (PNG files, or raw
+# frames into a pipe, e.g. to ffmpeg). If the writer can't keep up and the queue fills, frames are dropped (and
+# counted) rather than slowing down the animation.
+
+
+class PngSequenceWriter:
+    """
+    Writes each frame to its own PNG file in a directory. File names are made by formatting file_name_pattern with the
+    frame number, so gaps in the numbering show where frames were dropped.
+    """
+
+    def __init__(self, directory, file_name_pattern="frame_{:06d}.png"):
+        self.directory = directory
+        self.file_name_pattern = file_name_pattern
+        os.makedirs(directory, exist_ok=True)
+
+    def write_frame(self, frame_number, pixels):
+        from PyQt5.QtGui import QImage
+        height, width = pixels.shape[:2]
+        # the bytes have to outlive the QImage, which doesn't copy them
+        pixel_bytes = pixels.tobytes()
+        image = QImage(pixel_bytes, width, height, width * 4, QImage.Format_RGBA8888)
+        image.save(os.path.join(self.directory, self.file_name_pattern.format(frame_number)), "PNG")
+
+    def close(self):
+        pass
+
+
+class RawFramePipeWriter:
+    """
+    Writes the RGBA bytes of each frame, top row first, into a pipe. Either give a command to run with the frames on its
+    standard input, e.g. for an 800 x 600 widget recorded at 30 fps:
+
+        ["ffmpeg", "-f", "rawvideo", "-pix_fmt", "rgba", "-s", "800x600", "-r", "30", "-i", "-", "recording.mp4"]
+
+    or a binary stream to write into (which is left open).
+    """
+
+    def __init__(self, command=None, stream=None):
+        if (command is None) == (stream is None):
+            raise ValueError("Give either a command or a stream")
+        self.process = None if command is None else subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.stream = self.process.stdin if stream is None else stream
+
+    def write_frame(self, frame_number, pixels):
+        self.stream.write(pixels.tobytes())
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        else:
+            self.stream.flush()
+
+
+class FrameRecorder:
+
+    def __init__(self, host_widget, frame_writer, max_queued_frames=16):
+        """
+        :param host_widget: the MarcPaintWidget to record
+        :param frame_writer: has write_frame(frame_number, pixels) and close(); see PngSequenceWriter and
+            RawFramePipeWriter. write_frame is called on the encoder thread with a height x width x 4 array of RGBA
+            bytes, top row first.
+        :param max_queued_frames: how many read back frames can wait for the writer before new ones get dropped
+        """
+        self.host_widget = host_widget
+        self.frame_writer = frame_writer
+        self._frame_queue = queue.Queue(max_queued_frames)
+        self._encoder_error = None
+        self._encoder_thread = threading.Thread(target=self._encode_frames, daemon=True)
+        self._encoder_thread.start()
+
+        # a single sampled framebuffer that the (possibly multisampled) widget framebuffer is resolved into
+        self._resolve_framebuffer = None
+        self._resolve_renderbuffer = None
+        self._resolve_size = None
+        # the two pixel buffers, each remembering its capacity and the frame waiting in it: (width, height, repeats)
+        self._pixel_buffers = None
+        self._next_pixel_buffer = 0
+        # the last frame copied out, for repeating when an animation tick doesn't repaint
+        self._last_pixels = None
+        self._next_frame_number = 0
+        # the size of the recording, set by the first frame; frame writers (like ffmpeg reading raw frames) are set up
+        # for one size, so if the widget changes size, recording stops and the error is raised by stop
+        self.frame_size = None
+        self._size_error = None
+
+        self.captured_frame_count = 0
+        self.repeated_frame_count = 0
+        self.dropped_frame_count = 0
+        self.written_frame_count = 0
+        self.max_queue_depth = 0
+
+    # ------------------------------------ Capturing -------------------------------------
+
+    def capture_frame(self):
+        # called at the end of paintGL, with the frame painted and the context current
+        width, height = self.host_widget._get_framebuffer_size()
+        if self.frame_size is None:
+            self.frame_size = (width, height)
+        elif (width, height) != self.frame_size:
+            if self._size_error is None:
+                self._size_error = RuntimeError("The widget changed size from {} x {} to {} x {} while recording; the "
+                                                "recording stops after {} frames".format(
+                                                    *self.frame_size, width, height,
+                                                    self.captured_frame_count + self.repeated_frame_count))
+            return
+        widget_framebuffer = self.host_widget.defaultFramebufferObject()
+        if self._resolve_size != (width, height):
+            self._allocate_resolve_framebuffer(width, height)
+        if self._pixel_buffers is None:
+            self._pixel_buffers = [{"buffer": buffer, "capacity": 0, "frame": None}
+                                   for buffer in glGenBuffers(2)]
+
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, widget_framebuffer)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._resolve_framebuffer)
+        glBlitFramebuffer(0, 0, width, height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self._resolve_framebuffer)
+
+        pixel_buffer = self._pixel_buffers[self._next_pixel_buffer]
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixel_buffer["buffer"])
+        if pixel_buffer["capacity"] < width * height * 4:
+            glBufferData(GL_PIXEL_PACK_BUFFER, width * height * 4, None, GL_STREAM_READ)
+            pixel_buffer["capacity"] = width * height * 4
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        # with a pack buffer bound, this returns right away and the GPU fills the buffer in its own time
+        glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        pixel_buffer["frame"] = (width, height, 0)
+        self.captured_frame_count += 1
+
+        # meanwhile, the other buffer has had a whole frame to fill up
+        self._next_pixel_buffer = 1 - self._next_pixel_buffer
+        self._collect(self._pixel_buffers[self._next_pixel_buffer])
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, widget_framebuffer)
+
+    def repeat_frame(self):
+        # an animation tick that didn't need repainting still takes up a frame of the recording
+        if self._size_error is not None:
+            return
+        self.repeated_frame_count += 1
+        if self._pixel_buffers is not None:
+            waiting_frame = self._pixel_buffers[1 - self._next_pixel_buffer]["frame"]
+            if waiting_frame is not None:
+                width, height, repeats = waiting_frame
+                self._pixel_buffers[1 - self._next_pixel_buffer]["frame"] = (width, height, repeats + 1)
+                return
+        if self._last_pixels is not None:
+            self._enqueue(self._last_pixels)
+
+    def _collect(self, pixel_buffer):
+        if pixel_buffer["frame"] is None:
+            return
+        width, height, repeats = pixel_buffer["frame"]
+        pixel_buffer["frame"] = None
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixel_buffer["buffer"])
+        pixels = np.empty(width * height * 4, dtype=np.uint8)
+        address = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        ctypes.memmove(pixels.ctypes.data, address, pixels.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        # still bottom row first; the encoder thread flips it
+        self._last_pixels = pixels.reshape(height, width, 4)
+        for _ in range(1 + repeats):
+            self._enqueue(self._last_pixels)
+
+    def _enqueue(self, pixels):
+        frame_number = self._next_frame_number
+        self._next_frame_number += 1
+        try:
+            self._frame_queue.put_nowait((frame_number, pixels))
+        except queue.Full:
+            self.dropped_frame_count += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._frame_queue.qsize())
+
+    def _allocate_resolve_framebuffer(self, width, height):
+        self._release_resolve_framebuffer()
+        self._resolve_renderbuffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self._resolve_renderbuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        self._resolve_framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self._resolve_framebuffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self._resolve_renderbuffer)
+        self._resolve_size = (width, height)
+
+    def _release_resolve_framebuffer(self):
+        if self._resolve_framebuffer is not None:
+            glDeleteFramebuffers(1, [self._resolve_framebuffer])
+            glDeleteRenderbuffers(1, [self._resolve_renderbuffer])
+        self._resolve_framebuffer = self._resolve_renderbuffer = self._resolve_size = None
+
+    # ------------------------------------- Encoding -------------------------------------
+
+    def _encode_frames(self):
+        while True:
+            item = self._frame_queue.get()
+            if item is None:
+                break
+            if self._encoder_error is not None:
+                # the writer is broken, so we just keep the queue moving until we're stopped
+                continue
+            frame_number, pixels = item
+            try:
+                self.frame_writer.write_frame(frame_number, pixels[::-1])
+                self.written_frame_count += 1
+            except Exception as error:
+                self._encoder_error = error
+
+    # -------------------------------------- Stopping -------------------------------------
+
+    def stop(self):
+        """
+        Collects the frame still waiting on the GPU, waits for the writer to finish everything queued, and frees the
+        GL objects. Must be called with the GL context current.
+
+        :return: the recording statistics (see get_stats)
+        """
+        if self._pixel_buffers is not None:
+            self._collect(self._pixel_buffers[1 - self._next_pixel_buffer])
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            glDeleteBuffers(2, [pixel_buffer["buffer"] for pixel_buffer in self._pixel_buffers])
+            self._pixel_buffers = None
+        self._release_resolve_framebuffer()
+        glBindFramebuffer(GL_FRAMEBUFFER, self.host_widget.defaultFramebufferObject())
+        # the end marker must not be dropped, so this one waits for room
+        self._frame_queue.put(None)
+        self._encoder_thread.join()
+        self.frame_writer.close()
+        if self._encoder_error is not None:
+            raise self._encoder_error
+        if self._size_error is not None:
+            raise self._size_error
+        return self.get_stats()
+
+    def get_stats(self):
+        return {
+            "captured_frames": self.captured_frame_count,
+            "repeated_frames": self.repeated_frame_count,
+            "dropped_frames": self.dropped_frame_count,
+            "written_frames": self.written_frame_count,
+            "queue_depth": self._frame_queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+        }
@@ -0,0 +1,365 @@
+from OpenGL.GL import *
+import numpy as np
+
+# Small helpers for the parts of marqt that draw with shaders rather than the fixed-function pipeline. Shader sources
+# are written once, using a few macros (ATTRIBUTE, VARYING, FRAG_COLOR, TEXTURE2D), and get a header that makes them
+# either GLSL 1.20 (for the usual compatibility contexts, including the legacy contexts on macOS) or GLSL 3.30 core.
+
+_COMPATIBILITY_VERTEX_HEADER = """#version 120
+#define ATTRIBUTE attribute
+#define VARYING varying
+"""
+
+_COMPATIBILITY_FRAGMENT_HEADER = """#version 120
+#define VARYING varying
+#define FRAG_COLOR gl_FragColor
+#define TEXTURE2D texture2D
+"""
+
+_CORE_VERTEX_HEADER = """#version 330 core
+#define ATTRIBUTE in
+#define VARYING out
+"""
+
+_CORE_FRAGMENT_HEADER = """#version 330 core
+#define VARYING in
+#define TEXTURE2D texture
+out vec4 frag_color;
+#define FRAG_COLOR frag_color
+"""
+
+
+class ShaderCompilationError(Exception):
+    pass
+
+
+class ShaderProgram:
+
+    def __init__(self, vertex_source, fragment_source, attribute_locations, core_profile=False):
+        """
+        Compiles and links a program. Must be called with the GL context current (i.e. during painting).
+
+        :param vertex_source: vertex shader source, without the #version line
+        :param fragment_source: fragment shader source, without the #version line
+        :param attribute_locations: dict of {attribute name: location}, bound before linking so that all programs
+        agree on where things go
+        :param core_profile: whether to compile as GLSL 3.30 core rather than GLSL 1.20
+        """
+        self.core_profile = core_profile
+        vertex_header = _CORE_VERTEX_HEADER if core_profile else _COMPATIBILITY_VERTEX_HEADER
+        fragment_header = _CORE_FRAGMENT_HEADER if core_profile else _COMPATIBILITY_FRAGMENT_HEADER
+        vertex_shader = _compile_shader(GL_VERTEX_SHADER, vertex_header + vertex_source)
+        fragment_shader = _compile_shader(GL_FRAGMENT_SHADER, fragment_header + fragment_source)
+
+        self.program_id = glCreateProgram()
+        glAttachShader(self.program_id, vertex_shader)
+        glAttachShader(self.program_id, fragment_shader)
+        for attribute_name, location in attribute_locations.items():
+            glBindAttribLocation(self.program_id, location, attribute_name)
+        glLinkProgram(self.program_id)
+        # once linked, the program holds on to what it needs
+        glDeleteShader(vertex_shader)
+        glDeleteShader(fragment_shader)
+        if glGetProgramiv(self.program_id, GL_LINK_STATUS) != GL_TRUE:
+            log = glGetProgramInfoLog(self.program_id)
+            glDeleteProgram(self.program_id)
+            raise ShaderCompilationError(log.decode() if isinstance(log, bytes) else log)
+
+        self.attribute_locations = attribute_locations
+        self._uniform_locations = {}
+        # last value sent for each uniform, so that setting the same value again (e.g. the projection, for every
+        # shape) doesn't cost a GL call
+        self._uniform_values = {}
+
+    def use(self):
+        glUseProgram(self.program_id)
+
+    @staticmethod
+    def release():
+        glUseProgram(0)
+
+    def get_uniform_location(self, name):
+        if name not in self._uniform_locations:
+            self._uniform_locations[name] = glGetUniformLocation(self.program_id, name)
+        return self._uniform_locations[name]
+
+    def _value_changed(self, name, value):
+        if self._uniform_values.get(name) == value:
+            return False
+        self._uniform_values[name] = value
+        return True
+
+    def set_uniform_matrix(self, name, matrix):
+        # matrix is a row-major 4 x 4 numpy array, hence the transpose flag
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if self._value_changed(name, matrix.tobytes()):
+            glUniformMatrix4fv(self.get_uniform_location(name), 1, GL_TRUE, matrix)
+
+    def set_uniform_float(self, name, *values):
+        if not self._value_changed(name, values):
+            return
+        location = self.get_uniform_location(name)
+        if len(values) == 1:
+            glUniform1f(location, values[0])
+        elif len(values) == 2:
+            glUniform2f(location, *values)
+        elif len(values) == 3:
+            glUniform3f(location, *values)
+        else:
+            glUniform4f(location, *values)
+
+    def set_uniform_int(self, name, value):
+        if self._value_changed(name, value):
+            glUniform1i(self.get_uniform_location(name), value)
+
+    def delete(self):
+        glDeleteProgram(self.program_id)
+
+
+def _compile_shader(shader_type, source):
+    shader = glCreateShader(shader_type)
+    glShaderSource(shader, source)
+    glCompileShader(shader)
+    if glGetShaderiv(shader, GL_COMPILE_STATUS) != GL_TRUE:
+        log = glGetShaderInfoLog(shader)
+        glDeleteShader(shader)
+        raise ShaderCompilationError(log.decode() if isinstance(log, bytes) else log)
+    return shader
+
+
+def get_ortho_projection(view_bounds):
+    # the same matrix that glOrtho(x_min, x_max, y_min, y_max, -1, 1) would make, as a row-major numpy array
+    x_min, x_max, y_min, y_max = view_bounds
+    return np.array([
+        [2 / (x_max - x_min), 0, 0, -(x_max + x_min) / (x_max - x_min)],
+        [0, 2 / (y_max - y_min), 0, -(y_max + y_min) / (y_max - y_min)],
+        [0, 0, -1, 0],
+        [0, 0, 0, 1]
+    ], dtype=np.float32)
+
+
+# --------------------------------------- Instanced drawing ----------------------------------------
+
+# Attribute locations shared by the instanced program. Per-vertex data comes from a template mesh, and per-instance
+# data comes from one interleaved array of INSTANCE_FLOATS floats per instance:
+# center x, center y, size x, size y, r, g, b, a, rotation
+INSTANCE_ATTRIBUTE_LOCATIONS = {"a_position": 0, "a_tex_coord": 1, "a_center": 2, "a_size": 3, "a_color": 4,
+                                "a_rotation": 5}
+INSTANCE_FLOATS = 9
+# (attribute name, number of floats, offset in floats) for each per-instance attribute
+INSTANCE_ATTRIBUTE_LAYOUT = (("a_center", 2, 0), ("a_size", 2, 2), ("a_color", 4, 4), ("a_rotation", 1, 8))
+
+# (u offset, v offset, u scale, v scale) for textures that are used whole; see MarcPyImageHandler.get_texture_transform
+IDENTITY_TEX_TRANSFORM = (0.0, 0.0, 1.0, 1.0)
+
+INSTANCED_VERTEX_SOURCE = """
+ATTRIBUTE vec2 a_position;
+ATTRIBUTE vec2 a_tex_coord;
+ATTRIBUTE vec2 a_center;
+ATTRIBUTE vec2 a_size;
+ATTRIBUTE vec4 a_color;
+ATTRIBUTE float a_rotation;
+uniform mat4 u_projection;
+uniform vec4 u_tex_transform;
+VARYING vec4 v_color;
+VARYING vec2 v_tex_coord;
+
+void main() {
+    vec2 scaled = a_position * a_size;
+    float c = cos(a_rotation);
+    float s = sin(a_rotation);
+    vec2 rotated = vec2(c * scaled.x - s * scaled.y, s * scaled.x + c * scaled.y);
+    gl_Position = u_projection * vec4(a_center + rotated, 0.0, 1.0);
+    v_color = a_color;
+    // picks out the current frame, for animated images on an atlas
+    v_tex_coord = a_tex_coord * u_tex_transform.zw + u_tex_transform.xy;
+}
+"""
+
+INSTANCED_FRAGMENT_SOURCE = """
+uniform sampler2D u_texture;
+uniform int u_use_texture;
+VARYING vec4 v_color;
+VARYING vec2 v_tex_coord;
+
+void main() {
+    vec4 color = v_color;
+    if (u_use_texture != 0) {
+        color *= TEXTURE2D(u_texture, v_tex_coord);
+    }
+    FRAG_COLOR = color;
+}
+"""
+
+
+# ----------------------------------------- Core profile -------------------------------------------
+
+# The programs used by MarcGLShapes when the host widget is in core profile mode, standing in for what the
+# fixed-function pipeline does: flat color (glColor), per-vertex color (glColorPointer) and texture combined with color
+# (glTexEnv). Lines and points are drawn with the flat and per-vertex color programs like everything else.
+SHAPE_ATTRIBUTE_LOCATIONS = {"a_position": 0, "a_color": 1, "a_tex_coord": 2}
+
+# the fixed-function texture environment modes that the textured program knows how to imitate
+TEX_ENV_MODE_NUMBERS = {GL_MODULATE: 0, GL_REPLACE: 1, GL_DECAL: 2, GL_ADD: 3, GL_BLEND: 4}
+
+FLAT_VERTEX_SOURCE = """
+ATTRIBUTE vec2 a_position;
+uniform mat4 u_projection;
+
+void main() {
+    gl_Position = u_projection * vec4(a_position, 0.0, 1.0);
+}
+"""
+
+FLAT_FRAGMENT_SOURCE = """
+uniform vec4 u_color;
+
+void main() {
+    FRAG_COLOR = u_color;
+}
+"""
+
+VERTEX_COLOR_VERTEX_SOURCE = """
+ATTRIBUTE vec2 a_position;
+ATTRIBUTE vec4 a_color;
+uniform mat4 u_projection;
+VARYING vec4 v_color;
+
+void main() {
+    gl_Position = u_projection * vec4(a_position, 0.0, 1.0);
+    v_color = a_color;
+}
+"""
+
+VERTEX_COLOR_FRAGMENT_SOURCE = """
+VARYING vec4 v_color;
+
+void main() {
+    FRAG_COLOR = v_color;
+}
+"""
+
+TEXTURED_VERTEX_SOURCE = """
+ATTRIBUTE vec2 a_position;
+ATTRIBUTE vec4 a_color;
+ATTRIBUTE vec2 a_tex_coord;
+uniform mat4 u_projection;
+VARYING vec4 v_color;
+VARYING vec2 v_tex_coord;
+
+void main() {
+    gl_Position = u_projection * vec4(a_position, 0.0, 1.0);
+    v_color = a_color;
+    v_tex_coord = a_tex_coord;
+}
+"""
+
+# same formulas as the fixed-function texture environment for RGBA textures (with a zero GL_TEXTURE_ENV_COLOR)
+TEXTURED_FRAGMENT_SOURCE = """
+uniform sampler2D u_texture;
+uniform int u_tex_env_mode;
+VARYING vec4 v_color;
+VARYING vec2 v_tex_coord;
+
+void main() {
+    vec4 texel = TEXTURE2D(u_texture, v_tex_coord);
+    if (u_tex_env_mode == 1) {
+        FRAG_COLOR = texel;
+    } else if (u_tex_env_mode == 2) {
+        FRAG_COLOR = vec4(mix(v_color.rgb, texel.rgb, texel.a), v_color.a);
+    } else if (u_tex_env_mode == 3) {
+        FRAG_COLOR = vec4(min(v_color.rgb + texel.rgb, 1.0), v_color.a * texel.a);
+    } else if (u_tex_env_mode == 4) {
+        FRAG_COLOR = vec4(v_color.rgb * (1.0 - texel.rgb), v_color.a * texel.a);
+    } else {
+        FRAG_COLOR = v_color * texel;
+    }
+}
+"""
+
+# --------------------------------------------- Lines ----------------------------------------------
+
+# Thick lines drawn as one instance of a unit segment quad per line segment. The template vertex (a_position) has x = 0
+# at the start of the segment and 1 at the end, and y = -1 or 1 for the side. The per-instance points all come out of
+# the same buffer, at different offsets, so that a polyline only has to be uploaded once.
+LINE_ATTRIBUTE_LOCATIONS = {"a_position": 0, "a_prev": 2, "a_p0": 3, "a_p1": 4, "a_next": 5, "a_color0": 6,
+                            "a_color1": 7}
+
+# values of u_corner_type
+LINE_CORNER_NONE = 0
+LINE_CORNER_ROUNDED = 1
+LINE_CORNER_MITER = 2
+
+LINES_VERTEX_SOURCE = """
+ATTRIBUTE vec2 a_position;
+ATTRIBUTE vec2 a_prev;
+ATTRIBUTE vec2 a_p0;
+ATTRIBUTE vec2 a_p1;
+ATTRIBUTE vec2 a_next;
+ATTRIBUTE vec4 a_color0;
+ATTRIBUTE vec4 a_color1;
+uniform mat4 u_projection;
+uniform float u_width;
+uniform int u_corner_type;
+VARYING vec4 v_color;
+// distance along the segment from p0, signed distance across it, and the segment length
+VARYING vec3 v_segment_coords;
+
+// sharper joins than this get square ends instead of very long miter spikes
+const float MITER_LIMIT = 4.0;
+
+void main() {
+    vec2 segment = a_p1 - a_p0;
+    float segment_length = length(segment);
+    vec2 direction = segment_length > 0.0 ? segment / segment_length : vec2(1.0, 0.0);
+    vec2 normal = vec2(-direction.y, direction.x);
+    float half_width = 0.5 * u_width;
+    bool at_start = a_position.x < 0.5;
+    float along = at_start ? 0.0 : segment_length;
+    vec2 offset = normal * half_width * a_position.y;
+
+    if (u_corner_type == 1) {
+        // make room for the round caps, which the fragment shader cuts out
+        float extension = at_start ? -half_width : half_width;
+        along += extension;
+        offset += direction * extension;
+    } else if (u_corner_type == 2) {
+        // miter with the neighboring segment, if there is one (a neighbor of length zero means there isn't)
+        vec2 neighbor = at_start ? a_p0 - a_prev : a_next - a_p1;
+        float neighbor_length = length(neighbor);
+        if (neighbor_length > 0.0) {
+            vec2 miter = normal + vec2(-neighbor.y, neighbor.x) / neighbor_length;
+            float miter_length = length(miter);
+            if (miter_length > 0.0) {
+                miter /= miter_length;
+                float miter_scale = 1.0 / dot(miter, normal);
+                if (miter_scale <= MITER_LIMIT) {
+                    offset = miter * half_width * miter_scale * a_position.y;
+                }
+            }
+        }
+    }
+
+    v_segment_coords = vec3(along, half_width * a_position.y, segment_length);
+    v_color = at_start ? a_color0 : a_color1;
+    gl_Position = u_projection * vec4((at_start ? a_p0 : a_p1) + offset, 0.0, 1.0);
+}
+"""
+
+LINES_FRAGMENT_SOURCE = """
+uniform float u_width;
+uniform int u_corner_type;
+VARYING vec4 v_color;
+VARYING vec3 v_segment_coords;
+
+void main() {
+    if (u_corner_type == 1) {
+        // keep only what's within half a width of the segment, which rounds off the ends
+        float clamped_along = clamp(v_segment_coords.x, 0.0, v_segment_coords.z);
+        if (length(vec2(v_segment_coords.x - clamped_along, v_segment_coords.y)) > 0.5 * u_width) {
+            discard;
+        }
+    }
+    FRAG_COLOR = v_color;
+}
+"""
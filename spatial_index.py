@@ -0,0 +1,189 @@
+import numpy as np
+
+# Bounding boxes for culling (and finding) shapes by where they are. Boxes are (x_min, x_max, y_min, y_max), in the
+# same order as a MarcPaintWidget's view_bounds, and arrays of them are N x 4.
+
+
+def get_bounds(vertices):
+    # the bounding box of an N x 2 array of points, or None if there are none
+    if len(vertices) == 0:
+        return None
+    # column by column, which is many times quicker than reducing along axis 0 of an N x 2 array
+    xs, ys = vertices[:, 0], vertices[:, 1]
+    return float(xs.min()), float(xs.max()), float(ys.min()), float(ys.max())
+
+
+def get_element_bounds(vertices, starting_indices):
+    # the bounding box of each run of vertices from one starting index up to the next (e.g. each fan of a multi draw)
+    # (an empty run at the very end would be out of range for reduceat; its box doesn't matter, since it draws nothing)
+    starting_indices = np.minimum(starting_indices, len(vertices) - 1)
+    boxes = np.empty((len(starting_indices), 4), dtype=vertices.dtype)
+    boxes[:, 0::2] = np.minimum.reduceat(vertices, starting_indices, axis=0)
+    boxes[:, 1::2] = np.maximum.reduceat(vertices, starting_indices, axis=0)
+    return boxes
+
+
+def union_bounds(bounds, other_bounds):
+    if bounds is None or other_bounds is None:
+        return other_bounds if bounds is None else bounds
+    return (min(bounds[0], other_bounds[0]), max(bounds[1], other_bounds[1]),
+            min(bounds[2], other_bounds[2]), max(bounds[3], other_bounds[3]))
+
+
+def pad_bounds(bounds, x_padding, y_padding=None):
+    y_padding = x_padding if y_padding is None else y_padding
+    return bounds[0] - x_padding, bounds[1] + x_padding, bounds[2] - y_padding, bounds[3] + y_padding
+
+
+def bounds_intersect(bounds, other_bounds):
+    return bounds[0] <= other_bounds[1] and other_bounds[0] <= bounds[1] and \
+        bounds[2] <= other_bounds[3] and other_bounds[2] <= bounds[3]
+
+
+def bounds_contain(outer_bounds, inner_bounds):
+    return outer_bounds[0] <= inner_bounds[0] and inner_bounds[1] <= outer_bounds[1] and \
+        outer_bounds[2] <= inner_bounds[2] and inner_bounds[3] <= outer_bounds[3]
+
+
+def boxes_intersect(boxes, bounds):
+    # which rows of an N x 4 array of boxes overlap bounds, as a boolean array
+    return (boxes[:, 0] <= bounds[1]) & (boxes[:, 1] >= bounds[0]) & \
+        (boxes[:, 2] <= bounds[3]) & (boxes[:, 3] >= bounds[2])
+
+
+class SpatialGrid:
+    """
+    A uniform grid over a fixed set of boxes, for quickly finding the ones that overlap a query box. Each box is listed
+    in every cell it touches, except for boxes spanning lots of cells, which are just checked on every query. The cell
+    lists are stored back to back, ordered by cell, so that each row of cells in a query is a single slice.
+    """
+
+    # boxes touching more cells than this aren't put into cells
+    MAX_CELLS_PER_BOX = 64
+
+    def __init__(self, boxes, cells_per_box=2.0, max_cells=65536):
+        """
+        :param boxes: an N x 4 array of (x_min, x_max, y_min, y_max)
+        :param cells_per_box: roughly how many cells there are per box; more cells means fewer candidates to check
+            per query, but more memory and more cells to visit
+        """
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        num_boxes = len(self.boxes)
+        if num_boxes == 0:
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+        else:
+            self.bounds = (self.boxes[:, 0].min(), self.boxes[:, 1].max(), self.boxes[:, 2].min(),
+                           self.boxes[:, 3].max())
+        self.num_columns = self.num_rows = max(1, int(np.sqrt(min(max_cells, num_boxes * cells_per_box))))
+        # tiny extents would make for infinite cell counts, so each cell is at least some sliver wide
+        self.cell_width = max(self.bounds[1] - self.bounds[0], 1e-12) / self.num_columns
+        self.cell_height = max(self.bounds[3] - self.bounds[2], 1e-12) / self.num_rows
+
+        first_columns, last_columns, first_rows, last_rows = self._get_cell_ranges(self.boxes)
+        widths = last_columns - first_columns + 1
+        box_cell_counts = widths * (last_rows - first_rows + 1)
+        in_cells = box_cell_counts <= self.MAX_CELLS_PER_BOX
+        self.large_boxes = np.flatnonzero(~in_cells)
+
+        # one entry for every (box, cell) pair, worked out all at once
+        box_numbers = np.flatnonzero(in_cells)
+        counts = box_cell_counts[in_cells]
+        entry_boxes = np.repeat(box_numbers, counts)
+        entry_offsets = np.arange(len(entry_boxes)) - np.repeat(np.cumsum(counts) - counts, counts)
+        entry_widths = widths[entry_boxes]
+        entry_cells = (first_rows[entry_boxes] + entry_offsets // entry_widths) * self.num_columns + \
+            first_columns[entry_boxes] + entry_offsets % entry_widths
+        order = np.argsort(entry_cells, kind="stable")
+        self.cell_boxes = entry_boxes[order]
+        self.cell_starts = np.zeros(self.num_columns * self.num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_cells, minlength=self.num_columns * self.num_rows), out=self.cell_starts[1:])
+
+    def _get_cell_ranges(self, boxes):
+        first_columns = np.clip(((boxes[:, 0] - self.bounds[0]) // self.cell_width).astype(np.int64), 0,
+                                self.num_columns - 1)
+        last_columns = np.clip(((boxes[:, 1] - self.bounds[0]) // self.cell_width).astype(np.int64), 0,
+                               self.num_columns - 1)
+        first_rows = np.clip(((boxes[:, 2] - self.bounds[2]) // self.cell_height).astype(np.int64), 0,
+                             self.num_rows - 1)
+        last_rows = np.clip(((boxes[:, 3] - self.bounds[2]) // self.cell_height).astype(np.int64), 0,
+                            self.num_rows - 1)
+        return first_columns, last_columns, first_rows, last_rows
+
+    def query(self, bounds):
+        """
+        :param bounds: (x_min, x_max, y_min, y_max)
+        :return: sorted array of the numbers of the boxes that overlap bounds
+        """
+        if len(self.boxes) == 0 or not bounds_intersect(self.bounds, bounds):
+            return np.empty(0, dtype=np.int64)
+        if bounds_contain(bounds, self.bounds):
+            return np.arange(len(self.boxes))
+        query_boxes = np.array([bounds], dtype=np.float64)
+        first_column, last_column, first_row, last_row = (values[0] for values in self._get_cell_ranges(query_boxes))
+        if (last_column - first_column + 1) * (last_row - first_row + 1) * 4 > self.num_columns * self.num_rows:
+            # most of the grid; checking every box is quicker than gathering them from cells
+            return np.flatnonzero(boxes_intersect(self.boxes, bounds))
+        candidates = [self.large_boxes]
+        for row in range(first_row, last_row + 1):
+            start_cell = row * self.num_columns + first_column
+            end_cell = row * self.num_columns + last_column + 1
+            candidates.append(self.cell_boxes[self.cell_starts[start_cell]:self.cell_starts[end_cell]])
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[boxes_intersect(self.boxes[candidates], bounds)]
+
+
+class ShapeIndex:
+    """
+    A spatial index of a list of shapes (those of a layer, say), for finding the ones in view. Shapes without bounds
+    (text, state switches...) always count as in view, and dynamic shapes, whose bounds can change, are checked one
+    by one rather than put in the grid. Shapes that paint beyond their bounds by some pixels (wide lines) have their
+    bounds padded by that many pixels at the size pixels are when querying.
+    """
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.unbounded = []
+        self.changing = []
+        fixed_numbers = []
+        fixed_boxes = []
+        fixed_paddings = []
+        for shape_number, shape in enumerate(shapes):
+            if getattr(shape, "dynamic", False):
+                self.changing.append(shape_number)
+                continue
+            bounds = shape.get_bounds()
+            if bounds is None:
+                self.unbounded.append(shape_number)
+            else:
+                fixed_numbers.append(shape_number)
+                fixed_boxes.append(bounds)
+                fixed_paddings.append(shape.get_pixel_padding())
+        self.fixed_numbers = np.array(fixed_numbers, dtype=np.int64)
+        self.fixed_paddings = np.array(fixed_paddings, dtype=np.float64)
+        self.max_padding = float(self.fixed_paddings.max()) if len(fixed_paddings) > 0 else 0.0
+        self.grid = SpatialGrid(np.array(fixed_boxes, dtype=np.float64).reshape(-1, 4))
+
+    def get_visible_shapes(self, bounds, pixel_size=(0.0, 0.0)):
+        """
+        :param pixel_size: (width, height) of a pixel in the units of bounds, for padding the shapes' bounds
+        :return: the shapes that overlap bounds, in their original order
+        """
+        pixel_width, pixel_height = pixel_size
+        candidates = self.grid.query(pad_bounds(bounds, self.max_padding * pixel_width,
+                                                self.max_padding * pixel_height))
+        if self.max_padding > 0:
+            # (the query was padded for the widest shape; the rest are checked with their own padding)
+            padded_boxes = self.grid.boxes[candidates] + np.outer(self.fixed_paddings[candidates],
+                                                                  (-pixel_width, pixel_width, -pixel_height,
+                                                                   pixel_height))
+            candidates = candidates[boxes_intersect(padded_boxes, bounds)]
+        shape_numbers = [self.fixed_numbers[candidates], np.array(self.unbounded, dtype=np.int64)]
+        for shape_number in self.changing:
+            shape = self.shapes[shape_number]
+            shape_bounds = shape.get_bounds()
+            if shape_bounds is None or bounds_intersect(pad_bounds(shape_bounds,
+                                                                   shape.get_pixel_padding() * pixel_width,
+                                                                   shape.get_pixel_padding() * pixel_height),
+                                                        bounds):
+                shape_numbers.append(np.array([shape_number], dtype=np.int64))
+        return [self.shapes[shape_number] for shape_number in np.sort(np.concatenate(shape_numbers))]
@@ -0,0 +1,32 @@
+import os
+import pytest
+
+# the tests render headlessly, so they don't need a display; they're skipped where no OpenGL context can be made
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtWidgets
+from ..offscreen import OffscreenMarcPaintWidget, OffscreenRenderingError
+
+
+@pytest.fixture(scope="session")
+def qt_app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def make_renderer(qt_app):
+    # makes OffscreenMarcPaintWidgets (without multisampling, so that edges come out the same every time)
+    def make_renderer(**kwargs):
+        kwargs.setdefault("size", (100, 100))
+        kwargs.setdefault("samples", 0)
+        try:
+            return OffscreenMarcPaintWidget(**kwargs)
+        except OffscreenRenderingError as error:
+            pytest.skip(str(error))
+    return make_renderer
+
+
+def count_draw_calls(renderer):
+    # draw calls made while rendering the last frame
+    return sum(count for gl_function_name, count in renderer.get_gl_call_counts().items()
+               if gl_function_name.startswith("glDraw") or gl_function_name.startswith("glMultiDraw"))
@@ -0,0 +1,65 @@
+import numpy as np
+from ..marc_paint import CornerTypes
+from ..layers import DEFAULT_LAYER_NAME
+from .conftest import count_draw_calls
+
+
+def draw_rects(renderer, locations, colors):
+    # one fill_rects call (so one shape) per rect
+    for location, color in zip(locations, colors):
+        renderer.fill_rects([location], (0.05, 0.05), color)
+
+
+def test_adjacent_compatible_shapes_collapse_into_one_draw_call(make_renderer):
+    rng = np.random.default_rng(0)
+    locations, colors = rng.random((50, 2)), rng.random((50, 3))
+    batched = make_renderer(batch_shapes=True)
+    unbatched = make_renderer(batch_shapes=False)
+    for renderer in (batched, unbatched):
+        draw_rects(renderer, locations, colors[:, np.newaxis].repeat(4, axis=1))
+    batched_pixels, unbatched_pixels = batched.render(), unbatched.render()
+    assert count_draw_calls(batched) == 1
+    assert count_draw_calls(unbatched) == 50
+    np.testing.assert_array_equal(batched_pixels, unbatched_pixels)
+
+
+def test_batches_break_at_incompatible_shapes(make_renderer):
+    renderer = make_renderer()
+    red, blue = np.array((1, 0, 0)), np.array((0, 0, 1))
+    # single colors are set once per draw call, so a different one starts a new batch
+    draw_rects(renderer, [(0.1, 0.1), (0.2, 0.2)], [red, red])
+    draw_rects(renderer, [(0.3, 0.3)], [blue])
+    draw_rects(renderer, [(0.4, 0.4), (0.5, 0.5)], [red, red])
+    renderer.render()
+    assert count_draw_calls(renderer) == 3
+
+    # nothing is merged across the depth test switches around rounded lines
+    renderer.clear()
+    draw_rects(renderer, [(0.1, 0.1)], [red])
+    renderer.draw_lines(np.array([(0.2, 0.2), (0.8, 0.8)]), red, width=0.05, corner_type=CornerTypes.ROUNDED)
+    draw_rects(renderer, [(0.6, 0.1)], [red])
+    renderer.render()
+    # the rect before, the line's quads and round caps, and the rect after
+    assert count_draw_calls(renderer) == 4
+
+
+def test_shapes_added_between_frames_extend_the_batches(make_renderer):
+    rng = np.random.default_rng(1)
+    locations, colors = rng.random((64, 2)), rng.random((64, 4, 3))
+    renderer = make_renderer()
+    for rect_number in range(64):
+        draw_rects(renderer, locations[rect_number:rect_number + 1], colors[rect_number:rect_number + 1])
+        pixels = renderer.render()
+        # the run is kept as a few merged chunks, rather than being merged all over again
+        assert count_draw_calls(renderer) <= 1 + int(np.log2(rect_number + 1))
+
+    # adding another rect leaves the biggest chunk as it was
+    biggest_chunk = renderer.layer(DEFAULT_LAYER_NAME).get_shapes_to_paint()[0]
+    draw_rects(renderer, locations[:1], colors[:1])
+    renderer.render()
+    assert renderer.layer(DEFAULT_LAYER_NAME).get_shapes_to_paint()[0] is biggest_chunk
+
+    redrawn = make_renderer()
+    draw_rects(redrawn, locations, colors)
+    np.testing.assert_array_equal(pixels, redrawn.render())
+    assert count_draw_calls(redrawn) == 1
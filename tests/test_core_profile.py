@@ -0,0 +1,104 @@
+import math
+import numpy as np
+import pytest
+from PyQt5.QtGui import QImage, QColor
+from ..marc_paint import CornerTypes
+
+# The core profile renderer has to paint exactly what the fixed-function one does. Each scene below is drawn by both
+# and the framebuffers compared pixel for pixel.
+
+SIZE = (120, 120)
+TEXTURE_NAME = "checker"
+
+
+def make_checker_image(file_path):
+    # 16 x 16 pixels of four colors in 4 x 4 squares, with some translucent ones to exercise blending
+    image = QImage(16, 16, QImage.Format_RGBA8888)
+    square_colors = (QColor(255, 0, 0), QColor(0, 255, 0), QColor(0, 0, 255, 128), QColor(255, 255, 255, 200))
+    for x in range(16):
+        for y in range(16):
+            image.setPixelColor(x, y, square_colors[(x // 4 + y // 4) % 4])
+    assert image.save(str(file_path))
+    return str(file_path)
+
+
+def draw_streaming_line_strip(renderer, rng):
+    strip = renderer.draw_streaming_line_strip(40, (1, 1, 0), per_vertex_colors=True)
+    strip.append(np.column_stack((np.linspace(0, 1, 60), rng.random(60))), rng.random((60, 3)))
+
+
+SQUARE_TEX_COORDS = np.array([(0, 0), (0, 1), (1, 1), (1, 0)], dtype=float)
+
+SCENES = {
+    "points": lambda renderer, rng: renderer.draw_points(rng.random((30, 2)), (1, 1, 1)),
+    "wide points": lambda renderer, rng: renderer.draw_points(rng.random((30, 2)), rng.random((30, 3)), width=0.03),
+    "triangles": lambda renderer, rng: renderer.fill_triangles(rng.random((9, 2)), rng.random((9, 4))),
+    "indexed triangles": lambda renderer, rng: renderer.fill_triangles(
+        rng.random((6, 2)), rng.random((6, 3)), indices=np.array([0, 1, 2, 2, 3, 4, 4, 5, 0])),
+    "triangle fans": lambda renderer, rng: renderer.fill_triangle_fans(
+        rng.random((9, 2)), rng.random((3, 3)), starting_indices=np.array([0, 3, 6])),
+    "triangle strips": lambda renderer, rng: renderer.fill_triangle_strips(
+        rng.random((10, 2)), (0, 1, 0.5), starting_indices=np.array([0, 5])),
+    "quads": lambda renderer, rng: renderer.fill_quads(rng.random((40, 2)), rng.random((10, 3))),
+    "quad outlines": lambda renderer, rng: renderer.draw_quads(rng.random((8, 2)), rng.random((8, 3))),
+    "rects": lambda renderer, rng: renderer.fill_rects(rng.random((20, 2)), (0.1, 0.08), rng.random((20, 4))),
+    "instanced rects": lambda renderer, rng: renderer.fill_rects(
+        rng.random((20, 2)), rng.random((20, 2)) * 0.2, rng.random((20, 4)), center_anchored=True, instanced=True,
+        rotations=rng.random(20) * math.pi),
+    "rect outlines": lambda renderer, rng: renderer.draw_rects(rng.random((6, 2)), (0.2, 0.1), (1, 0, 1)),
+    "thick rect outlines": lambda renderer, rng: renderer.draw_rects(
+        rng.random((6, 2)), (0.2, 0.1), (1, 0.5, 0), width=0.02, center_anchored=True),
+    "lines": lambda renderer, rng: renderer.draw_lines(rng.random((10, 2)), rng.random((5, 3))),
+    "thick lines": lambda renderer, rng: renderer.draw_lines(rng.random((10, 2)), (0, 0, 1), width=0.03),
+    "rounded lines": lambda renderer, rng: renderer.draw_lines(
+        rng.random((10, 2)), (0, 0.5, 1, 0.5), width=0.04, corner_type=CornerTypes.ROUNDED),
+    "instanced lines": lambda renderer, rng: renderer.draw_lines(
+        rng.random((10, 2)), rng.random((10, 3)), width=0.03, corner_type=CornerTypes.ROUNDED, instanced=True),
+    "line strip": lambda renderer, rng: renderer.draw_line_strip(rng.random((8, 2)), (1, 1, 0)),
+    "thick line strip": lambda renderer, rng: renderer.draw_line_strip(rng.random((8, 2)), (1, 1, 0), width=0.03),
+    "instanced line strip": lambda renderer, rng: renderer.draw_line_strip(
+        rng.random((8, 2)), (1, 1, 0), width=0.03, corner_type=CornerTypes.FLAT_BRUSH, instanced=True),
+    "streaming line strip": draw_streaming_line_strip,
+    "polygons": lambda renderer, rng: renderer.draw_polygons(
+        rng.random((9, 2)), (0.5, 0.5, 1), start_indices=np.array([0, 4])),
+    "arcs": lambda renderer, rng: renderer.fill_arcs(rng.random((10, 2)), rng.random(10) * 0.1, rng.random((20, 4))),
+    "arc slices": lambda renderer, rng: renderer.fill_arcs(
+        rng.random((10, 2)), rng.random((10, 2)) * 0.1, rng.random((10, 3)), angle_ranges=rng.random((10, 2)) * 6),
+    "level of detail arcs": lambda renderer, rng: renderer.fill_arcs(
+        rng.random((10, 2)), rng.random(10) * 0.2, (0, 1, 1), num_segments=None),
+    "instanced arcs": lambda renderer, rng: renderer.fill_arcs(
+        rng.random((10, 2)), rng.random(10) * 0.1, rng.random((10, 4)), instanced=True),
+    "rings": lambda renderer, rng: renderer.fill_rings(
+        rng.random((4, 2)), np.full(4, 0.05), np.full(4, 0.1), rng.random((4, 3))),
+    "image": lambda renderer, rng: renderer.draw_image((0.1, 0.2), TEXTURE_NAME, width=0.6),
+    "instanced images": lambda renderer, rng: renderer.draw_image(
+        rng.random((5, 2)), TEXTURE_NAME, width=0.2, height=0.2, center_anchored=True, instanced=True,
+        rotations=rng.random(5)),
+    "textured quads": lambda renderer, rng: renderer.fill_quads(
+        np.array([(0.1, 0.1), (0.1, 0.9), (0.9, 0.9), (0.9, 0.1)]), (1, 1, 1, 0.8), texture=TEXTURE_NAME,
+        tex_coords=SQUARE_TEX_COORDS),
+    "textured triangles": lambda renderer, rng: renderer.fill_triangles(
+        np.array([(0.1, 0.1), (0.5, 0.9), (0.9, 0.1)]), (1, 0.5, 0.5), texture=TEXTURE_NAME,
+        tex_coords=SQUARE_TEX_COORDS[:3]),
+    "text": lambda renderer, rng: renderer.draw_text("Marqt 123", (0.1, 0.4), 0.2, (1, 1, 1), "Arial"),
+    "glyph atlas text": lambda renderer, rng: renderer.draw_text(
+        "Marqt 123", (0.1, 0.4), 0.2, (1, 1, 0.5), "Arial", use_glyph_atlas=True),
+}
+
+
+@pytest.mark.parametrize("use_vbos", (False, True))
+@pytest.mark.parametrize("scene_name", sorted(SCENES))
+def test_core_profile_matches_fixed_function(make_renderer, tmp_path, scene_name, use_vbos):
+    texture_path = make_checker_image(tmp_path / "checker.png")
+    frames = []
+    for core_profile in (False, True):
+        renderer = make_renderer(size=SIZE, core_profile=core_profile, use_vbos=use_vbos, bg_color=(0.2, 0.2, 0.2, 1),
+                                 textures={TEXTURE_NAME: texture_path})
+        # the first render loads the texture
+        renderer.render()
+        SCENES[scene_name](renderer, np.random.default_rng(0))
+        frames.append(renderer.render())
+    fixed_function_frame, core_profile_frame = frames
+    # (a scene that failed to draw anything would match trivially)
+    assert (fixed_function_frame != fixed_function_frame[0, 0]).any()
+    np.testing.assert_array_equal(fixed_function_frame, core_profile_frame)
@@ -0,0 +1,121 @@
+import math
+import numpy as np
+import pytest
+from ..picking import PickIndex, PolygonTargets, LineTargets, ArcTargets
+
+# PickIndex tests the geometry of each kind of target exactly, rather than their bounding boxes, and returns the hits
+# topmost (last added) first. None of this needs an OpenGL context; the id pass at the end does.
+
+PIXEL_SIZE = 0.01
+
+
+def make_index(*targets):
+    pick_index = PickIndex()
+    for this_targets in targets:
+        pick_index.add(this_targets)
+    return pick_index
+
+
+def is_hit(targets, location, radius=0):
+    return make_index(targets).pick(location, radius, PIXEL_SIZE) == [(0, 0)]
+
+
+def get_rotated_square(center, half_size, angle):
+    corners = np.array([(-1, -1), (1, -1), (1, 1), (-1, 1)]) * half_size
+    rotation = np.array([(math.cos(angle), -math.sin(angle)), (math.sin(angle), math.cos(angle))])
+    return corners @ rotation.T + center
+
+
+def test_rotated_rects_are_hit_inside_their_corners_not_their_boxes():
+    # a diamond reaching 0.1 * sqrt(2) from its center along the axes
+    targets = PolygonTargets([get_rotated_square((0.5, 0.5), 0.1, math.pi / 4)], "diamond")
+    assert is_hit(targets, (0.5, 0.5))
+    assert is_hit(targets, (0.63, 0.5))
+    assert is_hit(targets, (0.5, 0.37))
+    # inside the bounding box, but past the edge between two corners
+    assert not is_hit(targets, (0.59, 0.59))
+    # ... by about 0.027, which a radius makes up for
+    assert is_hit(targets, (0.59, 0.59), radius=0.03)
+    assert not is_hit(targets, (0.59, 0.59), radius=0.02)
+
+
+def test_ellipses_are_hit_inside_their_outline():
+    targets = ArcTargets([(0.5, 0.5)], [(0.2, 0.05)], (0, 2 * math.pi), "ellipse")
+    assert is_hit(targets, (0.68, 0.5))
+    assert is_hit(targets, (0.5, 0.53))
+    assert not is_hit(targets, (0.5, 0.56))
+    # inside the box, outside the ellipse
+    assert not is_hit(targets, (0.65, 0.54))
+    assert is_hit(targets, (0.72, 0.5), radius=0.03)
+
+
+def test_pie_slices_are_hit_only_within_their_angle_range():
+    quarter = ArcTargets([(0, 0)], [(0.2, 0.2)], (0, math.pi / 2), "quarter")
+    assert is_hit(quarter, (0.1, 0.1))
+    assert not is_hit(quarter, (-0.1, 0.1))
+    assert not is_hit(quarter, (0.1, -0.1))
+    assert not is_hit(quarter, (0.15, 0.15))
+    # a range going past 2 pi wraps around through 0
+    right_half = ArcTargets([(0, 0)], [(0.2, 0.2)], (3 * math.pi / 2, 5 * math.pi / 2), "right half")
+    assert is_hit(right_half, (0.1, 0.1))
+    assert is_hit(right_half, (0.1, -0.1))
+    assert not is_hit(right_half, (-0.1, 0.1))
+
+
+def test_thin_lines_get_a_pixel_of_leeway():
+    thin = LineTargets([(0, 0.5)], [(1, 0.5)], None, "thin")
+    assert is_hit(thin, (0.5, 0.505))
+    assert not is_hit(thin, (0.5, 0.515))
+    assert is_hit(thin, (0.5, 0.515), radius=0.01)
+    # past the end of the line as well
+    assert is_hit(thin, (1.005, 0.5))
+    assert not is_hit(thin, (1.02, 0.5))
+    # wide lines go by their width
+    wide = LineTargets([(0, 0.5)], [(1, 0.5)], 0.1, "wide")
+    assert is_hit(wide, (0.5, 0.54))
+    assert not is_hit(wide, (0.5, 0.56))
+
+
+def test_hits_come_topmost_first():
+    location = (0.5, 0.5)
+    rects = PolygonTargets([get_rotated_square(location, 0.1, 0), get_rotated_square(location, 0.2, 0.3)],
+                           ["bottom rect", "top rect"])
+    arcs = ArcTargets([(0.55, 0.5), (0.9, 0.9)], [(0.1, 0.1), (0.05, 0.05)], (0, 2 * math.pi), "arc")
+    lines = LineTargets([(0, 0)], [(1, 1)], 0.02, "line")
+    pick_index = make_index(rects, arcs, lines)
+    assert pick_index.pick(location, 0, PIXEL_SIZE) == [(2, 0), (1, 0), (0, 1), (0, 0)]
+    assert pick_index.pick((0.9, 0.9), 0, PIXEL_SIZE) == [(2, 0), (1, 1)]
+    assert pick_index.pick((0.1, 0.9), 0, PIXEL_SIZE) == []
+
+    # targets added after picking are found too
+    pick_index.add(PolygonTargets([get_rotated_square((0.1, 0.9), 0.05, 0)], "corner"))
+    assert pick_index.pick((0.1, 0.9), 0, PIXEL_SIZE) == [(3, 0)]
+    pick_index.clear()
+    assert pick_index.pick(location, 0, PIXEL_SIZE) == []
+
+
+def test_ids_are_given_per_item_or_once_for_all():
+    squares = [get_rotated_square((x, 0.5), 0.05, 0) for x in (0.2, 0.5, 0.8)]
+    for per_item_ids in (["a", "b", "c"], ("a", "b", "c"), np.array(["a", "b", "c"])):
+        assert [PolygonTargets(squares, per_item_ids).get_id(item_number) for item_number in range(3)] == \
+            ["a", "b", "c"]
+    assert PolygonTargets(squares, "all").get_id(2) == "all"
+    with pytest.raises(ValueError):
+        PolygonTargets(squares, ["a", "b"])
+    with pytest.raises(ValueError):
+        PolygonTargets(squares, ("a", "b", "c", "d"))
+
+
+@pytest.mark.parametrize("core_profile", (False, True))
+def test_gpu_picking_finds_only_what_is_visible(make_renderer, core_profile):
+    renderer = make_renderer(core_profile=core_profile)
+    renderer.fill_rects([(0.2, 0.2)], (0.4, 0.4), (1, 0, 0), ids="under")
+    renderer.fill_rects([(0.3, 0.3)], (0.4, 0.4), (0, 1, 0), ids="over")
+    with renderer.layer("top"):
+        renderer.fill_arcs(np.array([(0.5, 0.5)]), np.array([0.05]), (0, 0, 1), ids="arc")
+    renderer.render()
+    assert renderer.pick((0.5, 0.5)) == ["arc", "over", "under"]
+    assert renderer.pick((0.5, 0.5), use_gpu=True) == ["arc"]
+    assert renderer.pick((0.35, 0.35), use_gpu=True) == ["over"]
+    assert renderer.pick((0.25, 0.25), use_gpu=True) == ["under"]
+    assert renderer.pick((0.9, 0.1), use_gpu=True) == []
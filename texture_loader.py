@@ -0,0 +1,147 @@
+from PyQt5.QtCore import QMetaObject, QTimer, Qt
+from marcpy.utilities import enum
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import time
+from .image_processing import MarcPyImage
+
+# Loading textures without freezing the widget (see MarcPaintWidget.load_texture with asynchronous=True). Decoding the
+# image files, which is the slow part, happens on a pool of threads. Decoded images wait in a queue until the widget
+# paints, and are uploaded to the gpu then (which has to happen on the GUI thread, with the context current). Only so
+# much uploading is done per frame (upload_time_budget), so that a pile of finished images doesn't cause a stutter.
+
+TextureLoadStates = enum(NOT_LOADED="not loaded", LOADING="loading", DECODED="decoded", LOADED="loaded",
+                         FAILED="failed")
+
+
+class TextureLoader:
+
+    def __init__(self, host_widget, max_workers=4, upload_time_budget=0.004):
+        """
+        :param max_workers: the number of decoding threads
+        :param upload_time_budget: in seconds; how long to spend uploading decoded images per frame. At least one image
+            is uploaded per frame, however long it takes.
+        """
+        self.host_widget = host_widget
+        self.max_workers = max_workers
+        self.upload_time_budget = upload_time_budget
+        # the thread pool is only started once something is loaded asynchronously
+        self._executor = None
+        self._lock = threading.Lock()
+        # (texture name, request number, decoded MarcPyImage or the exception raised decoding it), in order of decoding
+        self._decoded = deque()
+        self._states = {}
+        self._callbacks = {}
+        # if a texture is asked for again before it's done, only the latest request counts
+        self._request_numbers = {}
+        self._next_request_number = 0
+        # how long has been spent uploading this frame (see begin_frame), and whether anything has been
+        self._upload_time_this_frame = 0.0
+        self._uploaded_this_frame = False
+        # {texture name: the exception} for textures that couldn't be loaded
+        self.failures = {}
+
+    # ------------------------------------ Requests -------------------------------------
+
+    def load_asynchronously(self, texture_name, texture_path, callback=None):
+        request_number = self._start_request(texture_name, callback)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="texture loader")
+        self._executor.submit(self._decode, texture_name, texture_path, request_number)
+
+    def load_now(self, texture_name, texture_path, callback=None):
+        # decodes and uploads right away; must be called with the GL context current
+        request_number = self._start_request(texture_name, callback)
+        try:
+            result = MarcPyImage(texture_path, make_opengl_textures=False, clock=self.host_widget.frame_clock)
+        except Exception as error:
+            result = error
+        self._finish(texture_name, request_number, result)
+
+    def _start_request(self, texture_name, callback):
+        with self._lock:
+            request_number = self._next_request_number
+            self._next_request_number += 1
+            self._request_numbers[texture_name] = request_number
+            self._states[texture_name] = TextureLoadStates.LOADING
+        self._callbacks[texture_name] = callback
+        self.failures.pop(texture_name, None)
+        return request_number
+
+    def _decode(self, texture_name, texture_path, request_number):
+        # runs on a loader thread, so no GL in here
+        try:
+            result = MarcPyImage(texture_path, make_opengl_textures=False, clock=self.host_widget.frame_clock)
+            result.prepare_for_upload()
+        except Exception as error:
+            result = error
+        with self._lock:
+            self._decoded.append((texture_name, request_number, result))
+            if self._request_numbers.get(texture_name) == request_number:
+                self._states[texture_name] = TextureLoadStates.DECODED
+        try:
+            # widgets can only be touched from the GUI thread, so the repaint is queued up over there
+            QMetaObject.invokeMethod(self.host_widget, "update", Qt.QueuedConnection)
+        except RuntimeError:
+            # the widget is gone
+            pass
+
+    # ------------------------------------- Uploads --------------------------------------
+
+    def begin_frame(self):
+        # the upload budget is per frame, however many times upload_decoded_textures is called during it
+        self._upload_time_this_frame = 0.0
+        self._uploaded_this_frame = False
+
+    def upload_decoded_textures(self):
+        # called while painting, with the context current
+        while self._upload_time_this_frame <= self.upload_time_budget or not self._uploaded_this_frame:
+            with self._lock:
+                if len(self._decoded) == 0:
+                    return
+                texture_name, request_number, result = self._decoded.popleft()
+            start_time = time.perf_counter()
+            self._finish(texture_name, request_number, result)
+            self._upload_time_this_frame += time.perf_counter() - start_time
+            self._uploaded_this_frame = True
+        with self._lock:
+            uploads_left = len(self._decoded) > 0
+        if uploads_left:
+            # out of time for this frame; the rest get uploaded over the next ones
+            QTimer.singleShot(0, self.host_widget.update)
+
+    def _finish(self, texture_name, request_number, result):
+        with self._lock:
+            if self._request_numbers.get(texture_name) != request_number:
+                # superseded by a later request for the same name
+                return
+            del self._request_numbers[texture_name]
+        if isinstance(result, Exception):
+            texture, state = None, TextureLoadStates.FAILED
+            self.failures[texture_name] = result
+        else:
+            result.make_opengl_textures()
+            self.host_widget.textures[texture_name] = result
+            texture, state = result, TextureLoadStates.LOADED
+            self.host_widget.mark_dirty()
+        with self._lock:
+            self._states[texture_name] = state
+        callback = self._callbacks.pop(texture_name, None)
+        if callback is not None:
+            callback(texture_name, texture)
+
+    # -------------------------------------- Queries --------------------------------------
+
+    def get_state(self, texture_name):
+        if texture_name in self._states:
+            return self._states[texture_name]
+        return TextureLoadStates.LOADED if texture_name in self.host_widget.textures else TextureLoadStates.NOT_LOADED
+
+    def has_pending_loads(self):
+        return len(self._request_numbers) > 0
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None